@@ -0,0 +1,933 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the simulation infrastructure (messenger, transports, nodes).
+
+Run with: python benchmark.py
+The nodes record every message in the event log (event_log.py) at debug level, which is not kept by default, so
+the measurements do not pay for formatting it. quiet() discards what is still printed, e.g., echoed warnings and the
+startup output of the servers.
+"""
+
+import asyncio
+import collections
+import contextlib
+import hashlib
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import event_log
+import launcher
+import node as lab_node
+import server as labs_server
+from paste import httpserver
+from retransmission import OutstandingTable
+from test import create_transports
+from messenger import SEND_WINDOW, Message, MessageQueue, Messenger, Transport, UnreliableTransport
+from node import Entry, Node
+from scheduler import FREE_THREADED, PRIORITY_DELIVER, EventSimulation, node_random
+
+# ============================================================
+# BENCHMARK CONFIGURATION
+# ============================================================
+BACKLOG_SIZES = [10, 100, 1000, 10000, 100000]
+NUM_TICKS = 100
+BROADCAST_NODES = 100
+BROADCAST_ROUNDS = 200
+LOAD_NODES = 8
+LOAD_BOARD_SIZE = 20000  # entries on the node which is read in full by the heavy client
+LOAD_CLIENTS = [1, 4, 16]  # concurrent clients polling the status of the other nodes
+LOAD_DURATION = 2.0  # seconds per measurement
+OUTSTANDING_BACKLOGS = [0, 100, 1000, 10000]  # unacknowledged propagations in flight
+OUTSTANDING_PEERS = 4
+OUTSTANDING_ROUNDS = 200
+CONVERGENCE_SCENARIOS = ['easy', 'medium', 'hard', 'stall']  # stall: hard, and one node is cut off for a while
+STALL_DURATION = 10.0  # simulated seconds in which all links of the last node drop every message
+CONVERGENCE_SEEDS = 10  # runs per scenario
+CONVERGENCE_NODES = 4
+CONVERGENCE_ENTRIES = 10  # entries created by every node
+CONVERGENCE_LIMIT = 120.0  # simulated seconds
+ACK_SCENARIOS = ['medium', 'hard']
+ACK_SEEDS = 10  # runs per scenario
+ACK_NODES = 4
+ACK_ENTRIES = 100  # entries created by every node
+BATCH_SIZES = [1, 10, 100]  # messages sent to each peer per tick
+BATCH_PEERS = 4
+BATCH_TICKS = 200
+CODEC_ROUNDS = 2000
+LOG_MESSAGES = 20000  # delivered messages, each logs one event
+STRESS_ENTRIES = 100000  # entries created in one burst
+STRESS_DURATION = 10.0  # simulated seconds
+CORE_POLLERS = [1, 10, 100]  # concurrent clients polling /status
+CORE_CLIENT_PROCESSES = 4  # the pollers are spread over this many processes
+CORE_PORT = 18400
+DEPLOY_NODES = 4
+DEPLOY_ENTRIES = 100  # entries created through the REST API of every node
+DEPLOY_PORT = 18300  # HTTP port of node 0, the peers use DEPLOY_PORT + 100 + i
+DEPLOY_TIMEOUT = 60.0  # seconds until the nodes have to agree
+PARALLEL_NODES = 200
+PARALLEL_DURATION = 1.0  # simulated seconds
+PARALLEL_WORKERS = [1, 2, 4, 8]
+
+# ============================================================
+
+
+@contextlib.contextmanager
+def quiet():
+    """Discard what the simulation and the servers still print (echoed warnings, startup output)"""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+class ListBufferTransport(UnreliableTransport):
+    """The previous UnreliableTransport.deliver, which rebuilds the buffer list on every tick (for comparison)"""
+
+    def deliver(self, t: float):
+        while not self.in_queue.empty():
+            msg = self.in_queue.get()
+            if self.r.random() < self.drop_rate:
+                continue
+            self.buffered_messages.append((t + self.r.uniform(self.min_delay, self.max_delay), msg))
+        remaining_messages = []
+        for delivery_time, msg in self.buffered_messages:
+            if t >= delivery_time:
+                self.out_queue.put(msg)
+            else:
+                remaining_messages.append((delivery_time, msg))
+        self.buffered_messages = remaining_messages
+
+
+class JsonMessage:
+    """The previous Message, which stores a JSON string and parses it on every get_content() (for comparison)"""
+
+    def __init__(self, content):
+        self.content = json.dumps(content)
+        self.len = len(self.content)
+
+    def __str__(self):
+        return f'{self.content}'
+
+    def get_content(self):
+        return json.loads(self.content)
+
+
+class ListOutstanding:
+    """The previous not_acked lists, which are scanned on every ack and every next_timeout (for comparison)"""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.pending = {}  # peer -> list of (key, message, send_time)
+
+    def add(self, peer, key, message, t):
+        self.pending.setdefault(peer, []).append((key, message, t))
+
+    def ack(self, peer, key):
+        acked = False
+        msgs = self.pending.get(peer, [])
+        for i in range(len(msgs)):
+            if msgs[i - 1][0] == key:
+                del msgs[i - 1]
+                acked = True
+        return acked
+
+    def next_timeout(self):
+        send_times = [msg[2] for msgs in self.pending.values() for msg in msgs]
+        return min(send_times) + self.timeout if send_times else None
+
+    def expired(self, t):
+        # the previous per-tick loop of Node.update over every pending message
+        retransmit = {}
+        for peer, msgs in self.pending.items():
+            for msg in msgs:
+                if t - msg[2] > self.timeout:
+                    msgs.remove(msg)
+                    msgs.append((msg[0], msg[1], t))
+                    retransmit.setdefault(peer, []).append(msg[1])
+        return retransmit
+
+
+def bench_transport_backlog(transport_class, backlog):
+    """
+    Fill the transport with `backlog` messages that are not due yet,
+    then measure the cost of a tick which delivers a single due message.
+    """
+    r = random.Random(42)
+    in_queue, out_queue = MessageQueue(), MessageQueue()
+    transport = transport_class(in_queue, out_queue, r)
+    msg = Message({'type': 'propagate', 'id': 1, 'entry_value': 'x', 'from': 0})
+
+    # in-flight messages that stay buffered during the measurement
+    transport.set_delay(1000.0, 2000.0)
+    for _ in range(backlog):
+        in_queue.put(msg)
+    transport.deliver(0.0)
+
+    # per tick: one new message which is due immediately
+    transport.set_delay(0.0, 0.0)
+    with quiet():
+        start = time.perf_counter()
+        for tick in range(1, NUM_TICKS + 1):
+            in_queue.put(msg)
+            transport.deliver(tick * 0.01)
+        elapsed = time.perf_counter() - start
+    assert out_queue.qsize() == NUM_TICKS
+    return elapsed / NUM_TICKS
+
+
+def benchmark_transport_backlog():
+    print("=" * 60)
+    print("UnreliableTransport.deliver: cost per tick vs. in-flight backlog")
+    print("=" * 60)
+    print(f"{'backlog':>10} {'heap (us/tick)':>16} {'list (us/tick)':>16}")
+    for backlog in BACKLOG_SIZES:
+        heap_cost = bench_transport_backlog(UnreliableTransport, backlog)
+        list_cost = bench_transport_backlog(ListBufferTransport, backlog)
+        print(f"{backlog:>10} {heap_cost * 1e6:>16.1f} {list_cost * 1e6:>16.1f}")
+
+
+def bench_broadcast(fan_out):
+    """
+    One node broadcasts a propagate message to BROADCAST_NODES peers, every peer reads the content
+    and the bytes that would cross a process boundary are counted.
+    """
+    sender = Messenger(0, BROADCAST_NODES)
+    start = time.perf_counter()
+    for seq in range(BROADCAST_ROUNDS):
+        content = {'type': 'propagate', 'id': seq, 'entry_value': f'Server0_Entry{seq}', 'from': 0}
+        fan_out(sender, content)
+        for queue in sender.out_queues.values():
+            assert queue.get().get_content()['id'] == seq
+    return (time.perf_counter() - start) / BROADCAST_ROUNDS
+
+
+def fan_out_json(sender, content):
+    # previous pattern: one message (and one json.dumps) per destination, plus one json.loads per receiver
+    for node_id in range(BROADCAST_NODES):
+        msg = JsonMessage(content)
+        msg.len
+        sender.send(node_id, msg)
+
+
+def fan_out_shared(sender, content):
+    # one immutable message, encoded once and shared by all destinations
+    msg = Message(content)
+    for node_id in range(BROADCAST_NODES):
+        msg.encode()
+        sender.send(node_id, msg)
+
+
+def fan_out_broadcast(sender, content):
+    # one immutable message, enqueued for all destinations in a single call
+    msg = Message(content)
+    msg.encode()
+    sender.broadcast(msg, range(BROADCAST_NODES))
+
+
+def codec_samples():
+    propagate = {'type': 'propagate', 'id': 1234, 'entry_value': 'Server0_Entry1234', 'from': 0}
+    clock = [3, 5, 0, 12, 7, 1, 0, 0, 2, 9]
+    return {
+        'propagate': propagate,
+        'ack with SACK': {'type': 'ack', 'cumulative': 1200, 'sack': [[1203, 1210], [1215, 1220]], 'from': 3},
+        'add_entry (Lab 2)': {'type': 'add_entry', 'entry_id': '1792352695.6063347 - 2', 'entry_value': 'hello',
+                              'from': 2, 'timestamp': 1792352695.6063347},
+        'vector clocks (Lab 3)': {'type': 'propagate', 'vc': clock, 'from': 4,
+                                  'entry': {'id': 'x1', 'value': 'v', 'create_ts': clock + [4], 'modify_ts': None, 'delete_ts': None}},
+        'batch of 50': {'type': 'batch', 'messages': [propagate] * 50},
+    }
+
+
+def bench_codec(content, encode, decode):
+    """Returns (bytes, encode time, decode time) of one message, including building the Message"""
+    data = encode(content)
+    start = time.perf_counter()
+    for _ in range(CODEC_ROUNDS):
+        encode(content)
+    encode_time = (time.perf_counter() - start) / CODEC_ROUNDS
+    start = time.perf_counter()
+    for _ in range(CODEC_ROUNDS):
+        decode(data)
+    return len(data), encode_time, (time.perf_counter() - start) / CODEC_ROUNDS
+
+
+def benchmark_codec():
+    print("=" * 60)
+    print("Message encoding at process boundaries: JSON vs. binary codec")
+    print("=" * 60)
+    json_codec = (lambda content: json.dumps(Message(content).content, default=dict).encode('utf-8'),
+                  lambda data: Message(json.loads(data)))
+    binary_codec = (lambda content: Message(content).encode(), Message.decode)
+    print(f"{'message':>22} {'bytes':>12} {'encode (us)':>14} {'decode (us)':>14}")
+    for name, content in codec_samples().items():
+        json_size, json_encode, json_decode = bench_codec(content, *json_codec)
+        size, encode, decode = bench_codec(content, *binary_codec)
+        print(f"{name:>22} {json_size:>5} -> {size:<4} {json_encode * 1e6:>6.1f} -> {encode * 1e6:<5.1f} "
+              f"{json_decode * 1e6:>6.1f} -> {decode * 1e6:<5.1f}")
+
+
+def benchmark_broadcast():
+    print("=" * 60)
+    print(f"Message: broadcast to {BROADCAST_NODES} nodes")
+    print("=" * 60)
+    json_cost = bench_broadcast(fan_out_json)
+    shared_cost = bench_broadcast(fan_out_shared)
+    broadcast_cost = bench_broadcast(fan_out_broadcast)
+    print(f"{'JSON message per destination':>32}: {json_cost * 1e6:10.1f} us/broadcast")
+    print(f"{'shared immutable message':>32}: {shared_cost * 1e6:10.1f} us/broadcast ({json_cost / shared_cost:.1f}x)")
+    print(f"{'Messenger.broadcast':>32}: {broadcast_cost * 1e6:10.1f} us/broadcast ({json_cost / broadcast_cost:.1f}x)")
+
+
+def bench_outstanding(table_class, backlog):
+    """
+    Coordinator pattern: `backlog` propagations stay unacknowledged (e.g., a slow peer), then measure
+    one round of propagate to OUTSTANDING_PEERS peers, all acks and the next_timeout() of the simulation.
+    """
+    table = table_class(2.0)
+    msg = Message({'type': 'propagate', 'id': 0, 'entry_value': 'x', 'from': 0})
+    for seq in range(backlog):
+        for peer in range(OUTSTANDING_PEERS):
+            table.add(peer, -seq - 1, msg, 0.0)
+
+    start = time.perf_counter()
+    for seq in range(OUTSTANDING_ROUNDS):
+        for peer in range(OUTSTANDING_PEERS):
+            table.add(peer, seq, msg, 1.0)
+        for peer in range(OUTSTANDING_PEERS):
+            assert table.ack(peer, seq)
+        table.next_timeout()
+    return (time.perf_counter() - start) / OUTSTANDING_ROUNDS
+
+
+def benchmark_outstanding():
+    print("=" * 60)
+    print(f"not_acked: cost per propagation ({OUTSTANDING_PEERS} peers) vs. unacknowledged backlog")
+    print("=" * 60)
+    print(f"{'backlog':>10} {'table (us)':>14} {'lists (us)':>14}")
+    for backlog in OUTSTANDING_BACKLOGS:
+        table_cost = bench_outstanding(OutstandingTable, backlog)
+        list_cost = bench_outstanding(ListOutstanding, backlog)
+        print(f"{backlog:>10} {table_cost * 1e6:>14.1f} {list_cost * 1e6:>14.1f}")
+
+
+def bench_retransmit_tick(table_class, backlog):
+    """
+    `backlog` messages are outstanding but not due, per tick one message expires:
+    measure the retransmission part of Node.update.
+    """
+    # without jitter exactly one message is due per tick, like with the fixed timeout of the lists
+    table = OutstandingTable(2.0, jitter=0.0) if table_class is OutstandingTable else table_class(2.0)
+    msg = Message({'type': 'propagate', 'id': 0, 'entry_value': 'x', 'from': 0})
+    for seq in range(backlog):
+        table.add(seq % OUTSTANDING_PEERS, -seq - 1, msg, 1000.0)
+
+    start = time.perf_counter()
+    for tick in range(NUM_TICKS):
+        t = tick * 0.01
+        table.add(tick % OUTSTANDING_PEERS, tick, msg, t - 2.005)
+        assert len(table.expired(t)) == 1
+    return (time.perf_counter() - start) / NUM_TICKS
+
+
+def benchmark_retransmit_tick():
+    print("=" * 60)
+    print("Node.update retransmissions: cost per tick vs. outstanding messages")
+    print("=" * 60)
+    print(f"{'outstanding':>12} {'timers (us/tick)':>18} {'scan (us/tick)':>16}")
+    for backlog in OUTSTANDING_BACKLOGS:
+        table_cost = bench_retransmit_tick(OutstandingTable, backlog)
+        list_cost = bench_retransmit_tick(ListOutstanding, backlog)
+        print(f"{backlog:>12} {table_cost * 1e6:>18.1f} {list_cost * 1e6:>16.1f}")
+
+
+def bench_convergence(scenario, seed, fixed_timeout):
+    """
+    Every node creates CONVERGENCE_ENTRIES entries, then the simulation runs until no events are left.
+    Returns the simulated time at which all boards were equal (None if they never were) and the number of messages sent.
+    """
+    nodes = [Node(Messenger(i, CONVERGENCE_NODES), i, CONVERGENCE_NODES, node_random(seed, i)) for i in range(CONVERGENCE_NODES)]
+    if fixed_timeout:
+        # the previous behaviour: retransmit every 2 seconds, no RTT estimation, backoff, jitter or cap
+        # (plus the time the peers hold back their acks, like the adaptive timeout)
+        for node in nodes:
+            node.not_acked = OutstandingTable(2.0, node.r, min_rto=2.0, max_rto=2.0, jitter=0.0, max_in_flight=None, ack_delay=node.ack_delay)
+            node.not_added = OutstandingTable(2.0, node.r, min_rto=2.0, max_rto=2.0, jitter=0.0, max_in_flight=None)
+    r = random.Random(seed)
+    transports = create_transports(nodes, 'hard' if scenario == 'stall' else scenario, r)
+    simulation = EventSimulation(nodes, transports, r=r)
+    if scenario == 'stall':
+        cut = [transport for (from_id, to_id), transport in transports.items()
+               if from_id != to_id and CONVERGENCE_NODES - 1 in (from_id, to_id)]
+        for transport in cut:
+            transport.set_drop_rate(1.0)
+
+        def heal(t):
+            for transport in cut:
+                transport.set_drop_rate(0.1)
+        simulation.scheduler.schedule(STALL_DURATION, PRIORITY_DELIVER, heal)
+    num_entries = CONVERGENCE_ENTRIES * CONVERGENCE_NODES
+    converged_at = []
+
+    def check(simulation):
+        boards = [node.board for node in nodes]
+        if not converged_at and len(boards[0]) == num_entries and all(board.get_digest() == boards[0].get_digest() for board in boards):
+            converged_at.append(simulation.now)
+        return False  # keep going until all acks arrived
+
+    with quiet():
+        for i in range(CONVERGENCE_ENTRIES):
+            for node in nodes:
+                node.create_entry(f"Server{node.own_id}_Entry{i}")
+        simulation.wake_all()
+        simulation.run(CONVERGENCE_LIMIT, check)
+    return (converged_at[0] if converged_at else None), sum(node.messenger.num_sent for node in nodes)
+
+
+def benchmark_convergence():
+    print("=" * 60)
+    print(f"Retransmission: fixed 2s timeout vs. adaptive RTO, {CONVERGENCE_NODES} nodes, mean of {CONVERGENCE_SEEDS} seeds")
+    print("=" * 60)
+    print(f"{'scenario':>9} {'timeout':>9} {'converged (s)':>14} {'worst (s)':>10} {'messages':>9}")
+    for scenario in CONVERGENCE_SCENARIOS:
+        for fixed_timeout in (True, False):
+            runs = [bench_convergence(scenario, seed, fixed_timeout) for seed in range(CONVERGENCE_SEEDS)]
+            times = [t for t, _ in runs if t is not None]
+            messages = statistics.mean(sent for _, sent in runs)
+            label = 'fixed' if fixed_timeout else 'adaptive'
+            if len(times) < len(runs):
+                print(f"{scenario:>9} {label:>9} {'-':>14} {'-':>10} {messages:>9.0f}  ({len(runs) - len(times)} runs did not converge)")
+            else:
+                print(f"{scenario:>9} {label:>9} {statistics.mean(times):>14.2f} {max(times):>10.2f} {messages:>9.0f}")
+
+
+class CountingMessenger(Messenger):
+    """Messenger that counts the messages per type which enter the links, after batching and flow control"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent_types = collections.Counter()
+
+    def put(self, destination, msgs):
+        for msg in msgs:
+            self.sent_types[msg.get_content()['type']] += 1
+        super().put(destination, msgs)
+
+
+def bench_acks(scenario, seed, ack_delay):
+    """
+    Every node creates ACK_ENTRIES entries, then the simulation runs until no events are left.
+    Returns the simulated time at which all boards were equal (None if they never were) and the sent messages per type.
+    """
+    nodes = [Node(CountingMessenger(i, ACK_NODES), i, ACK_NODES, node_random(seed, i)) for i in range(ACK_NODES)]
+    for node in nodes:
+        node.ack_delay = node.not_acked.ack_delay = ack_delay
+    r = random.Random(seed)
+    simulation = EventSimulation(nodes, create_transports(nodes, scenario, r), r=r)
+    num_entries = ACK_ENTRIES * ACK_NODES
+    converged_at = []
+
+    def check(simulation):
+        boards = [node.board for node in nodes]
+        if not converged_at and len(boards[0]) == num_entries and all(board.get_digest() == boards[0].get_digest() for board in boards):
+            converged_at.append(simulation.now)
+        return False
+
+    with quiet():
+        for i in range(ACK_ENTRIES):
+            for node in nodes:
+                node.create_entry(f"Server{node.own_id}_Entry{i}")
+        simulation.wake_all()
+        simulation.run(CONVERGENCE_LIMIT, check)
+    sent = collections.Counter()
+    for node in nodes:
+        sent.update(node.messenger.sent_types)
+    return (converged_at[0] if converged_at else None), sent
+
+
+def benchmark_acks():
+    print("=" * 60)
+    print(f"Propagation acks: one per tick vs. delayed by {lab_node.ACK_DELAY}s, {ACK_NODES} nodes, mean of {ACK_SEEDS} seeds")
+    print("=" * 60)
+    print(f"{'scenario':>9} {'ack delay':>10} {'propagates':>11} {'acks':>6} {'propagates/ack':>15} {'converged (s)':>14}")
+    for scenario in ACK_SCENARIOS:
+        for ack_delay in (0.0, lab_node.ACK_DELAY):
+            runs = [bench_acks(scenario, seed, ack_delay) for seed in range(ACK_SEEDS)]
+            propagates = statistics.mean(sent['propagate'] for _, sent in runs)
+            acks = statistics.mean(sent['ack'] for _, sent in runs)
+            converged = statistics.mean(t for t, _ in runs if t is not None)
+            print(f"{scenario:>9} {ack_delay:>10.2f} {propagates:>11.0f} {acks:>6.0f} {propagates / acks:>15.1f} {converged:>14.2f}")
+
+
+def make_entry(i):
+    return Entry(i, f'Server0_Entry{i}')
+
+
+def http_client(port, paths, duration):
+    """Runs in its own process: request the paths round-robin over one keep-alive connection, returns the latencies"""
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    latencies = []
+    deadline = time.perf_counter() + duration
+    i = 0
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        connection.request('GET', paths[i % len(paths)])
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 200, response.status
+        latencies.append(time.perf_counter() - start)
+        i += 1
+    connection.close()
+    return latencies
+
+
+def http_request(port, method, path, body=None, retry_for=0.0):
+    """One request on a new connection, retried while the server is still starting"""
+    deadline = time.monotonic() + retry_for
+    while True:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body is not None else {}
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def create_entries(port, node_id, count):
+    """Runs in its own process: create count entries on one node over one keep-alive connection, returns the latencies"""
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    latencies = []
+    for i in range(count):
+        body = urllib.parse.urlencode({'value': f'Server{node_id}_Entry{i}'})
+        start = time.perf_counter()
+        connection.request('POST', f'/nodes/{node_id}/entries', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 200, response.status
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+    return latencies
+
+
+async def poll(port, paths, duration, latencies):
+    """Poll the paths round-robin, one connection per request like a page without keep-alive"""
+    deadline = time.perf_counter() + duration
+    i = 0
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f"GET {paths[i % len(paths)]} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n".encode())
+        response = await reader.read()
+        writer.close()
+        assert response.startswith(b'HTTP/1.1 200') or response.startswith(b'HTTP/1.0 200'), response[:40]
+        latencies.append(time.perf_counter() - start)
+        i += 1
+
+
+def pollers(port, paths, count, duration):
+    """Runs in its own process: count concurrent pollers, returns their latencies"""
+    async def run():
+        latencies = []
+        await asyncio.gather(*(poll(port, paths[i % len(paths):] + paths[:i % len(paths)], duration, latencies) for i in range(count)))
+        return latencies
+    return asyncio.run(run())
+
+
+def bench_server_core(core, num_pollers):
+    """
+    Poll the status of all nodes of a server process with num_pollers concurrent clients.
+    Returns the median and 99th percentile latency and the throughput.
+    """
+    env = dict(os.environ, NUM_NODES=str(LOAD_NODES), GROUP_NAME='benchmark', EVENT_LOG_LEVEL='warning',
+               PORT=str(CORE_PORT), SERVER_CORE=core)
+    process = subprocess.Popen([sys.executable, 'server.py'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    try:
+        http_request(CORE_PORT, 'GET', '/nodes/0/status', retry_for=30.0)
+        paths = [f'/nodes/{node_id}/status' for node_id in range(LOAD_NODES)]
+        processes = min(num_pollers, CORE_CLIENT_PROCESSES)
+        counts = [num_pollers // processes + (i < num_pollers % processes) for i in range(processes)]
+        with multiprocessing.get_context('spawn').Pool(processes) as pool:
+            clients = [pool.apply_async(pollers, (CORE_PORT, paths, count, LOAD_DURATION)) for count in counts]
+            samples = sorted(latency for client in clients for latency in client.get())
+    finally:
+        launcher.stop([process])
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return statistics.median(samples), p99, len(samples) / LOAD_DURATION
+
+
+def benchmark_server_core():
+    print("=" * 60)
+    print(f"HTTP server core: concurrent pollers of /status, {LOAD_NODES} nodes, {LOAD_DURATION}s per run")
+    print("=" * 60)
+    print(f"{'core':>8} {'pollers':>8} {'p50 (ms)':>10} {'p99 (ms)':>10} {'req/s':>8}")
+    for core in ('paste', 'asyncio'):
+        for num_pollers in CORE_POLLERS:
+            median, p99, throughput = bench_server_core(core, num_pollers)
+            print(f"{core:>8} {num_pollers:>8} {median * 1e3:>10.2f} {p99 * 1e3:>10.2f} {throughput:>8.0f}")
+
+
+def bench_deployment(multi_process):
+    """
+    Start DEPLOY_NODES nodes, either all in one server process or one process per node (launcher.py), let one client
+    per node create DEPLOY_ENTRIES entries and wait until all nodes report the same board.
+    Returns the create throughput, the median create latency and the time from the last write until all nodes agree
+    (None if they did not agree within DEPLOY_TIMEOUT).
+    """
+    env = dict(os.environ, NUM_NODES=str(DEPLOY_NODES), GROUP_NAME='benchmark', EVENT_LOG_LEVEL='warning')
+    if multi_process:
+        processes = launcher.launch(DEPLOY_NODES, DEPLOY_PORT, DEPLOY_PORT + 100, env=env, stdout=subprocess.DEVNULL)
+        ports = [DEPLOY_PORT + node_id for node_id in range(DEPLOY_NODES)]
+    else:
+        env.update(PORT=str(DEPLOY_PORT), EXTERNAL_PORT=str(DEPLOY_PORT))
+        processes = [subprocess.Popen([sys.executable, 'server.py'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)]
+        ports = [DEPLOY_PORT] * DEPLOY_NODES
+    try:
+        for node_id, port in enumerate(ports):
+            http_request(port, 'GET', f'/nodes/{node_id}/status', retry_for=30.0)
+
+        start = time.perf_counter()
+        with multiprocessing.get_context('spawn').Pool(DEPLOY_NODES) as pool:
+            clients = [pool.apply_async(create_entries, (port, node_id, DEPLOY_ENTRIES)) for node_id, port in enumerate(ports)]
+            latencies = sorted(latency for client in clients for latency in client.get())
+        written = time.perf_counter()
+
+        converged = None
+        while converged is None and time.perf_counter() - written < DEPLOY_TIMEOUT:
+            statuses = [json.loads(http_request(port, 'GET', f'/nodes/{node_id}/status')[1]) for node_id, port in enumerate(ports)]
+            if all(status['len'] == DEPLOY_NODES * DEPLOY_ENTRIES and status['hash'] == statuses[0]['hash'] for status in statuses):
+                converged = time.perf_counter() - written
+            else:
+                time.sleep(0.05)
+    finally:
+        launcher.stop(processes)
+    return len(latencies) / (written - start), statistics.median(latencies), converged
+
+
+def benchmark_deployment():
+    print("=" * 60)
+    print(f"Deployment: {DEPLOY_NODES} nodes, {DEPLOY_ENTRIES} entries created on every node over HTTP")
+    print("(the single-process server uses the transports configured in server.py, e.g., simulated delays)")
+    print("=" * 60)
+    print(f"{'mode':>16} {'creates/s':>10} {'median (ms)':>12} {'agree after (s)':>16}")
+    for name, multi_process in (('single process', False), ('one per node', True)):
+        throughput, median, converged = bench_deployment(multi_process)
+        agreed = f"{converged:.2f}" if converged is not None else f"> {DEPLOY_TIMEOUT:.0f}"
+        print(f"{name:>16} {throughput:>10.0f} {median * 1e3:>12.2f} {agreed:>16}")
+
+
+def bench_rest_latency(num_clients, shared_lock):
+    """
+    One client repeatedly reads the full board of node 0 while `num_clients` clients poll /status of the other nodes.
+    Clients are separate processes talking HTTP to the paste server, like browsers would.
+    Returns the median and 99th percentile latency of the status requests and their throughput.
+    """
+    labs_server.NUM_NODES = LOAD_NODES
+    with quiet():
+        app = labs_server.Server()
+    if shared_lock:
+        # the previous behaviour: a single lock for all nodes
+        app.node_locks[:] = [threading.RLock()] * LOAD_NODES
+    for i in range(LOAD_BOARD_SIZE):
+        app.nodes[0].board.add_entry(make_entry(i))
+
+    with quiet():
+        http_server = httpserver.serve(app, host='127.0.0.1', port=0, start_loop=False, threadpool_workers=num_clients + 1,
+                                       threadpool_options={"spawn_if_under": num_clients + 1}, request_queue_size=64)
+    port = http_server.server_address[1]
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+
+    heavy_paths = ['/nodes/0/entries']
+    status_paths = [f'/nodes/{node_id}/status' for node_id in range(1, LOAD_NODES)]
+    with multiprocessing.get_context('spawn').Pool(num_clients + 1) as pool:
+        heavy = pool.apply_async(http_client, (port, heavy_paths, LOAD_DURATION))
+        clients = [pool.apply_async(http_client, (port, status_paths[i:] + status_paths[:i], LOAD_DURATION)) for i in range(num_clients)]
+        samples = sorted(latency for client in clients for latency in client.get())
+        heavy.get()
+    with quiet():
+        http_server.server_close()
+
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return statistics.median(samples), p99, len(samples) / LOAD_DURATION
+
+
+def benchmark_rest_latency():
+    print("=" * 60)
+    print(f"REST: /status latency while node 0 ({LOAD_BOARD_SIZE} entries) is read in full")
+    print("=" * 60)
+    print(f"{'clients':>8} {'lock':>9} {'p50 (ms)':>10} {'p99 (ms)':>10} {'req/s':>10}")
+    for num_clients in LOAD_CLIENTS:
+        for shared_lock in (True, False):
+            p50, p99, throughput = bench_rest_latency(num_clients, shared_lock)
+            label = 'shared' if shared_lock else 'per-node'
+            print(f"{num_clients:>8} {label:>9} {p50 * 1e3:>10.2f} {p99 * 1e3:>10.2f} {throughput:>10.0f}")
+
+
+class PrintTransport(UnreliableTransport):
+    """Formats and prints every delivery like the transports did before the event log (for comparison)"""
+
+    def deliver(self, t: float):
+        msgs = self.in_queue.drain()
+        for msg in msgs:
+            print(f"Delivering message at time {t}: {msg}")
+        self.out_queue.put_many(msgs)
+
+
+def bench_event_log(transport_class, level, file_sink=False):
+    """Deliver LOG_MESSAGES propagate messages one per tick, returns the time per message"""
+    log = event_log.log
+    previous_level = log.level
+    log.set_level(level)
+    with tempfile.TemporaryDirectory() as directory:
+        if file_sink:
+            log.open_file(os.path.join(directory, 'events.jsonl'))
+        in_queue, out_queue = MessageQueue(), MessageQueue()
+        transport = transport_class(in_queue, out_queue, random.Random(42))
+        start = time.perf_counter()
+        with quiet():
+            for seq in range(LOG_MESSAGES):
+                in_queue.put(Message({'type': 'propagate', 'id': seq, 'entry_value': f'Server0_Entry{seq}', 'from': 0}))
+                transport.deliver(seq)
+                out_queue.get_nowait()
+        elapsed = time.perf_counter() - start
+        log.close()
+    log.set_level(previous_level)
+    return elapsed / LOG_MESSAGES
+
+
+def benchmark_event_log():
+    print("=" * 60)
+    print(f"Event log: cost of tracing {LOG_MESSAGES} deliveries")
+    print("=" * 60)
+    print(f"{'print() to /dev/null':>32}: {bench_event_log(PrintTransport, 'debug') * 1e6:>8.2f} us/msg")
+    print(f"{'disabled (level info)':>32}: {bench_event_log(UnreliableTransport, 'info') * 1e6:>8.2f} us/msg")
+    print(f"{'ring buffer (level debug)':>32}: {bench_event_log(UnreliableTransport, 'debug') * 1e6:>8.2f} us/msg")
+    print(f"{'ring buffer + file sink':>32}: {bench_event_log(UnreliableTransport, 'debug', True) * 1e6:>8.2f} us/msg")
+
+
+def bench_batching(batch_size, batched):
+    """
+    Node 0 sends batch_size acks to every peer per tick over lossy links, the peers receive them.
+    Returns the time per message and the messages that went through a queue and a drop decision per tick.
+    """
+    r = random.Random(42)
+    sender = Messenger(0, BATCH_PEERS + 1, window=None)
+    receivers = [Messenger(i, BATCH_PEERS + 1, window=None) for i in range(1, BATCH_PEERS + 1)]
+    transports = []
+    for receiver in receivers:
+        transport = UnreliableTransport(sender.out_queues[receiver.own_id], receiver.in_queue, r)
+        transport.set_drop_rate(0.1)
+        transports.append(transport)
+    queued = 0
+    start = time.perf_counter()
+    with quiet():
+        for tick in range(BATCH_TICKS):
+            if batched:
+                sender.hold()
+            for receiver in receivers:
+                for seq in range(batch_size):
+                    sender.send(receiver.own_id, Message({'type': 'ack', 'id': seq, 'from': 0}))
+            sender.flush()
+            queued += sum(queue.qsize() for queue in sender.out_queues.values())
+            for transport in transports:
+                transport.deliver(tick)
+            for receiver in receivers:
+                receiver.receive()
+    elapsed = time.perf_counter() - start
+    return elapsed / (BATCH_TICKS * BATCH_PEERS * batch_size), queued / BATCH_TICKS
+
+
+def benchmark_batching():
+    print("=" * 60)
+    print(f"Batch envelopes: {BATCH_PEERS} peers, lossy links")
+    print("=" * 60)
+    print(f"{'per tick':>10} {'single (us/msg)':>16} {'batched (us/msg)':>17} {'queued single':>14} {'queued batched':>15}")
+    for batch_size in BATCH_SIZES:
+        single, single_queued = bench_batching(batch_size, False)
+        batched, batched_queued = bench_batching(batch_size, True)
+        print(f"{batch_size:>10} {single * 1e6:>16.2f} {batched * 1e6:>17.2f} {single_queued:>14.0f} {batched_queued:>15.0f}")
+
+
+class StressProducer:
+    """
+    Sends one propagate message per created entry to node 1 and retransmits it every 2 seconds until it is acked.
+    The messages are built lazily, only while the link has credit (all at once without a send window).
+    """
+
+    def __init__(self, m: Messenger, r: random.Random):
+        self.own_id = 0
+        self.messenger = m
+        self.not_acked = OutstandingTable(2.0, r, min_rto=2.0, max_rto=2.0, jitter=0.0, max_in_flight=None)
+        self.to_create = iter(())  # sequence numbers of the entries that were not sent yet
+
+    def create_entries(self, n, t):
+        self.to_create = iter(range(n))
+        self.produce(t)
+
+    def produce(self, t):
+        while self.messenger.writable(1):
+            seq = next(self.to_create, None)
+            if seq is None:
+                return
+            msg = Message({'type': 'propagate', 'id': seq, 'entry_value': f'Server0_Entry{seq}', 'from': 0})
+            self.messenger.send(1, msg)
+            self.not_acked.add(1, seq, msg, t)
+
+    def is_crashed(self):
+        return False
+
+    def update(self, t):
+        for msg in self.messenger.receive():
+            self.not_acked.ack(1, msg.get_content()['id'])
+        for peer, msgs in self.not_acked.expired(t).items():
+            self.messenger.send_many(peer, msgs)
+        self.produce(t)  # the acks and drops returned credit
+
+    def next_timeout(self):
+        return self.not_acked.next_timeout()
+
+
+class StressConsumer:
+    """Acks every received message"""
+
+    def __init__(self, m: Messenger):
+        self.own_id = 1
+        self.messenger = m
+
+    def is_crashed(self):
+        return False
+
+    def update(self, t):
+        acks = [Message({'type': 'ack', 'id': msg.get_content()['id'], 'from': 1}) for msg in self.messenger.receive()]
+        self.messenger.send_many(0, acks)
+
+    def next_timeout(self):
+        return None
+
+
+def bench_flow_control(window):
+    """
+    Create STRESS_ENTRIES entries at once on a lossy link (0.5-1.5s delay, 10% drops) and simulate STRESS_DURATION seconds.
+    Returns the peak traced memory, the largest transport buffer, the number of messages sent and the wall-clock time.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    r = random.Random(42)
+    producer = StressProducer(Messenger(0, 2, window=window), node_random(42, 0))
+    consumer = StressConsumer(Messenger(1, 2, window=window))
+    nodes = [producer, consumer]
+    transports = {}
+    for from_id, to_id in ((0, 1), (1, 0)):
+        transport = UnreliableTransport(nodes[from_id].messenger.out_queues[to_id], nodes[to_id].messenger.in_queue, r)
+        transport.set_delay(0.5, 1.5)
+        transport.set_drop_rate(0.1)
+        transports[(from_id, to_id)] = transport
+    simulation = EventSimulation(nodes, transports, r=r)
+
+    max_buffered = 0
+    def track(simulation):
+        nonlocal max_buffered
+        max_buffered = max(max_buffered, len(transports[(0, 1)].buffered_messages))
+        return False
+
+    with quiet():
+        producer.create_entries(STRESS_ENTRIES, 0.0)
+        simulation.wake_all()
+        simulation.run(STRESS_DURATION, track)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, max_buffered, producer.messenger.num_sent, time.perf_counter() - start
+
+
+def benchmark_flow_control():
+    print("=" * 60)
+    print(f"Messenger send window: {STRESS_ENTRIES} entries in one burst, {STRESS_DURATION}s simulated")
+    print("=" * 60)
+    print(f"{'window':>10} {'peak (MB)':>10} {'max buffered':>13} {'sent':>9} {'wall (s)':>9}")
+    for window in (None, SEND_WINDOW):
+        peak, max_buffered, sent, elapsed = bench_flow_control(window)
+        print(f"{str(window):>10} {peak / 1e6:>10.1f} {max_buffered:>13} {sent:>9} {elapsed:>9.1f}")
+
+
+class GossipNode:
+    """
+    Minimal node for the parallel stepping benchmark: every update hashes the received messages
+    and forwards a message to two random peers, so each node is busy on every tick.
+    """
+
+    def __init__(self, m: Messenger, own_id: int, num_servers: int, r: random.Random):
+        self.messenger = m
+        self.own_id = own_id
+        self.num_servers = num_servers
+        self.r = r
+        self.digest = hashlib.sha256()
+
+    def is_crashed(self):
+        return False
+
+    def update(self, t):
+        for msg in self.messenger.receive():
+            for _ in range(20):
+                self.digest.update(msg.encode())
+        content = {'type': 'gossip', 'from': self.own_id, 'digest': self.digest.hexdigest()}
+        self.messenger.broadcast(Message(content), self.r.sample(range(self.num_servers), 2))
+
+    def next_timeout(self):
+        return None
+
+
+def bench_parallel_step(workers):
+    """Simulate PARALLEL_NODES gossiping nodes and return the wall-clock time and the final digests"""
+    nodes = [GossipNode(Messenger(i, PARALLEL_NODES), i, PARALLEL_NODES, node_random(42, i)) for i in range(PARALLEL_NODES)]
+    r = random.Random(42)
+    transports = {(i, j): Transport(nodes[i].messenger.out_queues[j], nodes[j].messenger.in_queue, r)
+                  for i in range(PARALLEL_NODES) for j in range(PARALLEL_NODES)}
+    simulation = EventSimulation(nodes, transports, r=r, workers=workers)
+    with quiet():
+        start = time.perf_counter()
+        simulation.wake_all()
+        simulation.run(PARALLEL_DURATION)
+        elapsed = time.perf_counter() - start
+    simulation.close()
+    return elapsed, [node.digest.hexdigest() for node in nodes]
+
+
+def benchmark_parallel_step():
+    print("=" * 60)
+    print(f"EventSimulation: {PARALLEL_NODES} nodes, {PARALLEL_DURATION}s simulated, {os.cpu_count()} CPU(s), GIL {'disabled' if FREE_THREADED else 'enabled'}")
+    print("=" * 60)
+    if not FREE_THREADED:
+        print("Skipped: the GIL serializes the node updates, so workers > 1 are ignored, run with a free-threaded Python build")
+        return
+    print(f"{'workers':>8} {'wall (s)':>10} {'speedup':>10} {'same result':>12}")
+    baseline, expected = bench_parallel_step(1)
+    for workers in PARALLEL_WORKERS:
+        elapsed, digests = bench_parallel_step(workers) if workers > 1 else (baseline, expected)
+        print(f"{workers:>8} {elapsed:>10.2f} {baseline / elapsed:>10.2f} {str(digests == expected):>12}")
+
+
+if __name__ == "__main__":
+    benchmark_transport_backlog()
+    benchmark_broadcast()
+    benchmark_codec()
+    benchmark_outstanding()
+    benchmark_retransmit_tick()
+    benchmark_convergence()
+    benchmark_acks()
+    benchmark_flow_control()
+    benchmark_batching()
+    benchmark_event_log()
+    benchmark_rest_latency()
+    benchmark_server_core()
+    benchmark_deployment()
+    benchmark_parallel_step()
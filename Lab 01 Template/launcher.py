@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Multi-process deployment: runs every node in its own OS process with its own HTTP port.
+
+    python launcher.py [num_nodes]
+
+Node i serves the REST API and the frontend on PORT + i and receives the messages of the other nodes over TCP on
+PEER_PORT + i (see socket_transport.py). The nodes run the same protocol code as in the single-process server,
+but they use separate cores and the messages pay the real network cost.
+"""
+
+import os
+import subprocess
+import sys
+import time
+from typing import List
+
+NUM_NODES = int(os.getenv('NUM_NODES')) if os.getenv('NUM_NODES') else 2
+PORT = int(os.getenv('PORT')) if os.getenv('PORT') else 8000  # HTTP port of node 0
+PEER_PORT = int(os.getenv('PEER_PORT')) if os.getenv('PEER_PORT') else 9000  # TCP port of node 0 for the other nodes
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def launch(num_nodes: int, port: int = PORT, peer_port: int = PEER_PORT, env=None, stdout=None) -> List[subprocess.Popen]:
+    """Start one server process per node, returns the processes (stop them with stop())"""
+    processes = []
+    for node_id in range(num_nodes):
+        node_env = dict(os.environ if env is None else env)
+        node_env.setdefault('GROUP_NAME', 'Unnamed Group')
+        node_env.update({
+            'NUM_NODES': str(num_nodes),
+            'NODE_ID': str(node_id),
+            'PORT': str(port + node_id),
+            'EXTERNAL_PORT': str(port + node_id),
+            'PEER_PORT': str(peer_port),
+        })
+        processes.append(subprocess.Popen([sys.executable, '-u', 'server.py'], cwd=DIRECTORY, env=node_env,
+                                          stdout=stdout, stderr=subprocess.STDOUT if stdout is not None else None))
+    return processes
+
+
+def stop(processes: List[subprocess.Popen], timeout: float = 5.0):
+    for process in processes:
+        process.terminate()
+    deadline = time.monotonic() + timeout
+    for process in processes:
+        try:
+            process.wait(max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+if __name__ == "__main__":
+    num_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_NODES
+    processes = launch(num_nodes)
+    for node_id in range(num_nodes):
+        print(f"#### Node {node_id}: http://127.0.0.1:{PORT + node_id}/server/{node_id} (pid {processes[node_id].pid})")
+    try:
+        while all(process.poll() is None for process in processes):
+            time.sleep(0.5)
+        print("#### A node process exited, stopping the others")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop(processes)
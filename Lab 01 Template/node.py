@@ -1,8 +1,18 @@
 
 # coding=utf-8
+import hashlib
+import json
 import random
 import messenger
 import time
+from retransmission import OutstandingTable
+import uuid
+from sortedcontainers import SortedDict, SortedList
+from event_log import DEBUG, log
+
+
+RETRANSMIT_TIMEOUT = 2.0  # seconds until an unacknowledged message is sent again, adapted per peer to the measured round-trip times
+ACK_DELAY = 0.1  # seconds a node waits before acknowledging propagate-messages, one ack covers all that arrive meanwhile
 
 
 class Entry:
@@ -25,13 +35,84 @@ class Entry:
 class Board():
     def __init__(self):
         self.indexed_entries = {}
+        self.ordered_ids = SortedList()  # entry ids in board order, kept up to date on every change
+        self.version = 0  # incremented on every change
+        self.digest_cache = (-1, None)  # (version, digest)
+        self.epoch = uuid.uuid4().hex  # identifies this board in version tokens
+        self.changes = SortedDict()  # version -> id of the entry changed in that version (only its last change)
+        self.change_versions = {}  # entry id -> version of its last change
+
+    def __len__(self):
+        return len(self.ordered_ids)
 
     def add_entry(self, entry):
-        self.indexed_entries[entry.id] = entry
+        if entry.id not in self.indexed_entries:
+            self.ordered_ids.add(entry.id)
+        self.indexed_entries[entry.id] = entry  # replacing an entry (modify) keeps its position
+        self.record_change(entry.id)
 
-    def get_ordered_entries(self):
-        ordered_indices = sorted(list(self.indexed_entries.keys()))
-        return [self.indexed_entries[k] for k in ordered_indices]
+    def delete_entry(self, entry_id):
+        if self.indexed_entries.pop(entry_id, None) is not None:
+            self.ordered_ids.remove(entry_id)
+            self.record_change(entry_id)
+
+    def get_ordered_entries(self, start=0, limit=None):
+        """Entries in board order, or only the page [start, start + limit) of it"""
+        stop = None if limit is None else start + limit
+        return [self.indexed_entries[k] for k in self.ordered_ids.islice(start, stop)]
+
+    def get_digest(self):
+        """sha256 of the ordered entries as reported by the status endpoints, only recomputed after a change"""
+        if self.digest_cache[0] != self.version:
+            dict_entries = [entry.to_dict() for entry in self.get_ordered_entries()]
+            digest = hashlib.sha256((json.dumps(tuple(dict_entries)).encode('utf-8'))).hexdigest()
+            self.digest_cache = (self.version, digest)
+        return self.digest_cache[1]
+
+    def record_change(self, entry_id):
+        """Bump the version and remember it as the last change of the entry (used for delta reads)"""
+        self.version += 1
+        previous_version = self.change_versions.pop(entry_id, None)
+        if previous_version is not None:
+            del self.changes[previous_version]
+        self.changes[self.version] = entry_id
+        self.change_versions[entry_id] = self.version
+
+    def get_version_token(self) -> str:
+        """Version token for delta reads, tokens of another board (e.g., before a restart) are not accepted"""
+        return f"{self.epoch}:{self.version}"
+
+    def parse_version_token(self, token):
+        """Board version of a token from get_version_token, or None if it doesn't belong to this board"""
+        epoch, _, version = str(token).partition(':')
+        if epoch != self.epoch or not version.isdigit() or int(version) > self.version:
+            return None
+        return int(version)
+
+    def get_changes(self, since: int):
+        """
+        Entries changed after version `since` with their current position in board order (sorted by position),
+        and the ids of the entries deleted after `since`.
+        """
+        changed, deleted = [], []
+        for version in self.changes.irange(minimum=since, inclusive=(False, True)):
+            entry_id = self.changes[version]
+            if entry_id in self.indexed_entries:
+                changed.append((self.ordered_ids.index(entry_id), self.indexed_entries[entry_id]))
+            else:
+                deleted.append(entry_id)
+        changed.sort(key=lambda change: change[0])
+        return changed, deleted
+
+    def get_page(self, cursor=None, limit=None):
+        """
+        Up to `limit` entries in board order that come after the entry with id `cursor`,
+        and the cursor of the next page (None for the last page).
+        """
+        start = 0 if cursor is None else self.ordered_ids.bisect_right(int(cursor))
+        entries = self.get_ordered_entries(start, limit)
+        has_more = start + len(entries) < len(self.ordered_ids)
+        return entries, (str(entries[-1].id) if has_more and entries else None)
 
 
 class Node:
@@ -51,9 +132,12 @@ class Node:
         self.r = r
         self.expected_seq = {i: 1 for i in self.all_servers} #tracks next expected message id for each node
         self.buffers = {i: {} for i in self.all_servers} #buffer for out of order messages
-        self.not_acked = {i: [] for i in self.all_servers} #tracks messages that have not been acked (for coordinator)
-        self.not_added = {i: [] for i in self.all_servers} #tracks add_entry-messages that have not been acked (for all nodes, creating an entry)
+        self.not_acked = OutstandingTable(RETRANSMIT_TIMEOUT, r, ack_delay=ACK_DELAY) #tracks messages that have not been acked, keyed by (node_id, sequence number) (for coordinator)
+        self.not_added = OutstandingTable(RETRANSMIT_TIMEOUT, r) #tracks add_entry-messages that have not been acked, keyed by (0, entry value) (for all nodes, creating an entry)
         self.addition_received = [] # track received addition to avoid duplicates (for coordinator)
+        self.ack_delay = ACK_DELAY
+        self.acks_due = {} # node id -> time at which we acknowledge the propagate-messages received from it so far
+        self.acked_upto = {i: 0 for i in self.all_servers} # highest sequence number each node acked cumulatively (for coordinator)
 
     def is_crashed(self):
         return self.status["crashed"]
@@ -67,16 +151,17 @@ class Node:
         Create a new entry by sending an 'add_entry' request to the coordinator (node 0).
         The coordinator will handle the rest.
         """
-        print(f"Node {self.own_id}: Sending 'add_entry' request to coordinator for value: {value}")
+        log.info("Sending 'add_entry' request to coordinator for value: {}", value, node=self.own_id)
 
         msg = {
             'type': 'add_entry',
             'entry_value': value,
             'from': self.own_id
         }
-        self.messenger.send(0, messenger.Message(msg))
+        message = messenger.Message(msg)
+        self.messenger.send(0, message)
          # Track unacknowledged add_entry messages 
-        self.not_added[0] += [(msg, 0.0)] 
+        self.not_added.add(0, value, message, 0.0, measure_rtt=False)  # the send time is not known here
 
     def update_entry(self, entry_id, value):
         pass  # TODO (Optional Task 4): Implement update logic similar to create_entry
@@ -84,6 +169,10 @@ class Node:
     def delete_entry(self, entry_id):
         pass  # TODO (Optional Task 4): Implement delete logic similar to create_entry
 
+    def recover(self):
+        """Called by the server when the node comes back after a crash, the retransmissions catch up on their own"""
+        pass
+
     def handle_message(self, message, t):
         """
         Handle incoming messages for the coordinator pattern.
@@ -98,17 +187,20 @@ class Node:
         msg_content = message.get_content()
 
         if 'type' not in msg_content:
-            print(f"Node {self.own_id}: Received message without type: {msg_content}")
+            log.warning("Received message without type: {}", msg_content, node=self.own_id)
             return
 
         msg_type = msg_content['type']
+        #any message shows that the sender is reachable, messages to it that backed off are resent right away
+        self.not_acked.revive(msg_content['from'], t)
+        self.not_added.revive(msg_content['from'], t)
 
         if msg_type == 'add_entry':
             # Only coordinator should receive this
             assert self.own_id == 0, "Only coordinator (node 0) should receive 'add_entry' messages"
 
             entry_value = msg_content['entry_value']
-            print(f"Coordinator: Received add_entry for '{entry_value}', broadcasting to all nodes")
+            log.debug("Coordinator: Received add_entry for '{}', broadcasting to all nodes", entry_value, node=self.own_id)
             
             add_ack_msg = {
                 'type': 'ack_add_entry',
@@ -123,35 +215,32 @@ class Node:
                 self.addition_received += [entry_value]
                 #Propagation
                 self.status['num_entries_prop'] += 1
+                msg = {
+                    'type': 'propagate',
+                    'id' : self.status['num_entries_prop'], #sequence number of message
+                    'entry_value': entry_value,
+                    'from' : self.own_id 
+                }
+                #one immutable message, enqueued for all destinations in a single call
+                message = messenger.Message(msg)
+                self.messenger.broadcast(message, self.all_servers)
                 for node_id in self.all_servers:
-                    msg = {
-                        'type': 'propagate',
-                        'id' : self.status['num_entries_prop'], #sequence number of message
-                        'entry_value': entry_value,
-                        'from' : self.own_id 
-                    }
-                    self.messenger.send(node_id, messenger.Message(msg))
-                    self.not_acked[node_id] += [(msg, t)] #track unacked messages
+                    self.not_acked.add(node_id, msg['id'], message, t) #track unacked messages
 
         elif msg_type == 'propagate':
             entry_value = msg_content['entry_value']
             entry_id = msg_content['id']
             from_id = msg_content['from']
 
-            # Send acknowledgment back to the sender
-            ack_msg = {
-                'type': 'ack',
-                'id': entry_id,
-                'from': self.own_id
-            }
-            self.messenger.send(from_id, messenger.Message(ack_msg))
+            # Acknowledge after ACK_DELAY, one ack covers all propagate-messages received from this node until then
+            self.acks_due.setdefault(from_id, t + self.ack_delay)
 
             if(entry_id == self.expected_seq[from_id]):
                 #add entry to board if it's the next expected id
                 self.status['num_entries'] += 1
                 entry = Entry(self.status['num_entries'], entry_value)
                 self.board.add_entry(entry)
-                print(f"Node {self.own_id}: Added entry ID {self.status['num_entries']} with value '{entry_value}'")
+                log.debug("Added entry ID {} with value '{}'", self.status['num_entries'], entry_value, node=self.own_id)
                 self.expected_seq[from_id] += 1
                 
                 
@@ -163,68 +252,89 @@ class Node:
                     self.board.add_entry(e)
                     self.expected_seq[from_id] += 1
             
-            else:
+            elif entry_id > self.expected_seq[from_id]:
                 #buffer out of order entry
                 self.buffers[from_id][entry_id] = entry_value
 
+            else:
+                #duplicate of a retransmission: our ack was lost or is late, acknowledge right away
+                self.acks_due[from_id] = t
+
 
         elif msg_type == 'ack':
-            acked_id = msg_content['id']
+            cumulative = msg_content['cumulative']
             from_id = msg_content['from']
-            #remove from not_acked list
-            if len(self.not_acked[from_id]) > 0:
-                for i in range(len(self.not_acked[from_id])):
-                    if self.not_acked[from_id][i-1][0]['id'] == acked_id:
-                        print(f"Node {self.own_id}: Received ack from Node {from_id} for message ID {acked_id}")
-                        del self.not_acked[from_id][i-1]
+            #remove everything up to the cumulative sequence number from not_acked
+            #only the newest message is used to measure the round-trip time, the others may have been acked by a lost ack before
+            for acked_id in range(self.acked_upto[from_id] + 1, cumulative + 1):
+                self.not_acked.ack(from_id, acked_id, t if acked_id == cumulative else None)
+            if cumulative > self.acked_upto[from_id]:
+                log.debug("Received ack from Node {} for message IDs up to {}", from_id, cumulative, node=self.own_id)
+                self.acked_upto[from_id] = cumulative
+            #and the out of order messages the node buffered
+            for first, last in msg_content['sack']:
+                for acked_id in range(first, last + 1):
+                    self.not_acked.ack(from_id, acked_id)
 
         elif msg_type == 'ack_add_entry':
             entry_value = msg_content['entry_value']
             from_id = msg_content['from']
-            #remove from not_added list
-            if len(self.not_added[from_id]) > 0:
-                for i in range(len(self.not_added[from_id])):
-                    if self.not_added[from_id][i-1][0]['entry_value'] == entry_value:
-                        print(f"Node {self.own_id}: Received ack from Node {from_id} for add_entry '{entry_value}'")
-                        del self.not_added[from_id][i-1]
+            #remove from not_added
+            if self.not_added.ack(from_id, entry_value, t):
+                log.debug("Received ack from Node {} for add_entry '{}'", from_id, entry_value, node=self.own_id)
+
+    def send_acks(self, t):
+        """
+        Acknowledge all propagate-messages received from the senders whose ack is due, one ack per sender:
+        cumulative: all messages up to this sequence number were added to the board
+        sack: [first, last] ranges of sequence numbers received out of order and buffered
+        """
+        for from_id in sorted(from_id for from_id, due in self.acks_due.items() if due <= t):
+            del self.acks_due[from_id]
+            sack = []
+            for entry_id in sorted(self.buffers[from_id]):
+                if sack and sack[-1][1] == entry_id - 1:
+                    sack[-1][1] = entry_id
+                else:
+                    sack.append([entry_id, entry_id])
+            ack_msg = {
+                'type': 'ack',
+                'cumulative': self.expected_seq[from_id] - 1,
+                'sack': sack,
+                'from': self.own_id
+            }
+            self.messenger.send(from_id, messenger.Message(ack_msg))
+
+    def next_timeout(self):
+        """
+        Time at which update() has to retransmit the oldest unacknowledged message or send a delayed ack, or None if
+        nothing is pending. Used by the event-driven simulation to only wake up the node when needed.
+        """
+        next_ack = min(self.acks_due.values(), default=None)
+        timeouts = [timeout for timeout in (self.not_added.next_timeout(), self.not_acked.next_timeout(), next_ack) if timeout is not None]
+        return min(timeouts, default=None)
 
     def update(self, t: float):
         """
         Called periodically by the server to process incoming messages.
+        Everything sent during one update leaves as one batch per destination.
         """
+        self.messenger.hold()
         msgs = self.messenger.receive()
         for msg in msgs:
-            print(f"Node {self.own_id} received message at time {t}: {msg}")
+            log.debug("Received message at time {}: {}", t, msg, node=self.own_id)
             self.handle_message(msg, t)
+        self.send_acks(t)
 
-        #Retransmission of add_entry messages
-        for node_id in self.not_added:
-            for msg in self.not_added[node_id]:
-                if t - msg[1] > 2.0: #retransmit if not acked within 2 seconds
-                    print(f"Node {self.own_id}: Retransmitting add_entry message to Node {node_id}")
-                    self.messenger.send(node_id, messenger.Message(msg[0]))
-                    self.not_added[node_id].remove(msg)
-                    msg = (msg[0], t) #update send time
-                    self.not_added[node_id].append(msg)
+        #Retransmission of add_entry messages which were not acked within 2 seconds, one batch per destination
+        for node_id, msgs in self.not_added.expired(t).items():
+            log.debug("Retransmitting {} add_entry message(s) to Node {}", len(msgs), node_id, node=self.own_id)
+            self.messenger.send_many(node_id, msgs)
 
         #Retransmission of unacked messages
-        for node_id in self.not_acked:
-            for msg in self.not_acked[node_id]:
-                if t - msg[1] > 2.0: #retransmit if not acked within 2 seconds
-                    print(f"Node {self.own_id}: Retransmitting message ID {msg[0]['id']} to Node {node_id}")
-                    self.messenger.send(node_id, messenger.Message(msg[0]))
-                    self.not_acked[node_id].remove(msg)
-                    msg = (msg[0], t) #update send time
-                    self.not_acked[node_id].append(msg)
-
-            
-
-
-
-
-
-
-
-
-
+        for node_id, msgs in self.not_acked.expired(t).items():
+            if log.enabled(DEBUG):
+                log.debug("Retransmitting message IDs {} to Node {}", [msg.get_content()['id'] for msg in msgs], node_id, node=self.own_id)
+            self.messenger.send_many(node_id, msgs)
 
+        self.messenger.flush()
@@ -0,0 +1,282 @@
+import heapq
+import itertools
+import math
+import random
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+
+from event_log import log
+
+# events with the same time are ordered by priority: first deliver messages, then update the nodes (like the tick loop did)
+PRIORITY_DELIVER = 0
+PRIORITY_UPDATE = 1
+
+# without the GIL (a free-threaded build, e.g. python3.13t) node updates on several threads actually run in parallel
+FREE_THREADED = not getattr(sys, '_is_gil_enabled', lambda: True)()
+
+
+def node_random(seed, node_id) -> random.Random:
+    """Per-node random stream derived from the global seed, so that the draws of a node do not depend on the other nodes"""
+    return random.Random(f"{seed}/{node_id}")
+
+
+def wall_clock() -> Callable[[], float]:
+    """Seconds since the call, for a simulation whose time follows the wall clock (the server)"""
+    start = time.monotonic()
+    return lambda: time.monotonic() - start
+
+
+class Scheduler:
+    """
+    Global priority queue of (time, event) pairs.
+
+    Events are plain callbacks that get the event time as first argument.
+    The scheduler is thread-safe so that REST handlers can schedule client operations while the simulation runs.
+    """
+
+    def __init__(self):
+        self.events = []  # heap of (time, priority, seq, callback, args)
+        self.seq = itertools.count()  # tie-breaker so that equal events keep their insertion order
+        self.changed = threading.Condition()
+        self.on_schedule = None  # called after every schedule(), e.g., to wake up an asyncio task instead of wait()
+
+    def __len__(self):
+        return len(self.events)
+
+    def schedule(self, t: float, priority: int, callback: Callable, *args):
+        with self.changed:
+            heapq.heappush(self.events, (t, priority, next(self.seq), callback, args))
+            self.changed.notify_all()
+        if self.on_schedule is not None:
+            self.on_schedule()
+
+    def next_time(self) -> Optional[float]:
+        with self.changed:
+            return self.events[0][0] if self.events else None
+
+    def pop_due(self, t: float):
+        """Pop the next event with time <= t, returns None if there is none"""
+        with self.changed:
+            if self.events and self.events[0][0] <= t:
+                return heapq.heappop(self.events)
+            return None
+
+    def wait(self, now: float, max_wait: Optional[float] = None):
+        """Block until the next event is due (relative to now) or a new event was scheduled"""
+        with self.changed:
+            timeout = max_wait
+            if self.events:
+                timeout = max(0.0, self.events[0][0] - now)
+                if max_wait is not None:
+                    timeout = min(timeout, max_wait)
+            if timeout is None or timeout > 0.0:
+                self.changed.wait(timeout)
+
+
+class EventSimulation:
+    """
+    Discrete-event driver for nodes and transports.
+
+    Instead of calling deliver(t) on all N^2 transports and update(t) on all nodes every tick, only links that carry
+    messages and nodes that received messages (or have a retransmission timer due) are stepped.
+    Node.update(t) and Transport.deliver(t) are used unchanged, we only need to know when to call them:
+    - Messenger.send notifies us which link got a new message
+    - Transport.deliver(t) returns the time of its next pending delivery (or None)
+    - Node.next_timeout() returns the time of the next retransmission (or None)
+    Times are rounded up to multiples of `resolution` so that the behaviour matches the fixed-tick loop.
+
+    Without a clock the time is virtual and only moves from event to event. With a clock (see wall_clock) the time
+    follows it: while the simulation thread waits for the next event, `now` would be stale, so everything scheduled
+    from another thread (a REST handler, the network) first advances `now` to the clock, see advance().
+
+    With workers > 1 on a free-threaded Python build the nodes which are due at the same time are updated in parallel on
+    a thread pool. Nodes only interact through their queues, so this is safe as long as every node uses its own random
+    stream (see node_random). The wakeups caused by a node update are recorded and replayed in the order of the
+    sequential loop afterwards, so the run stays deterministic. With the GIL the pool cannot run two node updates at
+    the same time and only adds the cost of handing them out, so workers is ignored there (see FREE_THREADED).
+    """
+
+    def __init__(self, nodes, transports: Dict[Tuple[int, int], object], resolution: float = 0.01, r: Optional[random.Random] = None, locks=None, catch_errors=False, start_time: float = 0.0, workers: int = 1, clock: Optional[Callable[[], float]] = None):
+        self.scheduler = Scheduler()
+        self.nodes = {node.own_id: node for node in nodes}
+        self.transports = transports
+        self.resolution = resolution
+        self.r = r  # used to shuffle the nodes which are updated at the same time
+        # node_id -> lock held while that node is updated, so that other nodes can be accessed concurrently
+        self.locks = locks if locks is not None else {node.own_id: threading.RLock() for node in nodes}
+        self.catch_errors = catch_errors  # keep the simulation running if a node raises (used by the server)
+        self.now = start_time  # only moves forward
+        self.clock = clock  # current time of a real-time simulation, None for virtual time
+
+        self.link_wakeups = {}  # (from_id, to_id) -> time of the scheduled deliver event
+        self.node_wakeups = {}  # node_id -> time the node needs to be updated
+        self.step_times = set()  # times for which a node update step is scheduled
+        self.wakeup_lock = threading.Lock()  # REST handlers may wake links concurrently to the simulation
+        if workers > 1 and not FREE_THREADED:
+            log.warning("Ignoring workers={}: the GIL serializes the node updates, use a free-threaded Python build", workers)
+            workers = 1
+        self.executor = ThreadPoolExecutor(workers) if workers > 1 else None
+        self.deferred = threading.local()  # wakeups recorded on a worker thread during a parallel step
+
+        for node in nodes:
+            node.messenger.set_send_listener(self.on_send)
+
+    def align(self, t: float) -> float:
+        """Round t up to the next multiple of the resolution"""
+        return math.ceil(t / self.resolution - 1e-9) * self.resolution
+
+    def advance(self) -> float:
+        """Move now forward to the clock and return it, call this before scheduling from outside the simulation"""
+        if self.clock is not None:
+            t = self.clock()
+            with self.wakeup_lock:
+                self.now = max(self.now, t)
+        return self.now
+
+    def on_send(self, from_id, to_id):
+        # like in the tick loop, a message sent at time t is picked up by the transport in the next tick
+        # (the send may come from a REST handler while the simulation waits, so the clock decides what now is)
+        self.wake_link((from_id, to_id), self.advance() + self.resolution)
+
+    def wake_link(self, link, t: float):
+        if link not in self.transports:
+            return  # e.g. partitioned network
+        if self.defer(self.wake_link, link, t):
+            return
+        t = self.align(t)
+        with self.wakeup_lock:
+            scheduled = self.link_wakeups.get(link)
+            if scheduled is not None and scheduled <= t:
+                return
+            self.link_wakeups[link] = t
+        self.scheduler.schedule(t, PRIORITY_DELIVER, self.deliver_link, link)
+
+    def wake_node(self, node_id, t: float):
+        if self.defer(self.wake_node, node_id, t):
+            return
+        t = self.align(t)
+        with self.wakeup_lock:
+            scheduled = self.node_wakeups.get(node_id)
+            if scheduled is not None and scheduled <= t:
+                return
+            self.node_wakeups[node_id] = t
+            if t in self.step_times:
+                return
+            self.step_times.add(t)
+        self.scheduler.schedule(t, PRIORITY_UPDATE, self.step_nodes)
+
+    def defer(self, wake, *args) -> bool:
+        wakeups = getattr(self.deferred, 'wakeups', None)
+        if wakeups is None:
+            return False
+        wakeups.append((wake, args))
+        return True
+
+    def wake_all(self):
+        """Update every node at the next event, e.g., after a node recovered or the network changed"""
+        now = self.advance()
+        for node_id in self.nodes:
+            self.wake_node(node_id, now)
+        for link in self.transports:
+            self.wake_link(link, now)
+
+    def deliver_link(self, t: float, link):
+        with self.wakeup_lock:
+            if self.link_wakeups.get(link) != t:
+                return  # outdated event, the link was rescheduled
+            del self.link_wakeups[link]
+
+        transport = self.transports.get(link)
+        if transport is None:
+            return
+        next_delivery = transport.deliver(t)
+        if next_delivery is not None:
+            self.wake_link(link, max(next_delivery, t + self.resolution))
+
+        to_node = self.nodes.get(link[1])  # None if the node runs in another process
+        if to_node is not None and to_node.messenger.has_message():
+            self.wake_node(to_node.own_id, t)
+
+    def step_nodes(self, t: float):
+        with self.wakeup_lock:
+            self.step_times.discard(t)
+            due = [node_id for node_id, wakeup in self.node_wakeups.items() if wakeup <= t]
+            for node_id in due:
+                del self.node_wakeups[node_id]
+        if self.r is not None:
+            self.r.shuffle(due)
+
+        if self.executor is None:
+            for node_id in due:
+                self.update_node(t, self.nodes[node_id])
+            return
+
+        for wakeups in self.executor.map(self.update_node_deferred, itertools.repeat(t), due):
+            for wake, args in wakeups:
+                wake(*args)
+
+    def update_node_deferred(self, t: float, node_id):
+        """update_node on a worker thread, returns the wakeups it caused instead of scheduling them"""
+        self.deferred.wakeups = []
+        try:
+            self.update_node(t, self.nodes[node_id])
+            return self.deferred.wakeups
+        finally:
+            self.deferred.wakeups = None
+
+    def update_node(self, t: float, node):
+        with self.locks[node.own_id]:
+            if node.is_crashed():
+                return  # messages stay in the queue, the node is woken up again when it recovers
+            try:
+                node.update(t)
+            except Exception as e:
+                if not self.catch_errors:
+                    raise
+                log.error("{}\n{}", e, traceback.format_exc(), node=node.own_id)
+            timeout = node.next_timeout()
+        if timeout is not None:
+            self.wake_node(node.own_id, max(timeout, t + self.resolution))
+
+    def in_flight(self) -> bool:
+        """True while any link still has messages queued or buffered"""
+        return bool(self.link_wakeups)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def run(self, until: float, stop_when: Optional[Callable] = None) -> float:
+        """
+        Virtual-time mode: jump from event to event without sleeping.
+        Stops at `until`, when no events are left, or as soon as stop_when(self) returns True.
+        Returns the simulated time that was reached.
+        """
+        while True:
+            next_time = self.scheduler.next_time()
+            if next_time is None or next_time > until:
+                break
+            self.run_until(next_time)
+            if stop_when is not None and stop_when(self):
+                break
+        return self.now
+
+    def run_until(self, t: float) -> int:
+        """Execute all events with time <= t and return how many were executed"""
+        executed = 0
+        while True:
+            event = self.scheduler.pop_due(t)
+            if event is None:
+                break
+            event_time, _, _, callback, args = event
+            with self.wakeup_lock:
+                self.now = max(self.now, event_time)  # behind now if another thread advanced it to the clock
+            callback(event_time, *args)
+            executed += 1
+        with self.wakeup_lock:
+            self.now = max(self.now, t)
+        return executed
@@ -0,0 +1,127 @@
+import asyncio
+import struct
+import threading
+from typing import Callable, Dict, List, Tuple
+
+from event_log import log
+from messenger import Message, MessageQueue
+
+FRAME_HEADER = struct.Struct('>I')  # length of the encoded message that follows
+MAX_FRAME = 64 * 1024 * 1024
+CONNECT_TIMEOUT = 1.0  # seconds
+
+Address = Tuple[str, int]
+
+
+class Network:
+    """
+    TCP endpoint of one node process (multi-process mode, see launcher.py).
+
+    An asyncio event loop on a background thread accepts the connections of the other nodes and keeps one outgoing
+    connection per peer. Every message is one frame: its length and its binary encoding (see codec.py).
+    Received messages are passed to on_message on the network thread.
+    If a peer is not reachable the frames are dropped, like the UnreliableTransport drops messages, and the
+    retransmissions of the protocol take care of them.
+    """
+
+    def __init__(self, host: str, port: int, on_message: Callable[[Message], None]):
+        self.host = host
+        self.port = port
+        self.on_message = on_message
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        self.writers = {}  # address -> StreamWriter, only used on the network thread
+        self.connect_locks = {}  # address -> asyncio.Lock, keeps the frames to a peer in order while connecting
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        """Listen on (host, port) and run the event loop, returns once the socket is bound"""
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self.handle_connection, self.host, self.port), self.loop).result()
+        self.port = self.server.sockets[0].getsockname()[1]  # the actual port if 0 was passed
+
+    def close(self):
+        async def shutdown():
+            self.server.close()
+            for writer in self.writers.values():
+                writer.close()
+            await self.server.wait_closed()
+        if self.server is not None:
+            asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def send(self, address: Address, frames: List[bytes]):
+        """Send encoded messages to the node at address, thread-safe and non-blocking"""
+        self.loop.call_soon_threadsafe(self.loop.create_task, self.write(address, frames))
+
+    async def write(self, address: Address, frames: List[bytes]):
+        lock = self.connect_locks.setdefault(address, asyncio.Lock())
+        async with lock:
+            writer = self.writers.get(address)
+            if writer is None or writer.is_closing():
+                try:
+                    _, writer = await asyncio.wait_for(asyncio.open_connection(*address), CONNECT_TIMEOUT)
+                except (OSError, asyncio.TimeoutError) as e:
+                    log.debug("Dropping {} message(s) to {}: {}", len(frames), address, e)
+                    return
+                self.writers[address] = writer
+            data = b''.join(FRAME_HEADER.pack(len(frame)) + frame for frame in frames)
+            writer.write(data)
+            self.bytes_sent += len(data)
+            try:
+                await writer.drain()  # backpressure: wait while the socket buffer is full
+            except OSError as e:
+                log.debug("Connection to {} lost: {}", address, e)
+                writer.close()
+                del self.writers[address]
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                (size,) = FRAME_HEADER.unpack(header)
+                if size > MAX_FRAME:
+                    raise ValueError(f"frame of {size} bytes")
+                data = await reader.readexactly(size)
+                self.bytes_received += FRAME_HEADER.size + size
+                self.on_message(Message.decode(data))
+        except asyncio.IncompleteReadError:
+            pass  # the peer closed the connection
+        except (OSError, ValueError) as e:
+            log.warning("Closing connection from {}: {}", writer.get_extra_info('peername'), e)
+        finally:
+            writer.close()
+
+
+class SocketTransport:
+    """
+    Link to a node in another process, same deliver(t) contract as Transport: the messages queued by the sender
+    are handed to the network and count as delivered for the send window. The delays and drops are the real ones.
+    """
+
+    def __init__(self, in_queue: MessageQueue, network: Network, address: Address):
+        self.in_queue = in_queue
+        self.network = network
+        self.address = address
+
+    def deliver(self, t: float):
+        msgs = self.in_queue.drain()
+        if msgs:
+            self.network.send(self.address, [msg.encode() for msg in msgs])  # encoded once, e.g., for a broadcast
+            self.in_queue.release(sum(msg.count for msg in msgs))
+        return None  # nothing is buffered here
+
+    def next_delivery_time(self):
+        return None
+
+    def close(self):
+        pass  # the messages were handed to the network already
+
+
+def peer_addresses(host: str, base_port: int, num_nodes: int) -> Dict[int, Address]:
+    """Node i listens on base_port + i"""
+    return {node_id: (host, base_port + node_id) for node_id in range(num_nodes)}
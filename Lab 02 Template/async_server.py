@@ -0,0 +1,42 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional
+
+import uvicorn
+from a2wsgi import WSGIMiddleware
+
+WSGI_WORKERS = 16  # threads which run the WSGI app, a handler that waits for a node lock does not block the others
+BACKLOG = 1024  # pending connections, so that bursts of clients are not delayed by SYN retries
+
+
+class AsyncHttpServer:
+    """
+    uvicorn serving a WSGI app (the Bottle Server) through the a2wsgi bridge.
+
+    Every connection is a coroutine on the event loop instead of a thread of a fixed pool, so any number of clients
+    can keep a connection open and wait without blocking the others. The app itself is blocking WSGI code, a2wsgi
+    calls it on a pool of WSGI_WORKERS threads (the node locks keep the handlers and the simulation apart), so the
+    event loop never waits for a handler. Background work like the simulation runs as tasks on the same loop
+    (see `tasks` in serve()).
+    """
+
+    def __init__(self, app: Callable, host: str, port: int, workers: int = WSGI_WORKERS):
+        config = uvicorn.Config(WSGIMiddleware(app, workers=workers), host=host, port=port, backlog=BACKLOG,
+                                lifespan='off', access_log=False, log_level='warning')
+        self.server = uvicorn.Server(config)
+
+    async def serve(self, tasks: Optional[List[Callable[[], Awaitable]]] = None):
+        """Serve until interrupted, running the given coroutine functions as tasks on the same loop"""
+        background = [asyncio.create_task(task()) for task in tasks or []]
+        try:
+            await self.server.serve()
+        finally:
+            for task in background:
+                task.cancel()
+
+
+def serve(app: Callable, host: str, port: int, tasks: Optional[List[Callable[[], Awaitable]]] = None):
+    """Run the app and the background tasks on a new event loop until interrupted"""
+    try:
+        asyncio.run(AsyncHttpServer(app, host, port).serve(tasks))
+    except KeyboardInterrupt:
+        pass
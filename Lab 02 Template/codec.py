@@ -0,0 +1,253 @@
+"""
+Compact binary encoding of message contents, used by Message.encode() at process boundaries.
+
+Every value starts with a one-byte tag (like msgpack):
+- 0x00-0x7f  one of the KNOWN_STRINGS (field names and message types), no length and no UTF-8
+- 0x80-0x8f  None, False, True, int, float, str, bytes, list, map and int array, see below
+- 0xc0-0xff  the integers 0 to 63 (ids, node ids, small counters) without a second byte
+Integers are zigzag varints (7 bits per byte), strings, lists and maps are prefixed with their varint length.
+Lists of integers, e.g., vector clocks and timestamps, are int arrays: one tag for the whole list and one varint
+per element, so a clock entry below 128 takes a single byte.
+"""
+
+import struct
+from collections.abc import Mapping
+from types import MappingProxyType
+
+FORMAT_VERSION = 1  # first byte of every encoded value
+
+# append only: the position in this list is the wire encoding of the string. The positions are the same in all labs,
+# a string which only another lab uses keeps its position reserved with None here
+KNOWN_STRINGS = [
+    'type', 'from', 'to', 'id', 'seq', 'entry_id', 'entry_value', 'value', 'timestamp', 'messages',
+    'batch', 'propagate', 'ack', 'add_entry', 'ack_add_entry', 'cumulative', 'sack',
+    'create_ts', 'modify_ts', 'delete_ts', 'vc', 'clock', 'entries', 'entry', 'digest', 'version',
+    'update_entry', 'delete_entry',
+    'merkle', 'merkle_entries', 'level', 'nodes', 'leaves', 'reply',
+    'gossip',
+    None, None,  # Lab 3 sync: 'sync', 'sync_entries'
+]
+assert len(KNOWN_STRINGS) <= 0x80
+KNOWN_INDEX = {s: i for i, s in enumerate(KNOWN_STRINGS) if s is not None}
+
+NONE = 0x80
+FALSE = 0x81
+TRUE = 0x82
+INT = 0x83
+FLOAT = 0x84
+STR = 0x85
+BYTES = 0x86
+LIST = 0x87
+MAP = 0x88
+INT_ARRAY = 0x89
+SMALL_INT = 0xc0  # 0xc0 + n for 0 <= n < 64
+SMALL_INT_LIMIT = 64
+
+DOUBLE = struct.Struct('<d')
+
+
+def write_varint(out: bytearray, n: int):
+    """Unsigned varint, the low 7 bits first"""
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def read_varint(data, pos: int):
+    """Returns (n, position after the varint)"""
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def zigzag(n: int) -> int:
+    # maps 0, -1, 1, -2, ... to 0, 1, 2, 3, ... so that small negative numbers stay short
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+
+def unzigzag(n: int) -> int:
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+def is_int_array(values) -> bool:
+    return len(values) > 1 and all(type(v) is int for v in values)
+
+
+def write(out: bytearray, value):
+    cls = type(value)
+    if cls is str:
+        index = KNOWN_INDEX.get(value)
+        if index is not None:
+            out.append(index)
+        else:
+            data = value.encode('utf-8')
+            out.append(STR)
+            write_varint(out, len(data))
+            out += data
+    elif cls is int:
+        if 0 <= value < SMALL_INT_LIMIT:
+            out.append(SMALL_INT + value)
+        else:
+            out.append(INT)
+            write_varint(out, zigzag(value))
+    elif cls is MappingProxyType or cls is dict:
+        write_map(out, value)
+    elif cls is tuple or cls is list:
+        write_list(out, value)
+    elif value is None:
+        out.append(NONE)
+    elif cls is bool:
+        out.append(TRUE if value else FALSE)
+    elif cls is float:
+        out.append(FLOAT)
+        out += DOUBLE.pack(value)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out.append(BYTES)
+        write_varint(out, len(value))
+        out += value
+    elif isinstance(value, Mapping):
+        write_map(out, value)
+    elif isinstance(value, (list, tuple)):
+        write_list(out, value)
+    elif isinstance(value, int):  # e.g., an IntEnum
+        write(out, int(value))
+    elif isinstance(value, str):
+        write(out, str(value))
+    else:
+        raise TypeError(f"Object of type {cls.__name__} cannot be encoded")
+
+
+def write_map(out: bytearray, value: Mapping):
+    out.append(MAP)
+    write_varint(out, len(value))
+    known = KNOWN_INDEX
+    for k, v in value.items():
+        # inlined for the common fields: known names, small ints and known type values
+        index = known.get(k) if type(k) is str else None
+        if index is not None:
+            out.append(index)
+        else:
+            write(out, k)
+        cls = type(v)
+        if cls is int and 0 <= v < SMALL_INT_LIMIT:
+            out.append(SMALL_INT + v)
+        elif cls is str and v in known:
+            out.append(known[v])
+        else:
+            write(out, v)
+
+
+def write_list(out: bytearray, value):
+    if is_int_array(value):
+        out.append(INT_ARRAY)
+        write_varint(out, len(value))
+        for v in value:
+            if 0 <= v < 0x40:
+                out.append(v << 1)
+            else:
+                write_varint(out, zigzag(v))
+    else:
+        out.append(LIST)
+        write_varint(out, len(value))
+        for v in value:
+            write(out, v)
+
+
+def read(data, pos: int, frozen: bool = False):
+    """Returns (value, position after the value), frozen: read-only mappings and tuples instead of dicts and lists"""
+    tag = data[pos]
+    pos += 1
+    if tag >= SMALL_INT:
+        return tag - SMALL_INT, pos
+    if tag < NONE:
+        return KNOWN_STRINGS[tag], pos
+    if tag == MAP:
+        n = data[pos]
+        if n < 0x80:
+            pos += 1
+        else:
+            n, pos = read_varint(data, pos)
+        result = {}
+        known = KNOWN_STRINGS
+        for _ in range(n):
+            # inlined for the common fields: known names, small ints and known type values
+            tag = data[pos]
+            if tag < NONE:
+                k = known[tag]
+                pos += 1
+            else:
+                k, pos = read(data, pos, frozen)
+            tag = data[pos]
+            if tag >= SMALL_INT:
+                result[k] = tag - SMALL_INT
+                pos += 1
+            elif tag < NONE:
+                result[k] = known[tag]
+                pos += 1
+            else:
+                result[k], pos = read(data, pos, frozen)
+        return (MappingProxyType(result) if frozen else result), pos
+    if tag == STR:
+        n, pos = read_varint(data, pos)
+        return str(data[pos:pos + n], 'utf-8'), pos + n
+    if tag == INT:
+        n, pos = read_varint(data, pos)
+        return unzigzag(n), pos
+    if tag == LIST:
+        n, pos = read_varint(data, pos)
+        result = []
+        for _ in range(n):
+            v, pos = read(data, pos, frozen)
+            result.append(v)
+        return (tuple(result) if frozen else result), pos
+    if tag == INT_ARRAY:
+        n, pos = read_varint(data, pos)
+        result = []
+        for _ in range(n):
+            v = data[pos]
+            if v < 0x80:
+                pos += 1
+            else:
+                v, pos = read_varint(data, pos)
+            result.append(v >> 1 if not v & 1 else -((v + 1) >> 1))
+        return (tuple(result) if frozen else result), pos
+    if tag == NONE:
+        return None, pos
+    if tag == FALSE:
+        return False, pos
+    if tag == TRUE:
+        return True, pos
+    if tag == FLOAT:
+        return DOUBLE.unpack_from(data, pos)[0], pos + DOUBLE.size
+    if tag == BYTES:
+        n, pos = read_varint(data, pos)
+        return bytes(data[pos:pos + n]), pos + n
+    raise ValueError(f"unknown tag 0x{tag:02x} at byte {pos - 1}")
+
+
+def encode(value) -> bytes:
+    out = bytearray([FORMAT_VERSION])
+    write(out, value)
+    return bytes(out)
+
+
+def decode(data: bytes, frozen: bool = False):
+    """
+    Inverse of encode, maps become dicts and lists/tuples become lists.
+    frozen=True returns read-only mappings and tuples instead, like messenger.freeze but without a second pass.
+    """
+    if not data or data[0] != FORMAT_VERSION:
+        raise ValueError("not an encoded message or unsupported format version")
+    try:
+        value, pos = read(data, 1, frozen)
+    except IndexError:
+        raise ValueError("truncated message") from None
+    if pos != len(data):
+        raise ValueError(f"{len(data) - pos} trailing bytes after the message")
+    return value
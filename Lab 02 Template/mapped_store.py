@@ -0,0 +1,454 @@
+"""
+Board storage in memory-mapped files, so that a node can hold tens of millions of entries: the Python process only
+keeps a few objects per store instead of an Entry, an id string and the dict and list slots for every entry.
+
+Every store is a directory with five files, which grow by doubling and keep the board across restarts:
+- records  a header and one fixed-width record per entry slot: where its id and value are in the heap, their
+           lengths, the crc32 of the id and the next slot in its Merkle leaf
+- heap     the UTF-8 bytes of the ids and values, only appended to: a modified value is written again, the space of
+           replaced values and deleted entries is not reclaimed
+- table    hash index, open addressing with linear probing: (crc32 of the id, slot + 1) per bucket
+- order    the slots in board order, i.e., sorted by id; ids are created with the time, so new entries are mostly
+           inserted near the end and only the few slots after them are moved
+- merkle   the node hashes of the Merkle tree and the first slot of every leaf chain
+
+Reads return MappedEntry views that decode the id and value from the mapped heap when they are accessed.
+json_chunks() serves the entries from the mapped heap without decoding them (e.g., the board endpoint and digest).
+The files are not crash-consistent: a process that is killed during a change can leave them inconsistent. With an
+operation log (see Node.attach_oplog), a snapshot flushes the files and a restart applies the operations after it again.
+"""
+
+import json
+import mmap
+import os
+import re
+import struct
+import zlib
+from typing import Iterable, List, Optional
+
+from merkle import DEPTH, FANOUT, MerkleTree
+
+MAGIC = b'MBRD'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sIIIQQQQQ')  # magic, version, fanout, depth, slots, live entries, ordered entries, heap end, used buckets
+HEADER_SIZE = 64
+RECORD = struct.Struct('<QQIIII')  # id offset, value offset, id length, value length, crc32 of the id, next slot + 1 in the leaf
+BUCKET = struct.Struct('<II')  # crc32 of the id, slot + 1 (0: empty)
+SLOT = struct.Struct('<I')
+TOMBSTONE = 0xFFFFFFFF  # slot of a bucket whose entry was deleted, the probing continues after it
+INITIAL_SLOTS = 4096
+MAX_LOAD = 0.5  # used buckets (including tombstones) per bucket before the table is rebuilt twice as large
+ESCAPED = re.compile(rb'[^\x20\x21\x23-\x5b\x5d-\x7e]')  # bytes that json.dumps writes differently (escapes, non-ASCII)
+
+
+class MappedFile:
+    """A file mapped into memory that grows by doubling"""
+
+    def __init__(self, path: str, min_size: int):
+        self.path = path
+        self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < min_size:
+            self.file.truncate(min_size)  # sparse, the zeros take no space until they are written
+            size = min_size
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def ensure(self, size: int):
+        """Grow the file to at least size bytes"""
+        if size > len(self.map):
+            new_size = len(self.map)
+            while new_size < size:
+                new_size *= 2
+            self.file.truncate(new_size)
+            # a new mapping instead of resize(), which fails while views of the old one (see MappedEntry) exist
+            self.map = mmap.mmap(self.file.fileno(), new_size)
+
+    def close(self):
+        self.file.close()  # the mapping is unmapped once no view uses it any more
+
+
+class MappedStore:
+    """
+    The entries of a Board in the files of a directory (see Board(store) and Node.attach_store). The board uses
+    `entries`, `order` and `merkle` like its dict of entries, its SortedKeyList of ids and its MerkleTree.
+    """
+
+    def __init__(self, directory: str, fanout: int = FANOUT, depth: int = DEPTH):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fanout = fanout
+        self.depth = depth
+        self.records = MappedFile(os.path.join(directory, 'records'), HEADER_SIZE + INITIAL_SLOTS * RECORD.size)
+        self.heap = MappedFile(os.path.join(directory, 'heap'), INITIAL_SLOTS * 64)
+        self.table = MappedFile(os.path.join(directory, 'table'), int(INITIAL_SLOTS / MAX_LOAD) * BUCKET.size)
+        self.order_file = MappedFile(os.path.join(directory, 'order'), INITIAL_SLOTS * SLOT.size)
+        nodes = sum(fanout ** level for level in range(depth + 1))
+        self.tree_file = MappedFile(os.path.join(directory, 'merkle'), nodes * 8 + fanout ** depth * SLOT.size)
+
+        magic, version, stored_fanout, stored_depth, *counters = HEADER.unpack_from(self.records.map, 0)
+        if magic == bytes(4):
+            self.slots = self.live = self.ordered = self.heap_end = self.used_buckets = 0
+            self.save_header()
+        elif magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{directory} is not a board store of version {FORMAT_VERSION}")
+        elif (stored_fanout, stored_depth) != (fanout, depth):
+            raise ValueError(f"{directory} has a Merkle tree with fanout {stored_fanout} and depth {stored_depth}")
+        else:
+            self.slots, self.live, self.ordered, self.heap_end, self.used_buckets = counters
+        self.buckets = len(self.table.map) // BUCKET.size
+
+        self.entries = MappedEntries(self)
+        self.order = MappedOrder(self)
+        self.merkle = MappedMerkleTree(self, fanout, depth)
+
+    def save_header(self):
+        HEADER.pack_into(self.records.map, 0, MAGIC, FORMAT_VERSION, self.fanout, self.depth,
+                         self.slots, self.live, self.ordered, self.heap_end, self.used_buckets)
+
+    def flush(self):
+        """Write the changed pages of all files to disk, e.g., for a snapshot of the operation log"""
+        for mapped in (self.records, self.heap, self.table, self.order_file, self.tree_file):
+            mapped.map.flush()
+
+    def close(self):
+        for mapped in (self.records, self.heap, self.table, self.order_file, self.tree_file):
+            mapped.close()
+
+    # records
+
+    def record(self, slot: int):
+        return RECORD.unpack_from(self.records.map, HEADER_SIZE + slot * RECORD.size)
+
+    def id_bytes(self, slot: int) -> bytes:
+        id_offset, _, id_length, _, _, _ = RECORD.unpack_from(self.records.map, HEADER_SIZE + slot * RECORD.size)
+        return self.heap.map[id_offset:id_offset + id_length]
+
+    def id_of(self, slot: int) -> str:
+        return self.id_bytes(slot).decode('utf-8')
+
+    def next_in_leaf(self, slot: int) -> int:
+        return SLOT.unpack_from(self.records.map, HEADER_SIZE + slot * RECORD.size + RECORD.size - SLOT.size)[0]
+
+    def set_next_in_leaf(self, slot: int, link: int):
+        SLOT.pack_into(self.records.map, HEADER_SIZE + slot * RECORD.size + RECORD.size - SLOT.size, link)
+
+    def append_heap(self, data: bytes) -> int:
+        offset = self.heap_end
+        self.heap.ensure(offset + len(data))
+        self.heap.map[offset:offset + len(data)] = data
+        self.heap_end += len(data)
+        return offset
+
+    # hash index
+
+    def probe(self, key: bytes, crc: int):
+        """(slot of the id or None, its bucket or the first free bucket for it)"""
+        table, mask = self.table.map, self.buckets - 1
+        index, free = crc & mask, None
+        while True:
+            bucket_crc, link = BUCKET.unpack_from(table, index * BUCKET.size)
+            if link == 0:
+                return None, index if free is None else free
+            if link == TOMBSTONE:
+                if free is None:
+                    free = index
+            elif bucket_crc == crc and self.id_bytes(link - 1) == key:
+                return link - 1, index
+            index = (index + 1) & mask
+
+    def slot_of(self, entry_id: str) -> Optional[int]:
+        key = entry_id.encode('utf-8')
+        return self.probe(key, zlib.crc32(key))[0]
+
+    def rebuild_table(self, buckets: int):
+        """Rehash the live entries into a new table of the given number of buckets (a power of two)"""
+        path = self.table.path + '.tmp'
+        if os.path.exists(path):
+            os.remove(path)
+        new = MappedFile(path, buckets * BUCKET.size)
+        mask = buckets - 1
+        for crc, link in BUCKET.iter_unpack(self.table.map):
+            if link != 0 and link != TOMBSTONE:
+                index = crc & mask
+                while BUCKET.unpack_from(new.map, index * BUCKET.size)[1] != 0:
+                    index = (index + 1) & mask
+                BUCKET.pack_into(new.map, index * BUCKET.size, crc, link)
+        os.replace(path, self.table.path)
+        self.table.close()
+        new.path = self.table.path
+        self.table, self.buckets, self.used_buckets = new, buckets, self.live
+
+    # changes
+
+    def put(self, entry_id: str, value: str):
+        """Add the entry, or replace the value of an existing one"""
+        key, data = entry_id.encode('utf-8'), str(value).encode('utf-8')
+        crc = zlib.crc32(key)
+        slot, bucket = self.probe(key, crc)
+        if slot is not None:
+            position = HEADER_SIZE + slot * RECORD.size
+            id_offset, _, id_length, _, crc, link = RECORD.unpack_from(self.records.map, position)
+            RECORD.pack_into(self.records.map, position, id_offset, self.append_heap(data), id_length, len(data), crc, link)
+        else:
+            if self.used_buckets + 1 > self.buckets * MAX_LOAD:
+                buckets = self.buckets
+                while self.live + 1 > buckets * MAX_LOAD / 2:
+                    buckets *= 2
+                self.rebuild_table(buckets)
+                slot, bucket = self.probe(key, crc)
+            slot = self.slots
+            self.records.ensure(HEADER_SIZE + (slot + 1) * RECORD.size)
+            offset = self.append_heap(key + data)
+            RECORD.pack_into(self.records.map, HEADER_SIZE + slot * RECORD.size, offset, offset + len(key), len(key), len(data), crc, 0)
+            if BUCKET.unpack_from(self.table.map, bucket * BUCKET.size)[1] == 0:
+                self.used_buckets += 1  # not a reused tombstone
+            BUCKET.pack_into(self.table.map, bucket * BUCKET.size, crc, slot + 1)
+            self.slots += 1
+            self.live += 1
+        self.save_header()
+
+    def discard(self, entry_id: str) -> bool:
+        """Remove the entry from the index, returns whether it existed (its slot is not reused)"""
+        key = entry_id.encode('utf-8')
+        crc = zlib.crc32(key)
+        slot, bucket = self.probe(key, crc)
+        if slot is None:
+            return False
+        BUCKET.pack_into(self.table.map, bucket * BUCKET.size, 0, TOMBSTONE)
+        self.live -= 1
+        self.save_header()
+        return True
+
+    def ordered_entries(self, start: int, stop: Optional[int]) -> List['MappedEntry']:
+        """Views of the entries [start, stop) in board order, without looking them up by id"""
+        stop = self.ordered if stop is None else min(stop, self.ordered)
+        order = self.order_file.map
+        return [MappedEntry(self, slot) for (slot,) in SLOT.iter_unpack(order[start * SLOT.size:max(start, stop) * SLOT.size])]
+
+    def json_chunks(self, entries: Iterable['MappedEntry']) -> List[bytes]:
+        """
+        The entries as a JSON array, byte for byte what json.dumps writes for a list of their to_dict()s, in chunks
+        to join or hash. The ids and values are memoryviews of the mapped heap, only those which json.dumps would
+        escape are decoded.
+        """
+        heap, records = memoryview(self.heap.map), self.records.map
+        unpack, escaped = RECORD.unpack_from, ESCAPED.search
+        chunks = [b'[']
+        append = chunks.append
+        separator = b'{"id": '
+        for entry in entries:
+            id_offset, value_offset, id_length, value_length, _, _ = unpack(records, HEADER_SIZE + entry.slot * RECORD.size)
+            entry_id = heap[id_offset:id_offset + id_length]
+            value = heap[value_offset:value_offset + value_length]
+            append(separator)
+            if escaped(entry_id) is None:
+                append(b'"')
+                append(entry_id)
+                append(b'", "value": ')
+            else:
+                append(json.dumps(str(entry_id, 'utf-8')).encode('ascii'))
+                append(b', "value": ')
+            if escaped(value) is None:
+                append(b'"')
+                append(value)
+                append(b'"}')
+            else:
+                append(json.dumps(str(value, 'utf-8')).encode('ascii'))
+                append(b'}')
+            separator = b', {"id": '
+        append(b']')
+        return chunks
+
+
+class MappedEntry:
+    """Entry of a MappedStore, the id and value are decoded from the mapped heap when they are accessed"""
+    __slots__ = ('store', 'slot')
+
+    def __init__(self, store: MappedStore, slot: int):
+        self.store = store
+        self.slot = slot
+
+    @property
+    def id(self) -> str:
+        return self.store.id_of(self.slot)
+
+    @property
+    def value(self) -> str:
+        _, value_offset, _, value_length, _, _ = self.store.record(self.slot)
+        return self.store.heap.map[value_offset:value_offset + value_length].decode('utf-8')
+
+    def to_dict(self) -> dict:
+        id_offset, value_offset, id_length, value_length, _, _ = self.store.record(self.slot)
+        heap = self.store.heap.map
+        return {
+            "id": heap[id_offset:id_offset + id_length].decode('utf-8'),
+            "value": heap[value_offset:value_offset + value_length].decode('utf-8')
+        }
+
+    def __str__(self):
+        return str(self.to_dict())
+
+
+class MappedEntries:
+    """The entries of a MappedStore by id, used like the dict Board.indexed_entries"""
+
+    def __init__(self, store: MappedStore):
+        self.store = store
+
+    def __len__(self):
+        return self.store.live
+
+    def __contains__(self, entry_id):
+        return self.store.slot_of(entry_id) is not None
+
+    def __iter__(self):
+        return iter(self.store.order)
+
+    def keys(self):
+        return self
+
+    def get(self, entry_id, default=None):
+        slot = self.store.slot_of(entry_id)
+        return default if slot is None else MappedEntry(self.store, slot)
+
+    def __getitem__(self, entry_id):
+        slot = self.store.slot_of(entry_id)
+        if slot is None:
+            raise KeyError(entry_id)
+        return MappedEntry(self.store, slot)
+
+    def __setitem__(self, entry_id, entry):
+        self.store.put(entry_id, entry.value)
+
+    def __delitem__(self, entry_id):
+        if not self.store.discard(entry_id):
+            raise KeyError(entry_id)
+
+
+class MappedOrder:
+    """The ids of a MappedStore in board order, used like the SortedKeyList Board.ordered_ids"""
+
+    def __init__(self, store: MappedStore):
+        self.store = store
+
+    def __len__(self):
+        return self.store.ordered
+
+    def __iter__(self):
+        return self.islice(0, None)
+
+    def bisect(self, key: bytes, right: bool) -> int:
+        store, order = self.store, self.store.order_file.map
+        lo, hi = 0, store.ordered
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key = store.id_bytes(SLOT.unpack_from(order, mid * SLOT.size)[0])
+            if key < mid_key or (not right and key == mid_key):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def bisect_key_right(self, key: str) -> int:
+        return self.bisect(key.encode('utf-8'), True)
+
+    def index(self, entry_id: str) -> int:
+        key = entry_id.encode('utf-8')
+        position = self.bisect(key, False)
+        if position == self.store.ordered or self.store.id_bytes(self.slot_at(position)) != key:
+            raise ValueError(f"{entry_id} is not in the board")
+        return position
+
+    def slot_at(self, position: int) -> int:
+        return SLOT.unpack_from(self.store.order_file.map, position * SLOT.size)[0]
+
+    def islice(self, start: int = 0, stop: Optional[int] = None):
+        return (entry.id for entry in self.store.ordered_entries(start, stop))
+
+    def add(self, entry_id: str):
+        """Insert the slot of a stored entry at the position of its id"""
+        store, key = self.store, entry_id.encode('utf-8')
+        if store.ordered == 0 or store.id_bytes(self.slot_at(store.ordered - 1)) <= key:
+            position = store.ordered  # the usual case, ids are created in order
+        else:
+            position = self.bisect(key, True)
+        store.order_file.ensure((store.ordered + 1) * SLOT.size)
+        order = store.order_file.map
+        order.move((position + 1) * SLOT.size, position * SLOT.size, (store.ordered - position) * SLOT.size)
+        SLOT.pack_into(order, position * SLOT.size, store.slot_of(entry_id))
+        store.ordered += 1
+        store.save_header()
+
+    def remove(self, entry_id: str):
+        store = self.store
+        position = self.index(entry_id)
+        order = store.order_file.map
+        order.move(position * SLOT.size, (position + 1) * SLOT.size, (store.ordered - position - 1) * SLOT.size)
+        store.ordered -= 1
+        store.save_header()
+
+
+class MappedMerkleTree(MerkleTree):
+    """
+    MerkleTree whose node hashes are kept in the merkle file of a MappedStore, and whose leaves are chains of slots
+    through the records instead of dicts of keys.
+    """
+
+    def __init__(self, store: MappedStore, fanout: int, depth: int):
+        self.store = store
+        self.fanout = fanout
+        self.depth = depth
+        view = memoryview(store.tree_file.map)
+        nodes = sum(fanout ** level for level in range(depth + 1))
+        hashes = view[:nodes * 8].cast('Q')
+        self.levels, start = [], 0
+        for level in range(depth + 1):
+            self.levels.append(hashes[start:start + fanout ** level])
+            start += fanout ** level
+        self.heads = view[nodes * 8:].cast('I')  # leaf -> first slot + 1 of its chain (0: empty leaf)
+
+    @property
+    def count(self):
+        return self.store.live
+
+    def set(self, key: str, item_hash: int, old_hash: Optional[int] = None):
+        """Add the key, which has to be stored already, or replace its item hash old_hash"""
+        if old_hash == item_hash:
+            return
+        leaf = self.leaf_of(key)
+        self.flip(leaf, item_hash if old_hash is None else old_hash ^ item_hash)
+        if old_hash is None:
+            slot = self.store.slot_of(key)
+            self.store.set_next_in_leaf(slot, self.heads[leaf])
+            self.heads[leaf] = slot + 1
+
+    def remove(self, key: str, item_hash: int):
+        """Remove the key, which has to be still stored"""
+        leaf = self.leaf_of(key)
+        self.flip(leaf, item_hash)
+        store = self.store
+        slot = store.slot_of(key)
+        previous, link = None, self.heads[leaf]
+        while link != slot + 1:
+            previous, link = link - 1, store.next_in_leaf(link - 1)
+        if previous is None:
+            self.heads[leaf] = store.next_in_leaf(slot)
+        else:
+            store.set_next_in_leaf(previous, store.next_in_leaf(slot))
+
+    def keys_in_leaves(self, leaves) -> List[str]:
+        store, keys = self.store, []
+        for leaf in leaves:
+            link = self.heads[leaf]
+            while link:
+                keys.append(store.id_of(link - 1))
+                link = store.next_in_leaf(link - 1)
+        return keys
+
+    def snapshot(self) -> dict:
+        """Plain values to MerkleTree.restore() the tree from, e.g., to move the board of a store into memory"""
+        return {
+            'fanout': self.fanout,
+            'levels': [list(level) for level in self.levels],
+            'leaf_keys': {leaf: self.keys_in_leaves([leaf]) for leaf, link in enumerate(self.heads) if link},
+        }
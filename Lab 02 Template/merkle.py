@@ -0,0 +1,113 @@
+import hashlib
+from typing import Hashable, Iterable, List, Optional, Tuple
+
+FANOUT = 16  # children per inner node
+DEPTH = 3  # levels below the root, FANOUT ** DEPTH leaves (4096)
+
+
+def hash_item(*parts) -> int:
+    """64-bit hash of an item, e.g., of the id and value of an entry"""
+    data = '\x00'.join(str(part) for part in parts).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+
+class MerkleTree:
+    """
+    Hash tree over a keyspace (e.g., the entry ids of a board) for anti-entropy between replicas.
+
+    Keys are assigned to FANOUT ** DEPTH leaves by their hash. The hash of a node is the XOR of the item hashes
+    of all keys below it, so adding, changing or removing a key only touches the DEPTH + 1 nodes on its path.
+    Two replicas compare their trees top-down and only descend into subtrees whose hashes differ, so the number of
+    hashes and items exchanged grows with the number of differing keys and not with the number of keys.
+    Nodes are addressed as (level, index), the root is (0, 0) and the children of (l, i) are (l + 1, i * FANOUT + k).
+    """
+
+    def __init__(self, fanout: int = FANOUT, depth: int = DEPTH):
+        self.fanout = fanout
+        self.depth = depth
+        self.levels = [[0] * fanout ** level for level in range(depth + 1)]  # level -> node hashes
+        self.leaf_keys = {}  # leaf index -> {key: None}, the item hashes are kept by the caller (e.g., in its entries)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def leaf_of(self, key: Hashable) -> int:
+        return hash_item(key) % len(self.levels[-1])
+
+    def set(self, key: Hashable, item_hash: int, old_hash: Optional[int] = None):
+        """Add the key, or replace its item hash old_hash"""
+        if old_hash == item_hash:
+            return
+        leaf = self.leaf_of(key)
+        self.flip(leaf, item_hash if old_hash is None else old_hash ^ item_hash)
+        if old_hash is None:
+            self.leaf_keys.setdefault(leaf, {})[key] = None
+            self.count += 1
+
+    def remove(self, key: Hashable, item_hash: int):
+        leaf = self.leaf_of(key)
+        self.flip(leaf, item_hash)
+        keys = self.leaf_keys[leaf]
+        del keys[key]
+        if not keys:
+            del self.leaf_keys[leaf]
+        self.count -= 1
+
+    def flip(self, leaf: int, change: int):
+        # XOR the change into the leaf and all its ancestors
+        index = leaf
+        for level in range(self.depth, -1, -1):
+            self.levels[level][index] ^= change
+            index //= self.fanout
+
+    def root(self) -> int:
+        return self.levels[0][0]
+
+    def hashes(self, level: int, indices: Iterable[int]) -> List[Tuple[int, int]]:
+        """[(index, hash)] of the given nodes of one level"""
+        nodes = self.levels[level]
+        return [(index, nodes[index]) for index in indices]
+
+    def children(self, level: int, indices: Iterable[int]) -> List[Tuple[int, int]]:
+        """[(index, hash)] of all children of the given nodes, which are on level + 1"""
+        return self.hashes(level + 1, (index * self.fanout + k for index in indices for k in range(self.fanout)))
+
+    def differing(self, level: int, remote: Iterable[Tuple[int, int]]) -> List[int]:
+        """Indices of the remote (index, hash) nodes of one level whose hash differs from ours"""
+        nodes = self.levels[level]
+        return [index for index, remote_hash in remote if nodes[index] != remote_hash]
+
+    def keys_in_leaves(self, leaves: Iterable[int]) -> List[Hashable]:
+        return [key for leaf in leaves for key in self.leaf_keys.get(leaf, ())]
+
+    def snapshot(self) -> dict:
+        """Plain values to restore() the tree from"""
+        return {
+            'fanout': self.fanout,
+            'levels': self.levels,
+            'leaf_keys': {leaf: list(keys) for leaf, keys in self.leaf_keys.items()},
+        }
+
+    @staticmethod
+    def restore(snapshot: dict) -> 'MerkleTree':
+        """The tree of a snapshot() without hashing the keys again"""
+        tree = MerkleTree(snapshot['fanout'], len(snapshot['levels']) - 1)
+        tree.levels = [list(level) for level in snapshot['levels']]
+        tree.leaf_keys = {leaf: dict.fromkeys(keys) for leaf, keys in snapshot['leaf_keys'].items()}
+        tree.count = sum(len(keys) for keys in tree.leaf_keys.values())
+        return tree
+
+
+def diff(a: MerkleTree, b: MerkleTree) -> Tuple[List[Hashable], int]:
+    """
+    Keys of the leaves that differ between two local trees, found the way two replicas would (e.g., for benchmarks),
+    i.e., the keys whose items the replicas would exchange. Also returns the number of hashes compared.
+    """
+    compared = 0
+    level, differing = 0, a.differing(0, b.hashes(0, [0]))
+    while differing and level < a.depth:
+        remote = b.children(level, differing)
+        compared += len(remote)
+        level, differing = level + 1, a.differing(level + 1, remote)
+    return list(set(a.keys_in_leaves(differing)) | set(b.keys_in_leaves(differing))), compared
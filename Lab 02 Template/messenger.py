@@ -1,36 +1,143 @@
+import heapq
+import itertools
 import json
 import queue
 import random
-from typing import List
+import threading
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Callable, List, Mapping, Optional
 
+import codec
+from event_log import DEBUG, log
 
+SEND_WINDOW = 256  # messages per link that may be queued or in flight at the same time
+MAX_BACKLOG = 256  # messages per link that may wait for credit, further ones are refused
+BATCH_TYPE = 'batch'  # type of the envelope that carries several messages over one link
+
+
+def freeze(content):
+    """Recursively turn dicts into read-only mappings and lists into tuples"""
+    if isinstance(content, MappingProxyType):
+        return content  # already frozen
+    if isinstance(content, dict):
+        return MappingProxyType({k: freeze(v) for k, v in content.items()})
+    if isinstance(content, (list, tuple)):
+        return tuple(freeze(v) for v in content)
+    return content
+
+
+@dataclass(frozen=True, slots=True, eq=False)
 class Message:
-    def __init__(self, content):
-        self.content = json.dumps(content)  # store as JSON string so it remains immutable!
-        self.len = len(self.content)
+    """
+    Immutable message holding a read-only mapping, hashed and compared by identity (e.g., in the backlogs).
+
+    Messages are passed by reference between the in-process queues, so nothing is serialized on send or parsed on
+    receive. The binary encoding (see codec.py) is only computed at a real process boundary (or for len) and cached,
+    so all destinations of a broadcast share one encoded buffer. str() shows the content as JSON for the logs.
+    """
+    content: Mapping
+    encoded: Optional[bytes] = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, 'content', freeze(self.content))
 
     def __str__(self):
-        return f'{self.content}'
+        return json.dumps(self.content, default=dict)
+
+    @property
+    def len(self) -> int:
+        """Size of the encoded message in bytes, e.g., for bandwidth accounting"""
+        return len(self.encode())
+
+    def get_content(self) -> Mapping:
+        return self.content
+
+    @property
+    def count(self) -> int:
+        """Number of messages carried, more than one for a batch envelope"""
+        return len(self.content['messages']) if self.is_batch() else 1
+
+    def is_batch(self) -> bool:
+        return self.content.get('type') == BATCH_TYPE
 
-    def get_content(self):
-        return json.loads(self.content)
+    def unpack(self) -> List['Message']:
+        """Messages of a batch envelope (the message itself otherwise)"""
+        if not self.is_batch():
+            return [self]
+        return [Message(content) for content in self.content['messages']]
+
+    @staticmethod
+    def pack(msgs: List['Message']) -> 'Message':
+        """One envelope for several messages to the same destination, the contents are shared and not copied"""
+        if len(msgs) == 1:
+            return msgs[0]
+        return Message({'type': BATCH_TYPE, 'messages': tuple(msg.content for msg in msgs)})
+
+    def encode(self) -> bytes:
+        if self.encoded is None:
+            object.__setattr__(self, 'encoded', codec.encode(self.content))
+        return self.encoded
+
+    @staticmethod
+    def decode(data: bytes) -> 'Message':
+        msg = Message(codec.decode(data, frozen=True))  # already frozen, freeze() returns it as is
+        object.__setattr__(msg, 'encoded', bytes(data))
+        return msg
 
 
 class MessageQueue(queue.SimpleQueue[Message]):
-    pass
+    on_release: Optional[Callable[[int], None]] = None  # called by the transport when messages left the link
+
+    def release(self, n: int):
+        """The transport delivered or dropped n messages of this queue"""
+        if n and self.on_release is not None:
+            self.on_release(n)
+
+    def drain(self) -> List[Message]:
+        """Take all queued messages at once"""
+        msgs = []
+        try:
+            while True:
+                msgs.append(self.get_nowait())
+        except queue.Empty:
+            return msgs
+
+    def put_many(self, msgs: List[Message]):
+        for msg in msgs:
+            self.put(msg)
 
 
 class Transport:
     def __init__(self, in_queue: MessageQueue, out_queue: MessageQueue, r: random.Random):
         self.in_queue = in_queue
         self.out_queue = out_queue
+        self.count_bytes = False
+        self.bytes_delivered = 0  # encoded size of the delivered messages, only counted with count_bytes
+
+    def set_byte_accounting(self, count_bytes: bool):
+        """Count the encoded bytes of the delivered messages, costs one encoding per message (cached by the message)"""
+        self.count_bytes = count_bytes
 
     def deliver(self, t: float):
         # use the time parameter to ensure replayability
-        while not self.in_queue.empty():
-            msg = self.in_queue.get()
-            print("Delivering message at time {}: {}".format(t, msg))
-            self.out_queue.put(msg)
+        # all queued messages are moved as one batch
+        msgs = self.in_queue.drain()
+        if log.enabled(DEBUG):
+            for msg in msgs:
+                log.debug("Delivering message at time {}: {}", t, msg)
+        if self.count_bytes:
+            self.bytes_delivered += sum(msg.len for msg in msgs)
+        self.out_queue.put_many(msgs)
+        self.in_queue.release(sum(msg.count for msg in msgs))
+        return None  # nothing left in flight
+
+    def next_delivery_time(self):
+        """Time of the next pending delivery or None (used by the event-driven simulation)"""
+        return None
+
+    def close(self):
+        """The link is torn down (e.g., replaced when a partition heals), nothing is in flight here"""
 
 
 class UnreliableTransport(Transport):
@@ -38,6 +145,9 @@ class UnreliableTransport(Transport):
     Unreliable transport that simulates network conditions:
     - Message delays (random delay within a range)
     - Message drops (probabilistic packet loss)
+
+    A batch envelope is delayed as a whole. By default it is also dropped as a whole, like a packet carrying several
+    messages. set_batch_drop(False) decides for every message of the batch on its own instead.
     """
 
     def __init__(self, in_queue: MessageQueue, out_queue: MessageQueue, r: random.Random):
@@ -46,7 +156,9 @@ class UnreliableTransport(Transport):
         self.min_delay = 0.0
         self.max_delay = 0.0
         self.drop_rate = 0.0
-        self.buffered_messages = []  # List of (delivery_time, message) tuples
+        self.drop_batches = True
+        self.buffered_messages = []  # heap of (delivery_time, seq, message) tuples, ordered by delivery time
+        self.seq = itertools.count()  # keeps messages with equal delivery times in FIFO order
 
     def set_random_generator(self, r: random.Random):
         """Set the random number generator for reproducibility"""
@@ -56,6 +168,10 @@ class UnreliableTransport(Transport):
         """Set the probability of dropping a message (0.0 to 1.0)"""
         self.drop_rate = drop_rate
 
+    def set_batch_drop(self, drop_batches: bool):
+        """True: drop a batch envelope with all its messages at once, False: drop the messages of a batch one by one"""
+        self.drop_batches = drop_batches
+
     def set_delay(self, min_delay: float, max_delay: float):
         """Set the range of random delays for message delivery"""
         self.min_delay = min_delay
@@ -70,14 +186,25 @@ class UnreliableTransport(Transport):
         2. Decide whether to drop each message
         3. Add surviving messages to buffer with delivery time
         4. Deliver buffered messages whose time has come
+
+        Returns the time of the next pending delivery (or None if nothing is buffered).
         """
         # Process new incoming messages
-        while not self.in_queue.empty():
-            msg = self.in_queue.get()
+        dropped = 0
+        for msg in self.in_queue.drain():
 
             # Decide whether to drop this message
-            if self.r.random() < self.drop_rate:
-                print(f"Dropping message at time {t}: {msg}")
+            if msg.is_batch() and not self.drop_batches:
+                survivors = [m for m in msg.unpack() if self.r.random() >= self.drop_rate]
+                if len(survivors) < msg.count:
+                    log.debug("Dropping {} of {} batched messages at time {}", msg.count - len(survivors), msg.count, t)
+                    dropped += msg.count - len(survivors)
+                    if not survivors:
+                        continue
+                    msg = Message.pack(survivors)
+            elif self.r.random() < self.drop_rate:
+                log.debug("Dropping message at time {}: {}", t, msg)
+                dropped += msg.count
                 continue  # Message is lost
 
             # Calculate random delay for this message
@@ -85,41 +212,189 @@ class UnreliableTransport(Transport):
             delivery_time = t + delay
 
             # Add to buffer with delivery time
-            self.buffered_messages.append((delivery_time, msg))
+            heapq.heappush(self.buffered_messages, (delivery_time, next(self.seq), msg))
 
         # Deliver messages whose time has come
-        # We need to check all buffered messages and deliver those ready
-        remaining_messages = []
-        for delivery_time, msg in self.buffered_messages:
-            if t >= delivery_time:
-                # Time to deliver this message
-                print(f"Delivering message at time {t}: {msg}")
-                self.out_queue.put(msg)
-            else:
-                # Not ready yet, keep in buffer
-                remaining_messages.append((delivery_time, msg))
-
-        # Update buffer with only the messages that haven't been delivered yet
-        self.buffered_messages = remaining_messages
+        # The buffer is a heap, so we only touch the messages that are due and never scan the rest
+        due = []
+        while self.buffered_messages and t >= self.buffered_messages[0][0]:
+            _, _, msg = heapq.heappop(self.buffered_messages)
+            log.debug("Delivering message at time {}: {}", t, msg)
+            due.append(msg)
+        if self.count_bytes:
+            self.bytes_delivered += sum(msg.len for msg in due)
+        self.out_queue.put_many(due)
+        self.in_queue.release(dropped + sum(msg.count for msg in due))
+
+        return self.next_delivery_time()
+
+    def next_delivery_time(self):
+        """Time of the next pending delivery or None"""
+        return self.buffered_messages[0][0] if self.buffered_messages else None
+
+    def close(self):
+        """The link is torn down: the buffered messages are lost and their credit goes back to the sender"""
+        lost = sum(msg.count for _, _, msg in self.buffered_messages)
+        self.buffered_messages = []
+        self.in_queue.release(lost)
 
 class Messenger:
-    def __init__(self, own_id, num_out: int):
+    """
+    Queues of a node to all other nodes.
+
+    Every link has a send window: at most `window` messages may be queued or in flight (buffered by the transport).
+    The transport returns the credit when it delivers, drops or is closed with a message. While the window is full,
+    new messages wait in a local backlog of the link, in which sending the same message again (e.g., a retransmission)
+    is a no-op. At most `max_backlog` messages wait per link, further ones are refused like a lost message, the sender
+    retransmits them later or checks writable() and produces them only when the link has credit again.
+    window=None disables the flow control, max_backlog=None lets the backlog grow without bound.
+
+    Between hold() and flush() (e.g., one update of the node), the messages to each destination are collected and
+    enqueued as one batch envelope, which the transport moves as a single message. receive() unpacks the batches.
+    """
+
+    def __init__(self, own_id, num_out: int, window: Optional[int] = SEND_WINDOW, max_backlog: Optional[int] = MAX_BACKLOG):
         self.own_id = own_id
         self.in_queue = MessageQueue()
         self.out_queues = {i: MessageQueue() for i in range(num_out)}
+        self.send_listener = None  # called with (own_id, destination) after each send
+        self.num_sent = 0  # messages handed to the transports, e.g., to compare protocols
+        self.num_refused = 0  # messages that found the window and the backlog of their link full
+        self.window = window
+        self.max_backlog = max_backlog
+        self.credit = {i: window for i in range(num_out)}  # messages that may still enter the link
+        self.backlogs = {i: {} for i in range(num_out)}  # {message: None} waiting for credit, in send order
+        self.window_lock = threading.Lock()  # credit is returned by the simulation thread
+        self.held = None  # destination -> messages collected since hold(), None if not holding
+        if window is not None:
+            for destination, out_queue in self.out_queues.items():
+                out_queue.on_release = lambda n, destination=destination: self.release(destination, n)
+
+    def set_send_listener(self, listener):
+        """Register a callback that is notified about every sent message, e.g., by the event-driven simulation"""
+        self.send_listener = listener
+
+    def hold(self):
+        """Collect the messages sent from now on until flush(), one batch per destination"""
+        if self.held is None:
+            self.held = {}
 
-    def send(self, destination, msg: Message): # TODO: Maybe add from and to fields to Message?
+    def flush(self):
+        """Enqueue the collected messages, one batch envelope per destination"""
+        held, self.held = self.held, None
+        for destination, msgs in (held or {}).items():
+            self.put(destination, msgs)
+
+    def send(self, destination, msg: Message) -> bool: # TODO: Maybe add from and to fields to Message?
+        """Returns False if the send window is full and the message waits in the backlog or was refused"""
+        return self.send_many(destination, [msg])
+
+    def send_many(self, destination, msgs: List[Message]) -> bool:
+        """Send several messages to one destination, e.g., a batch of retransmissions, with a single notification"""
         assert (destination in self.out_queues)
-        self.out_queues[destination].put(msg)
+        if self.window is not None:
+            with self.window_lock:
+                backlog = self.backlogs[destination]
+                # once messages wait, new ones queue behind them to keep the order
+                n = 0 if backlog else min(self.credit[destination], len(msgs))
+                self.credit[destination] -= n
+                for msg in msgs[n:]:
+                    self.wait(backlog, msg)
+            blocked = n < len(msgs)
+            msgs = msgs[:n]
+        else:
+            blocked = False
+        self.enqueue(destination, msgs)
+        return not blocked
+
+    def broadcast(self, msg: Message, destinations) -> bool:
+        """
+        Send the same message to all destinations in one call.
+        Only the reference is enqueued, so the message is constructed (and encoded) once for all of them.
+        Returns False if the message waits in the backlog of any destination or was refused.
+        """
+        if self.window is not None:
+            ready = []
+            with self.window_lock:
+                for destination in destinations:
+                    backlog = self.backlogs[destination]
+                    if backlog or not self.credit[destination]:
+                        self.wait(backlog, msg)
+                    else:
+                        self.credit[destination] -= 1
+                        ready.append(destination)
+            sent = len(ready) == len(destinations)
+            destinations = ready
+        else:
+            sent = True
+        if self.held is not None:
+            for destination in destinations:
+                self.held.setdefault(destination, []).append(msg)
+            return sent
+        out_queues = self.out_queues
+        listener = self.send_listener
+        for destination in destinations:
+            out_queues[destination].put(msg)
+            self.num_sent += 1
+            if listener is not None:
+                listener(self.own_id, destination)
+        return sent
+
+    def wait(self, backlog: dict, msg: Message):
+        # called with the window lock held, a message that waits already keeps its place
+        if msg in backlog or self.max_backlog is None or len(backlog) < self.max_backlog:
+            backlog[msg] = None
+        else:
+            self.num_refused += 1
+
+    def writable(self, destination) -> bool:
+        """True if a message sent to destination now enters the link right away, e.g., to create messages lazily"""
+        if self.window is None:
+            return True
+        with self.window_lock:
+            return not self.backlogs[destination] and self.credit[destination] > 0
+
+    def enqueue(self, destination, msgs: List[Message]):
+        if not msgs:
+            return
+        if self.held is not None:
+            self.held.setdefault(destination, []).extend(msgs)
+        else:
+            self.put(destination, msgs)
+
+    def put(self, destination, msgs: List[Message]):
+        # several messages to the same destination always travel as one envelope
+        if not msgs:
+            return
+        self.out_queues[destination].put(Message.pack(msgs))
+        self.num_sent += len(msgs)
+        if self.send_listener is not None:
+            self.send_listener(self.own_id, destination)
+
+    def release(self, destination, n: int):
+        """The transport delivered or dropped n messages of this link: refill the window from the backlog"""
+        with self.window_lock:
+            self.credit[destination] += n
+            backlog = self.backlogs[destination]
+            take = min(self.credit[destination], len(backlog))
+            msgs = list(itertools.islice(backlog, take))
+            for msg in msgs:
+                del backlog[msg]
+            self.credit[destination] -= take
+        self.put(destination, msgs)  # called by the transport, not part of the node's held batch
+
+    def backlog_size(self) -> int:
+        """Messages waiting for credit on all links"""
+        return sum(len(backlog) for backlog in self.backlogs.values())
 
     def has_message(self) -> bool:
         return not self.in_queue.empty()
 
     def receive(self) -> List[Message]:
         msgs = []
-        while not self.in_queue.empty():
-            print("Messenger {} received message".format(self.own_id))
-            msgs.append(self.in_queue.get())
+        for msg in self.in_queue.drain():
+            log.debug("Messenger received message", node=self.own_id)
+            msgs.extend(msg.unpack())
         return msgs
 
 
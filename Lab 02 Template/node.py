@@ -1,10 +1,30 @@
 # coding=utf-8
+import gc
+import hashlib
+import json
+import os
 import random
 import messenger
 import uuid
+from merkle import MerkleTree, hash_item
+from oplog import SNAPSHOT_OPS
+from retransmission import OutstandingTable
+from sortedcontainers import SortedDict, SortedKeyList
+from event_log import DEBUG, log
+
+
+RETRANSMIT_TIMEOUT = 2.0  # seconds until an unacknowledged message is sent again, adapted per peer to the measured round-trip times
+ANTI_ENTROPY_INTERVAL = float(os.getenv('ANTI_ENTROPY_INTERVAL')) if os.getenv('ANTI_ENTROPY_INTERVAL') else None  # seconds between two Merkle tree comparisons with a random peer, None: no anti-entropy (except in gossip mode)
+GOSSIP_PULL_INTERVAL = 2.0  # seconds between two Merkle tree comparisons in gossip mode if ANTI_ENTROPY_INTERVAL is not set
+GOSSIP_FANOUT = int(os.getenv('GOSSIP_FANOUT')) if os.getenv('GOSSIP_FANOUT') else 0  # >0: gossip new entries to this many random peers per round instead of propagating them to all nodes
+GOSSIP_INTERVAL = 0.5  # seconds between two gossip rounds of a node that has rumors
+RUMOR_ROUNDS = 3  # gossip rounds in which a node pushes a rumor before it stops spreading it
+CHANGE_HISTORY = 10000  # changes kept for delta reads of a board in a MappedStore, older version tokens need a full read
 
 
 class Entry:
+    __slots__ = ('id', 'value')  # boards keep many entries, e.g., a million restored from a snapshot
+
     def __init__(self, id, value):
         self.id = id
         self.value = value
@@ -22,15 +42,138 @@ class Entry:
         return str(self.to_dict())
 
 class Board():
-    def __init__(self):
-        self.indexed_entries = {}
+    def __init__(self, store=None):
+        self.store = store  # MappedStore that keeps the entries in files instead of Python objects, see Node.attach_store
+        self.indexed_entries = {} if store is None else store.entries
+        self.ordered_ids = SortedKeyList(key=str) if store is None else store.order  # entry ids in board order, kept up to date on every change
+        self.version = 1 if self.indexed_entries else 0  # incremented on every change, 1: not the empty board
+        self.digest_cache = (-1, None)  # (version, digest)
+        self.epoch = uuid.uuid4().hex  # identifies this board in version tokens
+        self.changes = SortedDict()  # version -> id of the entry changed in that version (only its last change)
+        self.change_versions = {}  # entry id -> version of its last change
+        self.max_history = None if store is None else CHANGE_HISTORY  # the history of a store has to stay small too
+        self.history_start = self.version  # delta reads can start from this version on
+        self.merkle = MerkleTree() if store is None else store.merkle  # hashes of the entries, compared with the other nodes by anti-entropy
+        self.oplog = None  # OperationLog that records every change, see Node.attach_oplog
+
+    def __len__(self):
+        return len(self.ordered_ids)
 
     def add_entry(self, entry):
-        self.indexed_entries[entry.id] = entry
+        old_entry = self.indexed_entries.get(entry.id)
+        old_hash = hash_item(entry.id, old_entry.value) if old_entry is not None else None  # before a store overwrites the value
+        self.indexed_entries[entry.id] = entry  # replacing an entry (modify) keeps its position
+        if old_entry is None:
+            self.ordered_ids.add(entry.id)  # after storing it, a store orders the entry's slot
+        self.merkle.set(entry.id, hash_item(entry.id, entry.value), old_hash)
+        self.record_change(entry.id)
+        if self.oplog is not None:
+            self.oplog.append(['add', entry.id, entry.value])
+
+    def delete_entry(self, entry_id):
+        entry = self.indexed_entries.get(entry_id)
+        if entry is not None:
+            self.ordered_ids.remove(entry_id)
+            self.merkle.remove(entry_id, hash_item(entry_id, entry.value))
+            del self.indexed_entries[entry_id]  # last, a store finds the entry's slot by its id
+            self.record_change(entry_id)
+            if self.oplog is not None:
+                self.oplog.append(['delete', entry_id])
+
+    def snapshot(self) -> dict:
+        """The entries as plain values in columns (for OperationLog.snapshot), restored by Board.restore"""
+        if self.store is not None:
+            # the entries are in the files of the store already, they only have to be on disk
+            self.store.flush()
+            return {'store': self.store.directory}
+        ids = list(self.ordered_ids)
+        indexed_entries = self.indexed_entries
+        return {
+            'ids': ids,
+            'values': [indexed_entries[entry_id].value for entry_id in ids],
+            'merkle': self.merkle.snapshot(),
+        }
+
+    def restore(state: dict):
+        """
+        Board with the entries of a snapshot, built in bulk: the ids are already in board order and the Merkle tree
+        is not hashed again. The delta-read history starts empty, a new epoch makes clients reload the board anyway.
+        """
+        board = Board()
+        ids = state['ids']
+        board.indexed_entries = dict(zip(ids, map(Entry, ids, state['values'])))
+        board.ordered_ids = SortedKeyList(ids, key=str)
+        board.merkle = MerkleTree.restore(state['merkle'])
+        board.version = 1  # not the empty board
+        return board
+
+    def get_ordered_entries(self, start=0, limit=None):
+        """Entries in board order, or only the page [start, start + limit) of it"""
+        stop = None if limit is None else start + limit
+        if self.store is not None:
+            return self.store.ordered_entries(start, stop)  # views of the mapped entries, not looked up by id
+        return [self.indexed_entries[k] for k in self.ordered_ids.islice(start, stop)]
+
+    def get_digest(self):
+        """sha256 of the ordered entries as reported by the status endpoints, only recomputed after a change"""
+        if self.digest_cache[0] != self.version:
+            if self.store is not None:
+                # the same JSON, joined from the mapped heap without decoding the entries
+                digest = hashlib.sha256(b''.join(self.store.json_chunks(self.get_ordered_entries()))).hexdigest()
+            else:
+                dict_entries = [entry.to_dict() for entry in self.get_ordered_entries()]
+                digest = hashlib.sha256((json.dumps(tuple(dict_entries)).encode('utf-8'))).hexdigest()
+            self.digest_cache = (self.version, digest)
+        return self.digest_cache[1]
+
+    def record_change(self, entry_id):
+        """Bump the version and remember it as the last change of the entry (used for delta reads)"""
+        self.version += 1
+        previous_version = self.change_versions.pop(entry_id, None)
+        if previous_version is not None:
+            del self.changes[previous_version]
+        self.changes[self.version] = entry_id
+        self.change_versions[entry_id] = self.version
+        if self.max_history is not None and len(self.changes) > self.max_history:
+            version, oldest_id = self.changes.popitem(0)
+            del self.change_versions[oldest_id]
+            self.history_start = version
+
+    def get_version_token(self) -> str:
+        """Version token for delta reads, tokens of another board (e.g., before a restart) are not accepted"""
+        return f"{self.epoch}:{self.version}"
+
+    def parse_version_token(self, token):
+        """Board version of a token from get_version_token, or None if it doesn't belong to this board or is too old"""
+        epoch, _, version = str(token).partition(':')
+        if epoch != self.epoch or not version.isdigit() or not self.history_start <= int(version) <= self.version:
+            return None
+        return int(version)
 
-    def get_ordered_entries(self):
-        ordered_indices = sorted(self.indexed_entries.keys(), key=str)
-        return [self.indexed_entries[k] for k in ordered_indices]
+    def get_changes(self, since: int):
+        """
+        Entries changed after version `since` with their current position in board order (sorted by position),
+        and the ids of the entries deleted after `since`.
+        """
+        changed, deleted = [], []
+        for version in self.changes.irange(minimum=since, inclusive=(False, True)):
+            entry_id = self.changes[version]
+            if entry_id in self.indexed_entries:
+                changed.append((self.ordered_ids.index(entry_id), self.indexed_entries[entry_id]))
+            else:
+                deleted.append(entry_id)
+        changed.sort(key=lambda change: change[0])
+        return changed, deleted
+
+    def get_page(self, cursor=None, limit=None):
+        """
+        Up to `limit` entries in board order that come after the entry with id `cursor`,
+        and the cursor of the next page (None for the last page).
+        """
+        start = 0 if cursor is None else self.ordered_ids.bisect_key_right(str(cursor))
+        entries = self.get_ordered_entries(start, limit)
+        has_more = start + len(entries) < len(self.ordered_ids)
+        return entries, (str(entries[-1].id) if has_more and entries else None)
 
 class Node:
     def __init__(self, m: messenger.Messenger, own_id: int, num_servers: int, r : random.Random):
@@ -49,9 +192,74 @@ class Node:
         self.r = r
         self.expected_seq = {i: 1 for i in self.all_servers} #tracks next expected message id for each node
         self.buffers = {i: {} for i in self.all_servers} #buffer for out of order messages
-        self.not_acked = {i: [] for i in self.all_servers} #tracks messages that have not been acked (for coordinator)
-        self.not_added = {i: [] for i in self.all_servers} #tracks add_entry-messages that have not been acked (for all nodes, creating an entry)
+        self.not_acked = OutstandingTable(RETRANSMIT_TIMEOUT, r) #tracks propagate-messages that have not been acked, keyed by (node_id, entry id)
+        self.not_added = OutstandingTable(RETRANSMIT_TIMEOUT, r) #tracks add_entry-messages that have not been acked, keyed by (node_id, entry id)
         self.addition_received = [] # track received addition to avoid duplicates (for coordinator)
+        self.next_anti_entropy = None  # time of the next Merkle tree comparison, the first one starts with the first update
+        self.anti_entropy_interval = ANTI_ENTROPY_INTERVAL
+        self.anti_entropy_sent = 0  # entries sent to other nodes by anti-entropy
+        self.gossip_fanout = GOSSIP_FANOUT
+        self.rumors = {}  # entry id -> [value, hops from the creator, rounds left], the entries this node still gossips
+        self.next_gossip = None  # time of the next gossip round, None: with the next update
+        self.oplog = None  # OperationLog of the node, see attach_oplog
+
+    def attach_oplog(self, oplog):
+        """
+        Restore the node from its operation log (the latest snapshot and the operations after it) and record every
+        change from now on, so that a restarted node process continues with its board (see OPLOG_DIR in server.py).
+        Messages that were in flight are not recorded, the retransmissions and anti-entropy take care of them.
+        With a store (attach_store first), the snapshots only flush its files and the operations after the latest one
+        are applied to the store again, which repairs the changes the files lost and leaves the others as they are.
+        """
+        gc_enabled = gc.isenabled()
+        gc.disable()  # the restored entries contain no cycles, collecting while creating a million of them doubles the time
+        try:
+            state, ops = oplog.restore()
+            if state is not None:
+                board_state = state['board']
+                if self.board.store is None:
+                    if 'store' in board_state:
+                        raise ValueError(f"the board of the snapshot is in the store {board_state['store']}, attach it first")
+                    self.board = Board.restore(board_state)
+                elif 'store' not in board_state:
+                    for entry_id, value in zip(board_state['ids'], board_state['values']):  # the board moves into the store
+                        self.board.add_entry(Entry(entry_id, value))
+                self.status.update(state['status'])
+                self.expected_seq.update(state['expected_seq'])
+                self.addition_received = state['addition_received']
+        finally:
+            if gc_enabled:
+                gc.enable()
+        for op in ops:
+            if op[0] == 'add':
+                if op[1] not in self.board.indexed_entries:
+                    self.status['num_entries'] += 1
+                self.board.add_entry(Entry(op[1], op[2]))
+            elif op[0] == 'delete':
+                self.board.delete_entry(op[1])
+        if self.board.store is not None:
+            self.status['num_entries'] = len(self.board)  # the store had most of the replayed entries already
+        log.info("Restored {} entries ({} operations replayed)", len(self.board), len(ops), node=self.own_id)
+        self.oplog = oplog
+        self.board.oplog = oplog
+
+    def attach_store(self, store):
+        """
+        Keep the board in a MappedStore (see BOARD_DIR in server.py), so that its size is not limited by the memory of
+        the process. The node continues with the entries already in the store's files.
+        """
+        self.board = Board(store)
+        self.status['num_entries'] = len(self.board)
+        log.info("Opened a store with {} entries", len(self.board), node=self.own_id)
+
+    def snapshot_state(self) -> dict:
+        """State of the node for OperationLog.snapshot, restored by attach_oplog"""
+        return {
+            'board': self.board.snapshot(),
+            'status': dict(self.status),
+            'expected_seq': dict(self.expected_seq),
+            'addition_received': list(self.addition_received),
+        }
 
     #Generate IDs by combining the timestamp with the node ID of the creator-node
     def generateID(self, t, ID):
@@ -79,7 +287,11 @@ class Node:
         entry = Entry(entry_id, value)
         self.board.add_entry(entry)
 
-        print(f"Node {self.own_id}: Created entry {entry_id} with value '{value}'")
+        log.info("Created entry {} with value '{}'", entry_id, value, node=self.own_id)
+
+        if self.gossip_fanout:
+            self.rumors[entry_id] = [value, 0, RUMOR_ROUNDS]  # spread with the next update
+            return
 
         # TODO: Propagate the entry to all other servers? Use your solution for lab 1 to send messages between servers reliably
         # - What if the request gets lost?
@@ -94,19 +306,22 @@ class Node:
             'timestamp' : t
         }
         
-        print("Message send\n")
-        self.messenger.send(self.own_id, messenger.Message(msg))
-        self.not_added[self.own_id] += [(msg, 0.0)] 
-        print("Message send over\n")
+        message = messenger.Message(msg)
+        self.messenger.send(self.own_id, message)
+        self.not_added.add(self.own_id, entry_id, message, 0.0, measure_rtt=False)  # the send time is not known here
         
     def update_entry(self, entry_id, value):
-        print(f"Node {self.own_id}: tried to update {entry_id} to {value}, but update not implemented.")
+        log.info("tried to update {} to {}, but update not implemented.", entry_id, value, node=self.own_id)
         # TODO (Optional): Implement modify operation with conflict resolution
 
     def delete_entry(self, entry_id):
-        print(f"Node {self.own_id}: tried to delete {entry_id}, but delete not implemented.")
+        log.info("tried to delete {}, but delete not implemented.", entry_id, node=self.own_id)
         # TODO (Optional): Implement delete operation with conflict resolution
 
+    def recover(self):
+        """Called by the server when the node comes back after a crash: start an anti-entropy round with the next update"""
+        self.next_anti_entropy = None
+
     def handle_message(self, message, t):
         """
         Handle incoming messages from other nodes.
@@ -115,18 +330,22 @@ class Node:
         msg_content = message.get_content()
 
         if 'type' not in msg_content:
-            print(f"Node {self.own_id}: Received message without type: {msg_content}")
+            log.warning("Received message without type: {}", msg_content, node=self.own_id)
             return
 
         msg_type = msg_content['type']
+        #any message shows that the sender is reachable, messages to it that backed off are resent right away
+        self.not_acked.revive(msg_content['from'], t)
+        self.not_added.revive(msg_content['from'], t)
 
         if msg_type == 'add_entry':
             entry_value = msg_content['entry_value']
             entry_id = msg_content['entry_id']
-            print(f"Coordinator: Received add_entry for '{entry_value}', broadcasting to all nodes")
+            log.debug("Coordinator: Received add_entry for '{}', broadcasting to all nodes", entry_value, node=self.own_id)
             
             add_ack_msg = {
                 'type': 'ack_add_entry',
+                'entry_id': entry_id,
                 'entry_value': entry_value,
                 'from': self.own_id
             }
@@ -138,16 +357,18 @@ class Node:
                 self.addition_received += [entry_value]
                 #Propagation
                 self.status['num_entries_prop'] += 1
+                msg = {
+                    'type': 'propagate',
+                    'id' : self.status['num_entries_prop'], #sequence number of message
+                    'entry_id': entry_id,
+                    'entry_value': entry_value,
+                    'from' : self.own_id 
+                }
+                #one immutable message, enqueued for all destinations in a single call
+                message = messenger.Message(msg)
+                self.messenger.broadcast(message, self.other_servers)
                 for node_id in self.other_servers:
-                    msg = {
-                        'type': 'propagate',
-                        'id' : self.status['num_entries_prop'], #sequence number of message
-                        'entry_id': entry_id,
-                        'entry_value': entry_value,
-                        'from' : self.own_id 
-                    }
-                    self.messenger.send(node_id, messenger.Message(msg))
-                    self.not_acked[node_id] += [(msg, t)] #track unacked messages
+                    self.not_acked.add(node_id, entry_id, message, t) #track unacked messages, the acks carry the entry id
                     
         elif msg_type == 'propagate':
             entry_value = msg_content['entry_value']
@@ -167,7 +388,7 @@ class Node:
                 self.status['num_entries'] += 1
                 entry = Entry(entry_id, entry_value)
                 self.board.add_entry(entry)
-                print(f"Node {self.own_id}: Added entry ID {self.status['num_entries']} with value '{entry_value}'")
+                log.debug("Added entry ID {} with value '{}'", self.status['num_entries'], entry_value, node=self.own_id)
                 self.expected_seq[from_id] += 1
                 while self.expected_seq[from_id] in self.buffers[from_id]:
                     #check if the next expected id's are in the buffer list
@@ -180,48 +401,176 @@ class Node:
         elif msg_type == 'ack':
             acked_id = msg_content['id']
             from_id = msg_content['from']
-            #remove from not_acked list
-            if len(self.not_acked[from_id]) > 0:
-                for i in range(len(self.not_acked[from_id])):
-                    if self.not_acked[from_id][i-1][0]['id'] == acked_id:
-                        print(f"Node {self.own_id}: Received ack from Node {from_id} for message ID {acked_id}")
-                        del self.not_acked[from_id][i-1]
+            #remove from not_acked
+            if self.not_acked.ack(from_id, acked_id, t):
+                log.debug("Received ack from Node {} for message ID {}", from_id, acked_id, node=self.own_id)
 
         elif msg_type == 'ack_add_entry':
             entry_value = msg_content['entry_value']
             from_id = msg_content['from']
-            #remove from not_added list
-            if len(self.not_added[from_id]) > 0:
-                for i in range(len(self.not_added[from_id])):
-                    if self.not_added[from_id][i-1][0]['entry_value'] == entry_value:
-                        print(f"Node {self.own_id}: Received ack from Node {from_id} for add_entry '{entry_value}'")
-                        del self.not_added[from_id][i-1]
+            #remove from not_added
+            if self.not_added.ack(from_id, msg_content['entry_id'], t):
+                log.debug("Received ack from Node {} for add_entry '{}'", from_id, entry_value, node=self.own_id)
+
+        elif msg_type == 'gossip':
+            self.handle_gossip(msg_content)
+
+        elif msg_type == 'merkle':
+            self.handle_merkle(msg_content)
+
+        elif msg_type == 'merkle_entries':
+            self.handle_merkle_entries(msg_content)
+
+    def gossip(self, t):
+        """
+        Gossip mode (gossip_fanout > 0): push all rumors to gossip_fanout random peers, which spread the new ones further.
+        Every node sends an entry gossip_fanout * RUMOR_ROUNDS times, no matter how many nodes there are, instead of
+        the creator sending it and waiting for an ack from every node, and the entries reach all nodes in O(log N) rounds.
+        Pushes are not acknowledged or retransmitted (rumor mongering with a counter): the few nodes the rumors miss get
+        the entries from the periodic Merkle tree pulls (start_anti_entropy), which run in gossip mode even if
+        anti_entropy_interval is None (see pull_interval).
+        """
+        self.next_gossip = t + GOSSIP_INTERVAL
+        msg = {
+            'type': 'gossip',
+            'entries': [[entry_id, value, hops] for entry_id, (value, hops, _) in self.rumors.items()],
+            'from': self.own_id
+        }
+        peers = self.r.sample(self.other_servers, min(self.gossip_fanout, len(self.other_servers)))
+        self.messenger.broadcast(messenger.Message(msg), peers)
+        for entry_id, rumor in list(self.rumors.items()):
+            rumor[2] -= 1
+            if rumor[2] <= 0:
+                del self.rumors[entry_id]
+
+    def handle_gossip(self, msg_content):
+        for entry_id, entry_value, hops in msg_content['entries']:
+            if entry_id not in self.board.indexed_entries:
+                self.status['num_entries'] += 1
+                self.board.add_entry(Entry(entry_id, entry_value))
+                self.rumors[entry_id] = [entry_value, hops + 1, RUMOR_ROUNDS]
+                log.debug("Gossip: added entry {} after {} hop(s)", entry_id, hops + 1, node=self.own_id)
+
+    def pull_interval(self):
+        """Seconds between two anti-entropy rounds, None: no anti-entropy. Gossip mode always pulls, see gossip()"""
+        if self.anti_entropy_interval is None and self.gossip_fanout > 0:
+            return GOSSIP_PULL_INTERVAL
+        return self.anti_entropy_interval
+
+    def start_anti_entropy(self, t):
+        """
+        Compare the board with a random peer: send our Merkle root, the peer answers with the hashes of the next level
+        below the nodes that differ, and so on down to the leaves, whose entries are exchanged (see handle_merkle).
+        Repairs whatever the propagation missed (e.g., a crash or a partition) with traffic proportional to the
+        difference and not to the size of the boards. The messages are not retransmitted, the next round repeats them.
+        """
+        self.next_anti_entropy = t + self.pull_interval()
+        if not self.other_servers:
+            return
+        peer = self.r.choice(self.other_servers)
+        msg = {
+            'type': 'merkle',
+            'level': 0,
+            'nodes': self.board.merkle.hashes(0, [0]),
+            'from': self.own_id
+        }
+        self.messenger.send(peer, messenger.Message(msg))
+
+    def handle_merkle(self, msg_content):
+        tree = self.board.merkle
+        level = msg_content['level']
+        differing = tree.differing(level, msg_content['nodes'])
+        if not differing:
+            return
+        if level < tree.depth:
+            msg = {
+                'type': 'merkle',
+                'level': level + 1,
+                'nodes': tree.children(level, differing),
+                'from': self.own_id
+            }
+        else:
+            # our entries of the differing leaves, the peer adds the ones it lacks and replies with the ones we lack
+            msg = {
+                'type': 'merkle_entries',
+                'leaves': differing,
+                'entries': self.entries_in_leaves(differing),
+                'reply': True,
+                'from': self.own_id
+            }
+            self.anti_entropy_sent += len(msg['entries'])
+        self.messenger.send(msg_content['from'], messenger.Message(msg))
+
+    def handle_merkle_entries(self, msg_content):
+        remote_ids = set()
+        for entry_id, entry_value in msg_content['entries']:
+            remote_ids.add(entry_id)
+            if entry_id not in self.board.indexed_entries:
+                self.status['num_entries'] += 1
+                self.board.add_entry(Entry(entry_id, entry_value))
+                log.debug("Anti-entropy: added entry {} from Node {}", entry_id, msg_content['from'], node=self.own_id)
+        if msg_content['reply']:
+            missing = [entry for entry in self.entries_in_leaves(msg_content['leaves']) if entry[0] not in remote_ids]
+            if missing:
+                msg = {
+                    'type': 'merkle_entries',
+                    'leaves': msg_content['leaves'],
+                    'entries': missing,
+                    'reply': False,
+                    'from': self.own_id
+                }
+                self.anti_entropy_sent += len(missing)
+                self.messenger.send(msg_content['from'], messenger.Message(msg))
+
+    def entries_in_leaves(self, leaves):
+        """[[id, value]] of our entries in the given leaves of the Merkle tree"""
+        indexed_entries = self.board.indexed_entries
+        return [[entry_id, indexed_entries[entry_id].value] for entry_id in self.board.merkle.keys_in_leaves(leaves)]
+
+    def next_timeout(self):
+        """
+        Time at which update() has to retransmit the oldest unacknowledged message or start the next gossip or
+        anti-entropy round. Used by the event-driven simulation to only wake up the node when needed.
+        """
+        next_gossip = (self.next_gossip or 0.0) if self.rumors else None
+        timeouts = [timeout for timeout in (self.not_added.next_timeout(), self.not_acked.next_timeout(), next_gossip, self.next_anti_entropy) if timeout is not None]
+        return min(timeouts, default=None)
 
     def update(self, t: float):
         """
         Called periodically by the server to process incoming messages.
+        Everything sent during one update leaves as one batch per destination.
         """
+        self.messenger.hold()
         msgs = self.messenger.receive()
         for msg in msgs:
-            print(f"Node {self.own_id} received message at time {t}: {msg}")
+            log.debug("Received message at time {}: {}", t, msg, node=self.own_id)
             self.handle_message(msg, t)
 
-        #Retransmission of add_entry messages
-        for node_id in self.not_added:
-            for msg in self.not_added[node_id]:
-                if t - msg[1] > 2.0: #retransmit if not acked within 2 seconds
-                    print(f"Node {self.own_id}: Retransmitting add_entry message to Node {node_id}")
-                    self.messenger.send(node_id, messenger.Message(msg[0]))
-                    self.not_added[node_id].remove(msg)
-                    msg = (msg[0], t) #update send time
-                    self.not_added[node_id].append(msg)
+        #Retransmission of add_entry messages which were not acked within 2 seconds, one batch per destination
+        for node_id, msgs in self.not_added.expired(t).items():
+            log.debug("Retransmitting {} add_entry message(s) to Node {}", len(msgs), node_id, node=self.own_id)
+            self.messenger.send_many(node_id, msgs)
 
         #Retransmission of unacked messages
-        for node_id in self.not_acked:
-            for msg in self.not_acked[node_id]:
-                if t - msg[1] > 2.0: #retransmit if not acked within 2 seconds
-                    print(f"Node {self.own_id}: Retransmitting message ID {msg[0]['id']} to Node {node_id}")
-                    self.messenger.send(node_id, messenger.Message(msg[0]))
-                    self.not_acked[node_id].remove(msg)
-                    msg = (msg[0], t) #update send time
-                    self.not_acked[node_id].append(msg)
+        for node_id, msgs in self.not_acked.expired(t).items():
+            if log.enabled(DEBUG):
+                log.debug("Retransmitting message IDs {} to Node {}", [msg.get_content()['id'] for msg in msgs], node_id, node=self.own_id)
+            self.messenger.send_many(node_id, msgs)
+
+        if not self.rumors:
+            self.next_gossip = None
+        elif self.next_gossip is None or t >= self.next_gossip:
+            self.gossip(t)
+
+        if self.pull_interval() is None:
+            self.next_anti_entropy = None
+        elif self.next_anti_entropy is None or t >= self.next_anti_entropy:
+            self.start_anti_entropy(t)
+
+        if self.oplog is not None:
+            if self.oplog.ops_since_snapshot() >= SNAPSHOT_OPS:
+                self.oplog.snapshot(self.snapshot_state())  # compacts the log
+            self.oplog.flush()
+
+        self.messenger.flush()
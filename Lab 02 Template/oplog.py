@@ -0,0 +1,97 @@
+"""
+Append-only operation log with snapshots, so that a node can be restarted with its state instead of an empty board.
+
+Every node has its own directory with two files:
+- oplog     one frame per operation: the length and the binary encoding (see codec.py) of [seq, operation]
+- snapshot  pickle of the node state after the first `seq` operations, written to a temporary file and renamed
+
+A restart loads the snapshot and replays only the operations after it. After SNAPSHOT_OPS operations the node writes
+a new snapshot and the log is compacted, i.e., truncated, so neither the log nor the replay grow with the history.
+Operations whose seq is covered by the snapshot are skipped, so a crash between the snapshot and the truncation is
+harmless, and a torn last frame (the process died while writing it) is cut off.
+"""
+
+import os
+import pickle
+import struct
+
+import codec
+
+FORMAT_VERSION = 1  # of the snapshot
+FRAME_HEADER = struct.Struct('>I')  # length of the encoded operation that follows
+SNAPSHOT_OPS = 50000  # operations after which the owner should call snapshot()
+
+
+class OperationLog:
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.log_path = os.path.join(directory, 'oplog')
+        self.snapshot_path = os.path.join(directory, 'snapshot')
+        self.seq = 0  # operations appended so far, including those in the snapshot
+        self.snapshot_seq = 0  # operations contained in the snapshot
+        self.file = None
+
+    def restore(self):
+        """
+        Returns (state of the latest snapshot or None, operations after it), call once before append().
+        """
+        state = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot = pickle.load(f)
+            if snapshot['version'] != FORMAT_VERSION:
+                raise ValueError(f"unsupported snapshot version {snapshot['version']}")
+            state, self.snapshot_seq = snapshot['state'], snapshot['seq']
+        self.seq = self.snapshot_seq
+
+        ops = []
+        data = b''
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'rb') as f:
+                data = f.read()
+        pos = 0
+        while pos + FRAME_HEADER.size <= len(data):
+            (size,) = FRAME_HEADER.unpack_from(data, pos)
+            end = pos + FRAME_HEADER.size + size
+            if end > len(data):
+                break
+            seq, op = codec.decode(data[pos + FRAME_HEADER.size:end])
+            if seq > self.seq:
+                ops.append(op)
+                self.seq = seq
+            pos = end
+
+        self.file = open(self.log_path, 'ab')
+        if pos < len(data):
+            self.file.truncate(pos)  # torn frame of an interrupted write
+        return state, ops
+
+    def append(self, op):
+        """Buffer an operation (a list or dict of plain values), written to the file by flush()"""
+        self.seq += 1
+        frame = codec.encode([self.seq, op])
+        self.file.write(FRAME_HEADER.pack(len(frame)) + frame)
+
+    def flush(self):
+        """Hand the buffered operations to the OS, so that they survive a crash of the process"""
+        self.file.flush()
+
+    def ops_since_snapshot(self) -> int:
+        return self.seq - self.snapshot_seq
+
+    def snapshot(self, state):
+        """Write the state after all appended operations and compact the log"""
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'version': FORMAT_VERSION, 'seq': self.seq, 'state': state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self.snapshot_seq = self.seq
+        self.file.flush()
+        self.file.truncate(0)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -6,17 +6,28 @@ Modify the parameters below to test different scenarios:
 - NUM_ENTRIES: Number of entries to create
 - NUM_SERVERS: Number of nodes
 - SCENARIO: 'easy' (no failures), 'medium' (delays), 'hard' (delays + packet loss)
+- VIRTUAL_TIME: jump from event to event instead of sleeping, stop as soon as all nodes converged
+- NUM_WORKERS: update nodes in parallel, the result is the same as with a single worker
 """
 
+import json
 import random
+import tempfile
 import time
+from mapped_store import MappedStore
+from merkle import MerkleTree
+from oplog import OperationLog
 from messenger import Messenger, Transport, UnreliableTransport
-from node import Node
+from node import Entry, Node
+from scheduler import EventSimulation, node_random
 
 NUM_ENTRIES = 10
 NUM_SERVERS = 4
 SCENARIO = "hard"  # "easy", "medium", "hard"
 RANDOM_SEED = 42
+ANTI_ENTROPY_INTERVAL = 2.0  # seconds between two Merkle tree comparisons in the tests that need anti-entropy
+VIRTUAL_TIME = True  # False: step every time_step and sleep like the server does
+NUM_WORKERS = 1  # >1: update the nodes which are due at the same time on a thread pool (virtual time and free-threaded Python only)
 
 
 #create transports
@@ -50,12 +61,24 @@ def create_transports(nodes, scenario, r):
     return transports
 
 
-def run_simulation(nodes, transports, duration_seconds=5.0, time_step=0.01):
+def run_simulation(nodes, transports, duration_seconds=5.0, time_step=0.01, start_time=0.0, virtual=VIRTUAL_TIME, stop_when=None):
     """
     Run the distributed system simulation for a specified duration.
     Delivers messages and updates nodes at each time step.
+
+    In virtual time the clock jumps straight to the next pending event (message arrival or retransmission)
+    without sleeping, and the run ends early once stop_when(simulation) returns True.
+    Returns the simulated time that was reached, pass it as start_time to continue the simulation.
     """
-    t = 0.0
+    if virtual:
+        simulation = EventSimulation(nodes, transports, resolution=time_step, start_time=start_time, workers=NUM_WORKERS)
+        simulation.wake_all()  # pick up messages queued before the simulation started
+        try:
+            return simulation.run(start_time + duration_seconds, stop_when)
+        finally:
+            simulation.close()
+
+    t = start_time
     iterations = int(duration_seconds / time_step)
 
     for _ in range(iterations):
@@ -71,6 +94,19 @@ def run_simulation(nodes, transports, duration_seconds=5.0, time_step=0.01):
         t += time_step
         time.sleep(0.0001)
 
+    return t
+
+
+#stop condition for the virtual-time mode: nothing in flight and all running nodes have the same num_entries entries
+def converged(nodes, num_entries):
+    def check(simulation):
+        if simulation.in_flight():
+            return False
+        # compare the cached board digests instead of serializing all entries of every node
+        boards = [n.board for n in nodes if not n.is_crashed()]
+        return len(boards[0]) == num_entries and all(b.get_digest() == boards[0].get_digest() for b in boards[1:])
+    return check
+
 
 #basic test from lab 1
 def test_baseline():
@@ -83,7 +119,7 @@ def test_baseline():
     nodes = []
     for i in range(NUM_SERVERS):
         m = Messenger(i, NUM_SERVERS)
-        n = Node(m, i, NUM_SERVERS, r)
+        n = Node(m, i, NUM_SERVERS, node_random(42, i))
         nodes.append(n)
 
     # Setup transports based on scenario
@@ -102,9 +138,10 @@ def test_baseline():
     duration = 10.0
 
     print(f"Running simulation for {duration}s...")
-    run_simulation(nodes, transports, duration_seconds=duration)
+    t = run_simulation(nodes, transports, duration_seconds=duration, stop_when=converged(nodes, NUM_ENTRIES * NUM_SERVERS))
 
     elapsed = time.time() - start_time
+    print(f"Simulated time: {t:.2f}s")
     print(f"Time taken: {elapsed:.2f}s")
 
     # Check consistency
@@ -144,7 +181,7 @@ def test_partition_recovery():
     print("=" * 60)
 
     r = random.Random(RANDOM_SEED)
-    nodes = [Node(Messenger(i, NUM_SERVERS), i, NUM_SERVERS, r) for i in range(NUM_SERVERS)]
+    nodes = [Node(Messenger(i, NUM_SERVERS), i, NUM_SERVERS, node_random(RANDOM_SEED, i)) for i in range(NUM_SERVERS)]
 
     # Split in half
     half = NUM_SERVERS // 2
@@ -168,7 +205,7 @@ def test_partition_recovery():
     for i, node in enumerate(P2):
         node.create_entry(f"Server{node.own_id}_Entry{i}", time.time())
 
-    run_simulation(nodes, transports, duration_seconds=4.0)
+    t = run_simulation(nodes, transports, duration_seconds=4.0)
 
     print("\nChecking partitions diverged...")
     assert P1[0].get_entries() != P2[0].get_entries()
@@ -176,9 +213,11 @@ def test_partition_recovery():
 
     # Heal the network
     print(" Healing network...")
+    for transport in transports.values():
+        transport.close()  # the credit of the messages in flight goes back to the senders
     transports = create_transports(nodes, SCENARIO, r)
 
-    run_simulation(nodes, transports, duration_seconds=10.0)
+    run_simulation(nodes, transports, duration_seconds=10.0, start_time=t, stop_when=converged(nodes, NUM_SERVERS))
 
     print("\nChecking global consistency...")
     expected = nodes[0].get_entries()
@@ -196,7 +235,7 @@ def test_crash_recovery():
     print("=" * 60)
 
     r = random.Random(RANDOM_SEED)
-    nodes = [Node(Messenger(i, NUM_SERVERS), i, NUM_SERVERS, r) for i in range(NUM_SERVERS)]
+    nodes = [Node(Messenger(i, NUM_SERVERS), i, NUM_SERVERS, node_random(RANDOM_SEED, i)) for i in range(NUM_SERVERS)]
     transports = create_transports(nodes, SCENARIO, r)
 
     crashed = nodes[0]
@@ -208,13 +247,13 @@ def test_crash_recovery():
         for n in nodes[1:]:
             n.create_entry(f"Alive_E{i}", time.time())
 
-    run_simulation(nodes, transports, duration_seconds=4.0)
+    t = run_simulation(nodes, transports, duration_seconds=4.0, stop_when=converged(nodes, NUM_ENTRIES * (NUM_SERVERS - 1)))
 
     # Recovery
     print(f" Node {crashed.own_id} recovers!")
     crashed.status["crashed"] = False
 
-    run_simulation(nodes, transports, duration_seconds=6.0)
+    run_simulation(nodes, transports, duration_seconds=6.0, start_time=t, stop_when=converged(nodes, NUM_ENTRIES * (NUM_SERVERS - 1)))
 
     # Check consistency
     expected = nodes[1].get_entries()
@@ -223,8 +262,186 @@ def test_crash_recovery():
     print("SUCCESS: Crashed node caught up!")
 
 
+#Anti-entropy: large boards that differ in a few entries converge, and only about the differing entries are sent
+def test_anti_entropy(num_shared=10000, num_unique=5):
+    print("=" * 60)
+    print("TEST — Merkle tree anti-entropy")
+    print("=" * 60)
+
+    r = random.Random(RANDOM_SEED)
+    nodes = [Node(Messenger(i, NUM_SERVERS), i, NUM_SERVERS, node_random(RANDOM_SEED, i)) for i in range(NUM_SERVERS)]
+    transports = create_transports(nodes, SCENARIO, r)
+    for n in nodes:
+        n.anti_entropy_interval = ANTI_ENTROPY_INTERVAL
+
+    # the same entries on every board and a few on each board only, added directly so that nothing propagates them
+    for n in nodes:
+        for i in range(num_shared):
+            n.board.add_entry(Entry(f"shared - {i}", f"Shared_E{i}"))
+        for i in range(num_unique):
+            n.board.add_entry(Entry(f"unique - {n.own_id} - {i}", f"Server{n.own_id}_Unique{i}"))
+    total = num_shared + num_unique * NUM_SERVERS
+    print(f"{num_shared} shared entries, {num_unique} entries only on each of {NUM_SERVERS} nodes")
+
+    t = run_simulation(nodes, transports, duration_seconds=60.0, stop_when=converged(nodes, total))
+
+    expected = nodes[0].get_entries()
+    assert len(expected) == total
+    for n in nodes:
+        assert n.get_entries() == expected
+    sent = sum(n.anti_entropy_sent for n in nodes)
+    missing = num_unique * NUM_SERVERS * (NUM_SERVERS - 1)
+    print(f"Converged after {t:.2f}s, {sent} entries sent for {missing} missing ones")
+    # a differing leaf holds a few shared entries too, but sending whole boards would be num_shared entries per round
+    assert sent < num_shared
+    print("SUCCESS: Boards reconciled by anti-entropy!")
+
+
+#Gossip mode: entries are pushed to a few random peers per round instead of to all nodes
+def test_gossip(fanout=2, num_servers=NUM_SERVERS):
+    print("=" * 60)
+    print(f"TEST — Gossip with fanout {fanout}, {num_servers} nodes, scenario: {SCENARIO}")
+    print("=" * 60)
+
+    r = random.Random(RANDOM_SEED)
+    nodes = [Node(Messenger(i, num_servers), i, num_servers, node_random(RANDOM_SEED, i)) for i in range(num_servers)]
+    for n in nodes:
+        n.gossip_fanout = fanout  # anti_entropy_interval stays unset, gossip mode pulls on its own
+    transports = create_transports(nodes, SCENARIO, r)
+
+    for i in range(NUM_ENTRIES):
+        for n in nodes:
+            n.create_entry(f"Server{n.own_id}_Entry{i}", time.time())
+
+    t = run_simulation(nodes, transports, duration_seconds=30.0, stop_when=converged(nodes, NUM_ENTRIES * num_servers))
+
+    expected = nodes[0].get_entries()
+    assert len(expected) == NUM_ENTRIES * num_servers
+    for n in nodes:
+        assert n.get_entries() == expected
+    print(f"Converged after {t:.2f}s, {sum(n.messenger.num_sent for n in nodes)} messages sent")
+    print("SUCCESS: All nodes consistent with gossip!")
+
+
+#Process restart: new Node objects restore their boards from the operation logs (snapshot + replayed operations)
+def test_restart():
+    print("=" * 60)
+    print("TEST — Restart from operation logs")
+    print("=" * 60)
+
+    r = random.Random(RANDOM_SEED)
+    with tempfile.TemporaryDirectory() as directory:
+        def start_nodes():
+            nodes = [Node(Messenger(i, NUM_SERVERS), i, NUM_SERVERS, node_random(RANDOM_SEED, i)) for i in range(NUM_SERVERS)]
+            for n in nodes:
+                n.attach_oplog(OperationLog(f"{directory}/node-{n.own_id}"))
+            return nodes
+
+        nodes = start_nodes()
+        for i in range(NUM_ENTRIES):
+            for n in nodes:
+                n.create_entry(f"Server{n.own_id}_Entry{i}", time.time())
+            if i == NUM_ENTRIES // 2:
+                for n in nodes:
+                    n.oplog.snapshot(n.snapshot_state())  # the rest is replayed from the log
+        total = NUM_ENTRIES * NUM_SERVERS
+        t = run_simulation(nodes, create_transports(nodes, SCENARIO, r), duration_seconds=20.0, stop_when=converged(nodes, total))
+        expected = nodes[0].get_entries()
+        for n in nodes:
+            n.oplog.close()
+
+        print(" Restarting all nodes...")
+        nodes = start_nodes()
+        for n in nodes:
+            assert n.get_entries() == expected
+            assert n.status['num_entries'] == total
+        print(f" Restored {len(expected)} entries on every node")
+
+        for n in nodes:
+            n.create_entry(f"Server{n.own_id}_AfterRestart", time.time())
+        run_simulation(nodes, create_transports(nodes, SCENARIO, r), duration_seconds=20.0, start_time=t, stop_when=converged(nodes, total + NUM_SERVERS))
+        expected = nodes[0].get_entries()
+        for n in nodes:
+            assert n.get_entries() == expected
+            n.oplog.close()
+    print("SUCCESS: Boards restored after restart!")
+
+
+def test_mapped_store(num_unique=5):
+    print("=" * 60)
+    print("TEST — Boards in memory-mapped stores")
+    print("=" * 60)
+
+    r = random.Random(RANDOM_SEED)
+    with tempfile.TemporaryDirectory() as directory:
+        def start_nodes():
+            nodes = [Node(Messenger(i, NUM_SERVERS), i, NUM_SERVERS, node_random(RANDOM_SEED, i)) for i in range(NUM_SERVERS)]
+            for n in nodes:
+                n.attach_store(MappedStore(f"{directory}/node-{n.own_id}"))
+                n.attach_oplog(OperationLog(f"{directory}/oplog-{n.own_id}"))  # the rest of the node state
+                n.anti_entropy_interval = ANTI_ENTROPY_INTERVAL
+            return nodes
+
+        nodes = start_nodes()
+        for i in range(NUM_ENTRIES):
+            for n in nodes:
+                n.create_entry(f"Server{n.own_id}_Entry{i}", time.time())
+        for n in nodes:  # only anti-entropy brings these to the other nodes
+            for i in range(num_unique):
+                n.board.add_entry(Entry(f"unique - {n.own_id} - {i}", f"Server{n.own_id}_Unique{i} \"ü\""))
+            n.oplog.snapshot(n.snapshot_state())  # flushes the store, the rest is replayed from the log
+        total = (NUM_ENTRIES + num_unique) * NUM_SERVERS
+        t = run_simulation(nodes, create_transports(nodes, SCENARIO, r), duration_seconds=60.0, stop_when=converged(nodes, total))
+        expected = nodes[0].get_entries()
+        assert len(expected) == total
+        for n in nodes:
+            assert n.get_entries() == expected
+        # served from the mapped heap as it is, except for the values json.dumps escapes
+        assert b''.join(nodes[0].board.store.json_chunks(nodes[0].board.get_ordered_entries())) == json.dumps(expected).encode('utf-8')
+
+        # the same changes on a board in memory give the same order, delta reads and Merkle tree (every node makes them)
+        board, reference = nodes[0].board, Node(Messenger(0, 1), 0, 1, node_random(RANDOM_SEED, 0)).board
+        for entry in expected:
+            reference.add_entry(Entry(entry['id'], entry['value']))
+        since = (board.version, reference.version)
+        for b in [n.board for n in nodes] + [reference]:
+            b.add_entry(Entry(expected[3]['id'], "Modified"))
+            b.delete_entry(expected[5]['id'])
+        assert board.merkle.root() == reference.merkle.root()
+        assert MerkleTree.restore(board.merkle.snapshot()).root() == reference.merkle.root()
+        assert board.get_digest() == reference.get_digest()
+        changed, deleted = board.get_changes(since[0])
+        reference_changed, reference_deleted = reference.get_changes(since[1])
+        assert [(position, entry.to_dict()) for position, entry in changed] == [(position, entry.to_dict()) for position, entry in reference_changed]
+        assert deleted == reference_deleted == [expected[5]['id']]
+        assert board.get_page(expected[10]['id'], 5)[1] == reference.get_page(expected[10]['id'], 5)[1]
+        expected = nodes[0].get_entries()
+        for n in nodes:
+            n.board.store.close()
+            n.oplog.close()
+
+        print(" Reopening all stores...")
+        nodes = start_nodes()
+        assert nodes[0].get_entries() == expected
+        assert nodes[0].status['num_entries'] == len(expected)
+        assert nodes[0].board.merkle.root() == reference.merkle.root()
+        for n in nodes:
+            n.create_entry(f"Server{n.own_id}_AfterRestart", time.time())
+        run_simulation(nodes, create_transports(nodes, SCENARIO, r), duration_seconds=60.0, start_time=t, stop_when=converged(nodes, total + NUM_SERVERS))
+        for n in nodes:
+            assert n.get_entries() == nodes[0].get_entries()
+            n.board.store.close()
+            n.oplog.close()
+    print(f"SUCCESS: {total} entries in memory-mapped stores, reopened after restart!")
+
+
 # run tests
 if __name__ == "__main__":
     test_baseline()
     test_partition_recovery()
     test_crash_recovery()
+    test_anti_entropy()
+    test_gossip()
+    test_gossip(num_servers=20)  # pushes get lost on the lossy links, only the pulls bring every board up to date
+    test_restart()
+    test_mapped_store()
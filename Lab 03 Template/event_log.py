@@ -0,0 +1,150 @@
+import collections
+import json
+import os
+import queue
+import threading
+import time
+from typing import List, Optional
+
+DEBUG = 10  # every message, e.g., deliveries, drops, acks and retransmissions
+INFO = 20  # client operations, e.g., created entries
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {level: name for name, level in LEVELS.items()}
+
+CAPACITY = 10000  # events kept in memory, older ones are overwritten
+
+
+def parse_level(level) -> int:
+    """Level from its name ('debug', ...) or number"""
+    if isinstance(level, int):
+        return level
+    level = str(level).strip().lower()
+    if level.isdigit():
+        return int(level)
+    if level not in LEVELS:
+        raise ValueError(f"unknown log level {level!r}, use one of {', '.join(LEVELS)}")
+    return LEVELS[level]
+
+
+class Event:
+    """One log event, the message is only formatted when somebody reads it"""
+    __slots__ = ('time', 'level', 'node', 'fmt', 'args', 'formatted')
+
+    def __init__(self, level: int, node, fmt: str, args: tuple):
+        self.time = time.time()
+        self.level = level
+        self.node = node
+        self.fmt = fmt
+        self.args = args
+        self.formatted = None
+
+    @property
+    def message(self) -> str:
+        if self.formatted is None:
+            self.formatted = self.fmt.format(*self.args) if self.args else self.fmt
+        return self.formatted
+
+    def to_dict(self) -> dict:
+        return {
+            "time": self.time,
+            "level": LEVEL_NAMES.get(self.level, self.level),
+            "node": self.node,
+            "message": self.message
+        }
+
+    def __str__(self):
+        prefix = f"[{LEVEL_NAMES.get(self.level, self.level).upper()}]"
+        return f"{prefix} Node {self.node}: {self.message}" if self.node is not None else f"{prefix} {self.message}"
+
+
+class EventLog:
+    """
+    Structured event log that replaces the per-message prints.
+
+    Events below `level` are discarded before anything is formatted, so disabled tracing costs one comparison per
+    call (wrap expensive arguments in `if log.enabled(DEBUG):`). The others are kept in a ring buffer of the last
+    `capacity` events, which the server exposes at /debug/events, and are formatted lazily when they are read.
+    Events at or above `echo_level` are also printed, and a file sink writes JSON lines from a background thread so
+    that logging never waits for the disk.
+    """
+
+    def __init__(self, level=INFO, capacity: int = CAPACITY, echo_level=WARNING):
+        self.level = parse_level(level)
+        self.echo_level = parse_level(echo_level)
+        self.events = collections.deque(maxlen=capacity)
+        self.sink = None  # queue of events for the file writer thread
+        self.sink_thread = None
+
+    def set_level(self, level):
+        self.level = parse_level(level)
+
+    def enabled(self, level: int) -> bool:
+        return level >= self.level
+
+    def log(self, level: int, fmt: str, *args, node=None):
+        if level < self.level:
+            return
+        event = Event(level, node, fmt, args)
+        self.events.append(event)
+        if level >= self.echo_level:
+            print(event)
+        if self.sink is not None:
+            self.sink.put(event)
+
+    def debug(self, fmt: str, *args, node=None):
+        self.log(DEBUG, fmt, *args, node=node)
+
+    def info(self, fmt: str, *args, node=None):
+        self.log(INFO, fmt, *args, node=node)
+
+    def warning(self, fmt: str, *args, node=None):
+        self.log(WARNING, fmt, *args, node=node)
+
+    def error(self, fmt: str, *args, node=None):
+        self.log(ERROR, fmt, *args, node=node)
+
+    def recent(self, level=DEBUG, node=None, limit: Optional[int] = None) -> List[Event]:
+        """The buffered events (oldest first) at or above level, optionally only the last `limit` of one node"""
+        level = parse_level(level)
+        events = [e for e in list(self.events) if e.level >= level and (node is None or e.node == node)]
+        return events[-limit:] if limit else events
+
+    def open_file(self, path: str):
+        """Also write every recorded event as one JSON line to path, from a background thread"""
+        self.close()
+        self.sink = queue.SimpleQueue()
+        self.sink_thread = threading.Thread(target=self.write_file, args=(path, self.sink), daemon=True)
+        self.sink_thread.start()
+
+    def write_file(self, path: str, sink: queue.SimpleQueue):
+        with open(path, 'a', encoding='utf-8') as f:
+            while True:
+                events = [sink.get()]
+                try:
+                    while True:
+                        events.append(sink.get_nowait())
+                except queue.Empty:
+                    pass
+                closed = None in events
+                f.writelines(json.dumps(e.to_dict(), default=str) + "\n" for e in events if e is not None)
+                f.flush()
+                if closed:
+                    return
+
+    def close(self):
+        """Stop the file sink after it wrote the pending events"""
+        if self.sink is not None:
+            self.sink.put(None)
+            self.sink_thread.join()
+            self.sink = self.sink_thread = None
+
+
+# process-wide log, configured with EVENT_LOG_LEVEL (debug, info, warning, error), EVENT_LOG_CAPACITY,
+# EVENT_LOG_ECHO (level from which events are also printed) and EVENT_LOG_FILE (JSON lines)
+log = EventLog(os.getenv('EVENT_LOG_LEVEL') or INFO,
+               int(os.getenv('EVENT_LOG_CAPACITY')) if os.getenv('EVENT_LOG_CAPACITY') else CAPACITY,
+               os.getenv('EVENT_LOG_ECHO') or WARNING)
+if os.getenv('EVENT_LOG_FILE'):
+    log.open_file(os.getenv('EVENT_LOG_FILE'))
@@ -1,4 +1,6 @@
 
+var ENTRIES_PAGE_SIZE = 500; // entries per request when the whole board is loaded
+
 var initFrontend = function(serverList, currentServer) {
     window.app = new Vue({
         el: '#app',
@@ -8,6 +10,7 @@ var initFrontend = function(serverList, currentServer) {
           loading: true,
           requesting: false,
           entries: [],
+          version: null, // board version of the shown entries, later reloads only fetch the changes
           server_status: null,
           entryRequest: null,
           entryValue: ''
@@ -18,6 +21,7 @@ var initFrontend = function(serverList, currentServer) {
         methods: {
             changeServer: function() {
                 console.debug("Changed server to " + this.serverId);
+                this.version = null;
                 this.reloadBoard();
             },
 
@@ -33,18 +37,85 @@ var initFrontend = function(serverList, currentServer) {
                 console.debug("Reloading board for " + this.serverId);
                 
                 this.loading = true;
+                if (this.version !== null) {
+                    this.loadChanges();
+                } else {
+                    this.loadPage(null, [], null);
+                }
+            },
+            loadPage: function(cursor, entries, version) {
+                // load the board page by page, the cursor is the id of the last entry we got
                 var vm = this;
-                
-                this.entryRequest = $.getJSON( 'http://' + vm.serverList[vm.serverId] + '/entries', function( data ) {
-                    vm.setBoardEntries(data.entries, data.server_status);
+                var params = { limit: ENTRIES_PAGE_SIZE };
+                if (cursor !== null) {
+                    params.cursor = cursor;
+                }
+
+                this.entryRequest = $.getJSON( 'http://' + vm.serverList[vm.serverId] + '/entries', params, function( data ) {
+                    vm.handlePage(data, entries, version);
                 }).fail(function( jqxhr, textStatus, error ) {
-                    if (error !== "abort") {
-                        setTimeout(function(){
-                            vm.reloadBoard();
-                        }, 1000)
+                    vm.retryReload(error);
+                });
+            },
+            handlePage: function(data, entries, version) {
+                // remember the version of the first page, the changes made while paging are fetched afterwards
+                var seen = {};
+                entries.forEach(function(entry) { seen[entry.id] = true; });
+                data.entries.forEach(function(entry) {
+                    if (!seen[entry.id]) {
+                        entries.push(entry);
                     }
                 });
-            }, 
+                if (version === null) {
+                    version = data.version;
+                }
+
+                if (data.next_cursor !== null) {
+                    this.loadPage(data.next_cursor, entries, version);
+                    return;
+                }
+                this.version = version;
+                this.setBoardEntries(entries, data.server_status);
+                if (version !== data.version) {
+                    this.loadChanges();
+                }
+            },
+            loadChanges: function() {
+                var vm = this;
+                var params = { since: vm.version, limit: ENTRIES_PAGE_SIZE }; // the limit is only used if the server falls back to a full read
+
+                this.entryRequest = $.getJSON( 'http://' + vm.serverList[vm.serverId] + '/entries', params, function( data ) {
+                    if (data.changed === undefined) {
+                        // the server does not know our version (e.g., it restarted) and answered with the first page
+                        vm.handlePage(data, [], null);
+                        return;
+                    }
+                    vm.version = data.version;
+                    vm.setBoardEntries(vm.applyChanges(vm.entries, data.changed, data.deleted), data.server_status);
+                }).fail(function( jqxhr, textStatus, error ) {
+                    vm.retryReload(error);
+                });
+            },
+            applyChanges: function(entries, changed, deleted) {
+                // drop the changed and deleted entries, then insert the changed ones at their new positions (ascending)
+                var removed = {};
+                deleted.forEach(function(id) { removed[id] = true; });
+                changed.forEach(function(change) { removed[change.entry.id] = true; });
+
+                var result = entries.filter(function(entry) { return !removed[entry.id]; });
+                changed.forEach(function(change) {
+                    result.splice(change.position, 0, change.entry);
+                });
+                return result;
+            },
+            retryReload: function(error) {
+                var vm = this;
+                if (error !== "abort") {
+                    setTimeout(function(){
+                        vm.reloadBoard();
+                    }, 1000)
+                }
+            },
             createEntry: function() {
 
                 if (this.requesting) {
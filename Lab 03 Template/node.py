@@ -1,9 +1,15 @@
 # coding=utf-8
+import hashlib
+import json
 import random
 import messenger
 import uuid
+from sortedcontainers import SortedDict, SortedKeyList
 from vector_clock import VectorClock
+from event_log import log
 
+SYNC_INTERVAL = 2.0  # seconds between two vector clock digest exchanges with a random peer
+SYNC_CHUNK = 100  # entries per message when streaming the operations a peer missed
 
 class TimeStamp:
     def __init__(self, vc: VectorClock, tie_breaker=None):
@@ -25,6 +31,10 @@ class TimeStamp:
     def to_list(self) -> list:
         return self.vc.to_list() + [self.tie_breaker]
 
+    def sort_key(self) -> tuple:
+        # a total order that extends the causal order: if a happened before b, the clock sum of a is smaller
+        return (sum(self.vc.to_list()), self.vc.to_list(), str(self.tie_breaker))
+
 
 class Entry:
     def __init__(self, id, value, create_ts, modify_ts=None, delete_ts=None):
@@ -56,21 +66,94 @@ class Entry:
     def __str__(self):
         return str(self.to_dict())
 
+    def sort_key(self) -> tuple:
+        return self.create_ts.sort_key() + (self.id,)
+
     def __lt__(self, other):
-        # TODO: implement the sorting here! Please use the creation vector clock first to preserve causality and then use the entry ID as a tie-breaker
-        return False
+        # use the creation vector clock first to preserve causality and then use the entry ID as a tie-breaker
+        return self.sort_key() < other.sort_key()
 
 
 class Board():
     def __init__(self):
         self.indexed_entries = {}
+        self.ordered_entries = SortedKeyList(key=Entry.sort_key)  # entries that are not deleted, in board order
+        self.version = 0  # incremented on every change, entries must not be changed without calling add_entry
+        self.digest_cache = (-1, None)  # (version, digest)
+        self.epoch = uuid.uuid4().hex  # identifies this board in version tokens
+        self.changes = SortedDict()  # version -> id of the entry changed in that version (only its last change)
+        self.change_versions = {}  # entry id -> version of its last change
+
+    def __len__(self):
+        return len(self.ordered_entries)
 
     def add_entry(self, entry):
+        # also used to modify or delete (i.e., set delete_ts) an entry, the index is updated accordingly
+        old_entry = self.indexed_entries.get(entry.id)
+        if old_entry is not None:
+            self.ordered_entries.discard(old_entry)
         self.indexed_entries[entry.id] = entry
+        if not entry.is_deleted():
+            self.ordered_entries.add(entry)
+        self.record_change(entry.id)
+
+    def get_ordered_entries(self, start=0, limit=None):
+        """Entries in board order, or only the page [start, start + limit) of it"""
+        stop = None if limit is None else start + limit
+        return list(self.ordered_entries.islice(start, stop))
 
-    def get_ordered_entries(self):
-        entries = [e for e in list(self.indexed_entries.values()) if not e.is_deleted()]
-        return sorted(entries)
+    def get_digest(self):
+        """sha256 of the ordered entries as reported by the status endpoints, only recomputed after a change"""
+        if self.digest_cache[0] != self.version:
+            dict_entries = [entry.to_dict() for entry in self.get_ordered_entries()]
+            digest = hashlib.sha256((json.dumps(tuple(dict_entries)).encode('utf-8'))).hexdigest()
+            self.digest_cache = (self.version, digest)
+        return self.digest_cache[1]
+
+    def record_change(self, entry_id):
+        """Bump the version and remember it as the last change of the entry (used for delta reads)"""
+        self.version += 1
+        previous_version = self.change_versions.pop(entry_id, None)
+        if previous_version is not None:
+            del self.changes[previous_version]
+        self.changes[self.version] = entry_id
+        self.change_versions[entry_id] = self.version
+
+    def get_version_token(self) -> str:
+        """Version token for delta reads, tokens of another board (e.g., before a restart) are not accepted"""
+        return f"{self.epoch}:{self.version}"
+
+    def parse_version_token(self, token):
+        """Board version of a token from get_version_token, or None if it doesn't belong to this board"""
+        epoch, _, version = str(token).partition(':')
+        if epoch != self.epoch or not version.isdigit() or int(version) > self.version:
+            return None
+        return int(version)
+
+    def get_changes(self, since: int):
+        """
+        Entries changed after version `since` with their current position in board order (sorted by position),
+        and the ids of the entries deleted after `since`.
+        """
+        changed, deleted = [], []
+        for version in self.changes.irange(minimum=since, inclusive=(False, True)):
+            entry = self.indexed_entries[self.changes[version]]
+            if entry.is_deleted():
+                deleted.append(entry.id)
+            else:
+                changed.append((self.ordered_entries.index(entry), entry))
+        changed.sort(key=lambda change: change[0])
+        return changed, deleted
+
+    def get_page(self, cursor=None, limit=None):
+        """
+        Up to `limit` entries in board order that come after the entry with id `cursor`,
+        and the cursor of the next page (None for the last page).
+        """
+        start = 0 if cursor is None else self.ordered_entries.bisect_key_right(self.indexed_entries[cursor].sort_key())
+        entries = self.get_ordered_entries(start, limit)
+        has_more = start + len(entries) < len(self.ordered_entries)
+        return entries, (str(entries[-1].id) if has_more and entries else None)
 
 
 class Node:
@@ -87,7 +170,11 @@ class Node:
             "num_entries": 0,
         }
         self.r = r
-        self.clock = VectorClock(n=num_servers)
+        self.clock = VectorClock(n=num_servers)  # entry i: number of entries created by node i that were applied here
+        self.ops = {i: [] for i in self.all_servers}  # node id -> its entries (as dicts) in creation order, the k-th has clock entry k + 1
+        self.pending = {i: {} for i in self.all_servers}  # node id -> {clock entry: entry} received before an earlier entry of that node
+        self.next_sync = None  # time of the next digest exchange, None: with the next update
+        self.sync_sent = 0  # entries sent to other nodes by digest exchanges
 
     def is_crashed(self):
         return self.status["crashed"]
@@ -97,19 +184,20 @@ class Node:
         return list(map(lambda entry: entry.to_dict(), ordered_entries))
 
     def create_entry(self, value):
-        self.status['num_entries'] += 1
-        entry_id = str(self.status['num_entries'])
-        entry = Entry(entry_id, value, create_ts=TimeStamp(self.clock.copy(), tie_breaker=None)) # TODO: Add a tie-breaker to the timestamp
-        self.board.add_entry(entry)
-        # TODO: Propagate the entry to all other servers?! (based on your Lab 2 solution)
-        # TODO: Handle with vector clocks
+        # the clock entry of this node numbers its entries, so (clock entry, node id) is a unique id and the tie-breaker
+        seq = self.clock.to_list()[self.own_id] + 1
+        entry = Entry(f"{seq} - {self.own_id}", value, create_ts=TimeStamp(self.clock, tie_breaker=self.own_id))
+        entry.create_ts.vc.increment(self.own_id)
+        self.apply_entry(entry)
+        # pushed once, the entries lost on the way are streamed by the digest exchanges (see start_sync)
+        self.messenger.broadcast(messenger.Message({'type': 'propagate', 'entry': entry.to_dict(), 'from': self.own_id}), self.other_servers)
 
     def update_entry(self, entry_id, value):
-        print("Updating entry with id {} to value {}".format(entry_id, value))
+        log.info("Updating entry with id {} to value {}", entry_id, value, node=self.own_id)
         # TODO: Handle with vector clocks
 
     def delete_entry(self, entry_id):
-        print("Deleting entry with id {}".format(entry_id))
+        log.info("Deleting entry with id {}", entry_id, node=self.own_id)
         # TODO: Handle with vector clocks
 
     def handle_message(self, message):
@@ -120,16 +208,90 @@ class Node:
         msg_content = message.get_content()
 
         if 'type' not in msg_content:
-            print(f"Node {self.own_id}: Received message without type: {msg_content}")
+            log.warning("Received message without type: {}", msg_content, node=self.own_id)
             return
 
         msg_type = msg_content['type']
 
         if msg_type == 'propagate':
-            print(f"Node {self.own_id}: Received propagate message: {msg_content}")
-            pass
+            log.debug("Received propagate message: {}", msg_content, node=self.own_id)
+            self.apply_entry(Entry.from_dict(msg_content['entry']))
+
+        elif msg_type == 'sync':
+            self.handle_sync(msg_content)
+
+        elif msg_type == 'sync_entries':
+            for data in msg_content['entries']:
+                self.apply_entry(Entry.from_dict(data))
+
+    def apply_entry(self, entry):
+        """
+        Add an entry created by any node (including this one) unless its timestamp is dominated by our clock.
+        The entries of every node are applied in creation order, so that our clock entry i is the number of entries
+        of node i we have, entries that arrive early wait in self.pending.
+        """
+        origin = entry.create_ts.tie_breaker
+        seq = entry.create_ts.vc.to_list()[origin]
+        applied = self.clock.to_list()[origin]
+        if seq <= applied:
+            return  # we already have it, e.g., pushed and streamed
+        pending = self.pending[origin]
+        pending[seq] = entry
+        while applied + 1 in pending:
+            entry = pending.pop(applied + 1)
+            self.board.add_entry(entry)
+            self.ops[origin].append(entry.to_dict())
+            self.clock.increment(origin)
+            self.status['num_entries'] += 1
+            applied += 1
+
+    def recover(self):
+        """Called by the server when the node comes back after a crash: exchange digests with the next update"""
+        self.next_sync = None
+
+    def start_sync(self, t):
+        """
+        Digest exchange: send our vector clock to a random peer, which streams back exactly the entries whose timestamps
+        are not dominated by it (the entries of node i after our clock entry i) and sends its own clock back if it
+        misses entries we have. The cost is one clock per round plus the missed entries, however large the boards are.
+        Started every SYNC_INTERVAL and right after a recovery, not retransmitted (the next round repeats it).
+        """
+        self.next_sync = t + SYNC_INTERVAL
+        if self.other_servers:
+            self.send_sync(self.r.choice(self.other_servers), reply=True)
+
+    def send_sync(self, peer, reply):
+        msg = {
+            'type': 'sync',
+            'vc': self.clock.to_list(),
+            'reply': reply,
+            'from': self.own_id
+        }
+        self.messenger.send(peer, messenger.Message(msg))
+
+    def handle_sync(self, msg_content):
+        remote, own = msg_content['vc'], self.clock.to_list()
+        missing = [data for i in self.all_servers for data in self.ops[i][remote[i] if i < len(remote) else 0:]]
+        for start in range(0, len(missing), SYNC_CHUNK):
+            msg = {'type': 'sync_entries', 'entries': missing[start:start + SYNC_CHUNK], 'from': self.own_id}
+            self.messenger.send(msg_content['from'], messenger.Message(msg))
+        self.sync_sent += len(missing)
+        if msg_content['reply'] and any(r > o for r, o in zip(remote, own)):
+            self.send_sync(msg_content['from'], reply=False)  # the peer has entries we miss
+
+    def next_timeout(self):
+        """
+        Time at which update() has work to do without receiving a message (the next digest exchange), or None.
+        Used by the event-driven simulation to only wake up the node when needed. Before the first exchange and after
+        a recovery next_sync is None: the simulation updates the node anyway (wake_all, wake_node), which starts it.
+        """
+        return self.next_sync
 
     def update(self, t: float):
+        self.messenger.hold()  # everything sent during one update leaves as one batch per destination
         msgs = self.messenger.receive()
         for msg in msgs:
             self.handle_message(msg)
+        if self.next_sync is None or t >= self.next_sync:
+            self.start_sync(t)
+        self.messenger.flush()
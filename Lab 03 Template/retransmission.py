@@ -0,0 +1,222 @@
+import heapq
+import math
+import random
+from typing import Dict, Hashable, List, Optional, Tuple
+
+MIN_RTO = 0.1  # seconds, lower bound of the retransmission timeout
+MAX_RTO = 4.0  # seconds, upper bound of the timeout after backing off (twice the initial timeout)
+CLOCK_GRANULARITY = 0.01  # the simulation tick, the timeout is never closer than that to the smoothed RTT
+RTTVAR_FACTOR = 0  # weight of the RTT variation in the timeout, RFC 6298 uses 4, which waits far too long on lossy links
+BACKOFF_AFTER = 3  # retransmissions of a message with the plain timeout before it is backed off, single losses are common
+BACKOFF = 2.0  # factor of the timeout per further retransmission of a message
+PROBE = 0.25  # fraction of the timeout after which a peer whose messages back off is probed with one of them
+JITTER = 0.1  # timeouts are stretched by up to 10% so that retransmissions to different peers do not line up
+MAX_IN_FLIGHT = 128  # retransmissions per peer that may be unacknowledged at the same time
+
+
+class RtoEstimator:
+    """
+    Retransmission timeout of one peer, estimated from the round-trip times (Jacobson/Karels, RFC 6298).
+
+    Only messages which were sent exactly once are measured (Karn's algorithm), an ack for a retransmitted message
+    could belong to any of its copies.
+    """
+
+    def __init__(self, initial_rto: float, min_rto: float = MIN_RTO, max_rto: float = MAX_RTO):
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = None  # smoothed round-trip time
+        self.rttvar = None  # round-trip time variation
+        self.rto = self.clamp(initial_rto)
+
+    def clamp(self, rto: float) -> float:
+        return min(self.max_rto, max(self.min_rto, rto))
+
+    def observe(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = self.clamp(self.srtt + max(CLOCK_GRANULARITY, RTTVAR_FACTOR * self.rttvar))
+
+    def backoff(self, attempts: int) -> float:
+        """Timeout of a message which was already sent `attempts` times: doubled for every retransmission after BACKOFF_AFTER"""
+        return self.clamp(self.rto * BACKOFF ** max(0, attempts - BACKOFF_AFTER + 1))
+
+
+class OutstandingTable:
+    """
+    Messages which were sent but not acknowledged yet, keyed by (peer, key), e.g., (node_id, sequence id).
+
+    Adding and acknowledging a message is O(1) (dict). Messages are grouped into timer buckets by the tick of their
+    deadline (rounded up to the resolution, the simulation tick) and a heap holds the ticks of the buckets, so a tick
+    only touches the buckets which expired, independent of how many messages are outstanding, and the messages whose
+    jittered deadlines fall into the same tick expire together and are retransmitted in one batch per peer.
+
+    The deadline of a message is its send time plus the RTO of the peer (see RtoEstimator), doubled for every
+    retransmission of the message after the first BACKOFF_AFTER ones, plus a random jitter (one draw per peer and send
+    time). The backoff is per message and not per peer: the simulated links drop messages at random, a timeout does not
+    mean that the peer as a whole got slower. While messages to a peer back off, one of them probes the peer at a
+    fraction of the RTO, and as soon as anything arrives from the peer (see revive) the backed off messages are resent
+    right away, so a peer that was cut off for a long time catches up without waiting for max_rto.
+    At most max_in_flight retransmissions per peer are unacknowledged at a time, further expired messages wait for
+    the next timeout instead of flooding a slow or lossy link.
+    If the peers delay their acks (to cover several messages with one), ack_delay is the longest they wait, it is
+    added to every timeout like the max_ack_delay of QUIC, otherwise every delayed ack would look like a loss.
+    """
+
+    def __init__(self, timeout: float, r: Optional[random.Random] = None, min_rto: float = MIN_RTO, max_rto: float = MAX_RTO,
+                 jitter: float = JITTER, max_in_flight: Optional[int] = MAX_IN_FLIGHT, resolution: float = CLOCK_GRANULARITY,
+                 ack_delay: float = 0.0):
+        self.timeout = timeout  # initial retransmission timeout of every peer
+        self.r = r if r is not None else random.Random()
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.jitter = jitter
+        self.max_in_flight = max_in_flight
+        self.resolution = resolution
+        self.ack_delay = ack_delay
+        self.rto = {}  # peer -> RtoEstimator
+        self.pending = {}  # (peer, key) -> [message, send_time, deadline tick, attempts, measurable]
+        self.buckets = {}  # deadline tick -> {(peer, key): None}, insertion ordered
+        self.deadlines = []  # heap of the bucket ticks
+        self.retransmitting = {}  # peer -> {key: None} of retransmitted messages whose timeout did not expire yet
+        self.backed_off = {}  # peer -> {key: None} of messages with a backed off timeout, resent once the peer acks again
+        self.probes = {}  # peer -> key of the message that is retransmitted with the plain timeout while the others back off
+        self.jitters = {}  # peer -> (send time, jitter factor), shared by the messages sent to the peer at the same time
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __contains__(self, peer_key: Tuple[int, Hashable]):
+        return peer_key in self.pending
+
+    def estimator(self, peer: int) -> RtoEstimator:
+        estimator = self.rto.get(peer)
+        if estimator is None:
+            estimator = self.rto[peer] = RtoEstimator(self.timeout, self.min_rto, self.max_rto)
+        return estimator
+
+    def add(self, peer: int, key: Hashable, message, t: float, measure_rtt: bool = True):
+        """
+        Track a message sent to peer at time t, replaces a pending message with the same key.
+        Pass measure_rtt=False if t is not the actual send time, the ack must not be used as RTT sample then.
+        """
+        self.ack(peer, key)
+        self.schedule(peer, key, [message, t, None, 0, measure_rtt])
+
+    def schedule(self, peer: int, key: Hashable, pending: list):
+        estimator = self.estimator(peer)
+        rto = estimator.backoff(pending[3])
+        if rto > estimator.rto:
+            if peer not in self.probes:
+                self.probes[peer] = key  # retransmitted often, so that we notice soon when the peer is back
+                rto = estimator.rto * PROBE
+            else:
+                self.backed_off.setdefault(peer, {})[key] = None
+        deadline = pending[1] + rto * self.jitter_factor(peer, pending[1]) + self.ack_delay
+        deadline = math.ceil(deadline / self.resolution - 1e-9)  # the tick, not the exact float, keys the bucket
+        self.insert(peer, key, pending, deadline)
+
+    def insert(self, peer: int, key: Hashable, pending: list, deadline: int):
+        pending[2] = deadline
+        self.pending[(peer, key)] = pending
+        bucket = self.buckets.get(deadline)
+        if bucket is None:
+            bucket = self.buckets[deadline] = {}
+            heapq.heappush(self.deadlines, deadline)
+        bucket[(peer, key)] = None
+
+    def remove(self, peer: int, key: Hashable) -> Optional[list]:
+        pending = self.pending.pop((peer, key), None)
+        if pending is not None:
+            bucket = self.buckets[pending[2]]
+            del bucket[(peer, key)]
+            if not bucket:
+                del self.buckets[pending[2]]  # its deadline is dropped from the heap lazily
+        return pending
+
+    def jitter_factor(self, peer: int, t: float) -> float:
+        # one draw per peer and send time: messages sent together expire together and are retransmitted in one batch
+        if not self.jitter:
+            return 1.0
+        jitter = self.jitters.get(peer)
+        if jitter is None or jitter[0] != t:
+            jitter = self.jitters[peer] = (t, 1 + self.r.uniform(0, self.jitter))
+        return jitter[1]
+
+    def ack(self, peer: int, key: Hashable, t: Optional[float] = None) -> bool:
+        """
+        Remove the message, returns False if it was not pending (e.g., a duplicate ack).
+        If the ack was received at time t, the peer is revived and if the message was sent only once, the round-trip
+        time is measured.
+        """
+        pending = self.remove(peer, key)
+        if pending is None:
+            return False
+        _, send_time, _, _, measurable = pending
+        self.retransmitting.get(peer, {}).pop(key, None)
+        self.backed_off.get(peer, {}).pop(key, None)
+        if self.probes.get(peer) == key:
+            del self.probes[peer]
+        if t is not None:
+            if measurable:
+                self.estimator(peer).observe(t - send_time)
+            self.revive(peer, t)
+        return True
+
+    def revive(self, peer: int, t: float):
+        """
+        A message from the peer arrived at time t, so it is reachable again (e.g., after a partition healed):
+        its messages with a backed off timeout expire right away instead of waiting for up to max_rto.
+        """
+        tick = math.ceil(t / self.resolution - 1e-9)
+        for key in self.backed_off.pop(peer, ()):
+            pending = self.remove(peer, key)
+            pending[3] = 0  # the peer is back, the backoff starts over
+            self.insert(peer, key, pending, tick)
+
+    def next_timeout(self) -> Optional[float]:
+        """Time at which the next pending message has to be retransmitted, or None"""
+        self.drop_empty()
+        if not self.deadlines:
+            return None
+        return self.deadlines[0] * self.resolution
+
+    def expired(self, t: float) -> Dict[int, List[object]]:
+        """
+        Pop all messages whose deadline passed and track them again with send time t and a doubled timeout.
+        Returns the messages to retransmit grouped by peer (oldest first), so they can be sent in one batch.
+        """
+        expired = {}
+        self.drop_empty()
+        tick = math.floor(t / self.resolution + 1e-9)
+        while self.deadlines and tick >= self.deadlines[0]:
+            for peer, key in self.buckets.pop(heapq.heappop(self.deadlines)):
+                expired.setdefault(peer, []).append((key, self.pending.pop((peer, key))))
+                self.retransmitting.get(peer, {}).pop(key, None)  # no longer in flight
+                self.backed_off.get(peer, {}).pop(key, None)
+                if self.probes.get(peer) == key:
+                    del self.probes[peer]
+            self.drop_empty()
+
+        retransmit = {}
+        for peer, messages in expired.items():
+            in_flight = self.retransmitting.setdefault(peer, {})
+            for key, pending in messages:
+                pending[1] = t
+                pending[4] = False  # the ack can no longer be matched to one send
+                if self.max_in_flight is None or len(in_flight) < self.max_in_flight:
+                    pending[3] += 1
+                    in_flight[key] = None
+                    retransmit.setdefault(peer, []).append(pending[0])
+                # otherwise the message is not sent now and waits for another timeout
+                self.schedule(peer, key, pending)
+        return retransmit
+
+    def drop_empty(self):
+        # pop deadlines whose messages were all acknowledged
+        while self.deadlines and self.deadlines[0] not in self.buckets:
+            heapq.heappop(self.deadlines)
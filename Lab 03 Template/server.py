@@ -1,4 +1,5 @@
 # coding=utf-8
+import asyncio
 import queue
 import random
 import traceback
@@ -7,6 +8,8 @@ from bottle import Bottle, request, HTTPError, run, response, static_file
 
 from paste import httpserver
 
+import async_server
+
 import threading
 import os
 import time
@@ -15,21 +18,39 @@ import hashlib
 
 from messenger import Messenger, Transport, UnreliableTransport
 from node import Node
+from scheduler import EventSimulation, node_random, wall_clock
+from event_log import LEVEL_NAMES, log
+from socket_transport import Network, SocketTransport, peer_addresses
 import time
 
 NUM_NODES = int(os.getenv('NUM_NODES')) if os.getenv('NUM_NODES') else 2
 GROUP_NAME = os.getenv('GROUP_NAME')
 # Port for the server to listen on
 SERVER_PORT = int(os.getenv('PORT')) if os.getenv('PORT') else 80
+# Threads which update nodes in parallel (ignored unless Python is a free-threaded build, see EventSimulation)
+NUM_WORKERS = int(os.getenv('NUM_WORKERS')) if os.getenv('NUM_WORKERS') else 1
+# HTTP server: "paste" (thread pool) or "asyncio" (uvicorn, one event loop for all connections and the simulation)
+SERVER_CORE = os.getenv('SERVER_CORE') or 'paste'
 # External port for frontend to connect to (used when running in Docker with port mapping)
 # In Docker: server listens on 80, but externally accessible on 8000
 # Locally: server listens on 8000, externally accessible on 8000
 EXTERNAL_PORT = int(os.getenv('EXTERNAL_PORT')) if os.getenv('EXTERNAL_PORT') else SERVER_PORT
+# Multi-process mode (see launcher.py): this process only runs node NODE_ID and serves it on EXTERNAL_PORT,
+# the other nodes run in their own processes (node i on EXTERNAL_PORT - NODE_ID + i) and are reached over TCP
+NODE_ID = int(os.getenv('NODE_ID')) if os.getenv('NODE_ID') else None
+PEER_HOST = os.getenv('PEER_HOST') or '127.0.0.1'
+# Node i listens for the messages of the other nodes on PEER_PORT + i
+PEER_PORT = int(os.getenv('PEER_PORT')) if os.getenv('PEER_PORT') else 9000
+
+def node_address(node_id):
+    if NODE_ID is None:
+        return f"127.0.0.1:{EXTERNAL_PORT}/nodes/{node_id}"
+    return f"127.0.0.1:{EXTERNAL_PORT - NODE_ID + node_id}/nodes/{node_id}"
 
 def index(server=0):
     with open('frontend/index.html') as f:
         s = f.read()
-        s = s.replace("%SERVER_LIST%", ",".join([f"127.0.0.1:{EXTERNAL_PORT}/nodes/{i}" for i in range(NUM_NODES)]))  # replace list of servers
+        s = s.replace("%SERVER_LIST%", ",".join([node_address(i) for i in range(NUM_NODES)]))  # replace list of servers
         s = s.replace("%SERVER_ID%", str(server))  # replace selected server
         s = s.replace("%GROUP_NAME%", GROUP_NAME)  # replace group name
         return s
@@ -46,11 +67,14 @@ class Server(Bottle):
     def __init__(self):
         super(Server, self).__init__()
 
-        self.lock = threading.RLock()  # use reentry lock for the server
+        # one reentry lock per node instead of a single server lock: requests for different nodes (and the simulation
+        # updating other nodes) do not have to wait for each other
+        self.node_locks = [threading.RLock() for _ in range(NUM_NODES)]
 
         # Handle CORS
         self.route('/<:re:.*>', method='OPTIONS', callback=self.add_cors_headers)
         self.add_hook('after_request', self.add_cors_headers)
+        self.add_hook('before_request', self.check_node)
 
         # Those two http calls simulate crashes, i.e., unavailability of the server
         self.post('/nodes/<node_id:int>/crash', callback=self.crash_request)
@@ -63,70 +87,124 @@ class Server(Bottle):
         self.post('/nodes/<node_id:int>/entries/<entry_id>', callback=self.update_entry_request)
         self.post('/nodes/<node_id:int>/entries/<entry_id>/delete', callback=self.delete_entry_request)
 
+        # recent events of the event log, e.g., /debug/events?level=debug&node=1&limit=100
+        self.get('/debug/events', callback=self.debug_events_request)
+        self.post('/debug/events/level', callback=self.debug_level_request)
+
         self.get('/', callback=index)
         self.get('/server/<server>', callback=index)
         self.get('/<filename:path>', callback=serve_static_file)
 
-        self.r = random.Random(42)  # use a fixed seed for replayability
+        self.seed = 42  # use a fixed seed for replayability
+        self.r = random.Random(self.seed)
 
-        self.nodes = []
+        self.nodes = {}  # node_id -> Node, only NODE_ID in multi-process mode
 
         # define nodes
-        for node_id in range(NUM_NODES):
+        for node_id in (range(NUM_NODES) if NODE_ID is None else [NODE_ID]):
             m = Messenger(node_id, NUM_NODES)
-            n = Node(m, node_id, NUM_NODES, self.r)
-            self.nodes.append(n)
+            n = Node(m, node_id, NUM_NODES, node_random(self.seed, node_id))  # each node draws from its own stream
+            self.nodes[node_id] = n
 
         # define transport from one server to all others
         # Start with reliable transport for basic implementation
         # Students will enable unreliable transport for Task 4 (Medium/Hard scenarios)
         self.transports = {}
-        for from_id in range(NUM_NODES):
+        self.network = None if NODE_ID is None else Network(PEER_HOST, PEER_PORT + NODE_ID, self.receive)
+        if NODE_ID is None:
+            for from_id in range(NUM_NODES):
+                for to_id in range(NUM_NODES):
+                    # Use Transport for perfect/reliable delivery (no delays, no drops)
+                    # transport = Transport(self.nodes[from_id].messenger.out_queues[to_id], self.nodes[to_id].messenger.in_queue, self.r)
+
+                    # Replace with UnreliableTransport and configure delays/drops
+                    transport = UnreliableTransport(self.nodes[from_id].messenger.out_queues[to_id], self.nodes[to_id].messenger.in_queue, self.r)
+                    transport.set_delay(0.5, 2.0)  # 0.5-2.0 second delay
+                    transport.set_drop_rate(0.1)   # 10% packet loss
+
+                    self.transports[(from_id, to_id)] = transport
+        else:
+            # the other nodes run in their own processes, only the link to ourselves stays in memory
+            addresses = peer_addresses(PEER_HOST, PEER_PORT, NUM_NODES)
+            messenger = self.nodes[NODE_ID].messenger
             for to_id in range(NUM_NODES):
-                # Use Transport for perfect/reliable delivery (no delays, no drops)
-                # transport = Transport(self.nodes[from_id].messenger.out_queues[to_id], self.nodes[to_id].messenger.in_queue, self.r)
-
-                # Replace with UnreliableTransport and configure delays/drops
-                transport = UnreliableTransport(self.nodes[from_id].messenger.out_queues[to_id], self.nodes[to_id].messenger.in_queue, self.r)
-                transport.set_delay(0.5, 2.0)  # 0.5-2.0 second delay
-                transport.set_drop_rate(0.1)   # 10% packet loss
+                if to_id == NODE_ID:
+                    transport = Transport(messenger.out_queues[to_id], messenger.in_queue, self.r)
+                else:
+                    transport = SocketTransport(messenger.out_queues[to_id], self.network, addresses[to_id])
+                self.transports[(NODE_ID, to_id)] = transport
 
-                self.transports[(from_id, to_id)] = transport
-
-        # start a thread which updates all nodes in a loop
+        # the nodes are updated by simulate() on the event loop or by update_nodes() on a thread, see start_update_thread()
         self.node_update_time_delta = 0.01 # seconds
+        # discrete-event engine: only links with messages in flight and nodes with pending work are stepped
+        self.simulation = EventSimulation(list(self.nodes.values()), self.transports, resolution=self.node_update_time_delta, r=self.r, locks=self.node_locks, catch_errors=True, workers=NUM_WORKERS, clock=wall_clock())
+        if self.network is not None:
+            self.network.start()  # accept the messages of the other nodes once the simulation can process them
+
+    def start_update_thread(self):
+        # start a thread which updates all nodes in a loop (for the paste server)
         self.node_worker_thread = threading.Thread(target=self.update_nodes)
         self.node_worker_thread.daemon = True
         self.node_worker_thread.start()
 
-    def update_nodes(self):
-
-        t = 0.0
-        rand_nodes = self.nodes.copy() # we copy it here because we reorder it
+    async def simulate(self):
+        # like update_nodes, but as a task on the event loop of the asyncio server, which runs the handlers on its
+        # WSGI threads: the node locks are only held for single node calls, so the loop is never blocked for long
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        self.simulation.scheduler.on_schedule = lambda: loop.call_soon_threadsafe(wakeup.set)
+        clock = self.simulation.clock
         while True:
+            wakeup.clear()
+            self.simulation.run_until(clock())
+            next_time = self.simulation.scheduler.next_time()
+            timeout = max(0.0, next_time - clock()) if next_time is not None else None
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
-            # iterate through all transports and deliver messages
-            # no lock needed here as the transport only works on the queues
-            for transport in self.transports.values():
-                transport.deliver(t)
-
-            # shuffle nodes based on the random generator
-            self.r.shuffle(rand_nodes)
+    def update_nodes(self):
 
-            # update all alive nodes, note that we lock!
-            with self.lock:
-                for node in rand_nodes:
-                    if not node.is_crashed():
-                        try:
-                            node.update(t)
-                        except Exception as e:
-                            print("[ERROR] " + str(e))
-                            print(traceback.format_exc())
-                            pass
+        # the simulated time follows the wall clock, but instead of waking up every tick
+        # we sleep until the next event (message arrival, retransmission timer or client operation) is due
+        clock = self.simulation.clock
+        while True:
+            self.simulation.run_until(clock())
+            self.simulation.scheduler.wait(clock())
 
-            time.sleep(self.node_update_time_delta)  # sleep a bit, note that this is not very precise i.e., the actual time delta might be larger
-            t += self.node_update_time_delta
 
+    def debug_events_request(self):
+        try:
+            node = request.query.get('node')
+            limit = request.query.get('limit')
+            if (node is not None and not node.isdigit()) or (limit is not None and not limit.isdigit()):
+                raise HTTPError(400, "node and limit must be non-negative integers")
+            events = log.recent(request.query.get('level') or 'debug', int(node) if node is not None else None,
+                                int(limit) if limit is not None else None)
+            return {"level": LEVEL_NAMES.get(log.level, log.level), "events": [event.to_dict() for event in events]}
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+
+    def debug_level_request(self):
+        # e.g., level=debug to start tracing every message, level=info to stop it again
+        try:
+            log.set_level(request.forms.get('level'))
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        return {"level": LEVEL_NAMES.get(log.level, log.level)}
+
+    def receive(self, msg):
+        # called on the network thread for every message from another process
+        node = self.nodes[NODE_ID]
+        node.messenger.in_queue.put(msg)
+        self.simulation.wake_node(NODE_ID, self.simulation.advance())
+
+    def check_node(self):
+        # in multi-process mode the other nodes are served by their own processes
+        parts = request.path.split('/')
+        if len(parts) > 2 and parts[1] == 'nodes' and parts[2].isdigit() and int(parts[2]) not in self.nodes:
+            raise HTTPError(404, f"node {parts[2]} is not served by this process")
 
     # Please try to avoid modifying the following methods
     # ------------------------------------------------------------------------------------------------------
@@ -141,38 +219,63 @@ class Server(Bottle):
 
     def list_entries_request(self, node_id: int):
         # DONT use me for server to server stuff as this is also available when crashed. Please implement another method for that (which also handles the crashed state!)
+        # Optional query parameters:
+        # - since=<version>: only the entries changed (with their position) and deleted after that version
+        # - limit=<n> and cursor=<next_cursor>: one page of the board
         try:
-
-            with self.lock:
-                dict_entries = self.nodes[node_id].get_entries()
-
-                return {
-                    "entries": dict_entries,
-                    "server_status": {
-                        "len": len(dict_entries),
-                        "hash": hashlib.sha256((json.dumps(tuple(dict_entries)).encode('utf-8'))).hexdigest(),
-                        "crashed": self.nodes[node_id].status["crashed"],
-                        "notes": self.nodes[node_id].status["notes"]
-                    }  # we piggyback here allowing for a simple frontend implementation
-                }
+            since = request.query.get('since')
+            cursor = request.query.get('cursor')
+            limit = request.query.get('limit')
+            if limit is not None and (not limit.isdigit() or int(limit) < 1):
+                raise HTTPError(400, "limit must be a positive integer")
+
+            with self.node_locks[node_id]:
+                board = self.nodes[node_id].board
+                since_version = board.parse_version_token(since) if since is not None else None
+
+                if since_version is not None:
+                    changed, deleted = board.get_changes(since_version)
+                    result = {
+                        "changed": [{"position": position, "entry": entry.to_dict()} for position, entry in changed],
+                        "deleted": deleted
+                    }
+                else:
+                    # unknown versions (e.g., from before a restart) get a full read as well
+                    try:
+                        entries, next_cursor = board.get_page(cursor, int(limit) if limit is not None else None)
+                    except (KeyError, ValueError):
+                        raise HTTPError(400, "unknown cursor")
+                    result = {
+                        "entries": [entry.to_dict() for entry in entries],
+                        "next_cursor": next_cursor
+                    }
+
+                result["version"] = board.get_version_token()
+                result["server_status"] = {
+                    "len": len(board),
+                    "hash": board.get_digest(),  # cached until the board changes
+                    "crashed": self.nodes[node_id].status["crashed"],
+                    "notes": self.nodes[node_id].status["notes"]
+                }  # we piggyback here allowing for a simple frontend implementation
+                return result
         except Exception as e:
-            print("[ERROR] " + str(e))
+            log.error("{}", e, node=node_id)
             raise e
 
     def status_request(self, node_id: int):
         # DONT use me for server to server stuff as this is also available when crashed. Please implement another method for that (which also handles the crashed state!)
         try:
 
-            with self.lock:
-                dict_entries = self.nodes[node_id].get_entries()
+            with self.node_locks[node_id]:
+                board = self.nodes[node_id].board
                 return {
-                    "len": len(dict_entries),
-                    "hash": hashlib.sha256((json.dumps(tuple(dict_entries)).encode('utf-8'))).hexdigest(),
+                    "len": len(board),
+                    "hash": board.get_digest(),  # cached until the board changes
                     "crashed": self.nodes[node_id].status["crashed"],
                     "notes": self.nodes[node_id].status["notes"]
                 }
         except Exception as e:
-            print("[ERROR] " + str(e))
+            log.error("{}", e, node=node_id)
             raise e
 
     def crash_request(self, node_id: int):
@@ -180,15 +283,18 @@ class Server(Bottle):
             if not self.nodes[node_id].status["crashed"]:
                 self.nodes[node_id].status["crashed"] = True
         except Exception as e:
-            print("[ERROR] " + str(e))
+            log.error("{}", e, node=node_id)
             raise e
 
     def recover_request(self, node_id: int):
         try:
             if self.nodes[node_id].status["crashed"]:
-                self.nodes[node_id].status["crashed"] = False
+                with self.node_locks[node_id]:
+                    self.nodes[node_id].status["crashed"] = False
+                    self.nodes[node_id].recover()
+                self.simulation.wake_node(node_id, self.simulation.advance())  # process the messages that arrived meanwhile
         except Exception as e:
-            print("[ERROR] " + str(e))
+            log.error("{}", e, node=node_id)
             raise e
 
     def create_entry_request(self, node_id):
@@ -199,11 +305,13 @@ class Server(Bottle):
 
             entry_value = request.forms.get('value')
 
-            with self.lock:
-                return self.nodes[node_id].create_entry(entry_value)
+            with self.node_locks[node_id]:
+                result = self.nodes[node_id].create_entry(entry_value)
+            self.simulation.wake_node(node_id, self.simulation.advance())  # e.g., to gossip the new entry with the next update
+            return result
 
         except Exception as e:
-            print("[ERROR] " + str(e))
+            log.error("{}", e, node=node_id)
             raise e
 
     def update_entry_request(self, node_id: int, entry_id):
@@ -214,10 +322,10 @@ class Server(Bottle):
 
             entry_value = request.forms.get('value')
 
-            with self.lock:
+            with self.node_locks[node_id]:
                 return self.nodes[node_id].update_entry(entry_id, entry_value)
         except Exception as e:
-            print("[ERROR] " + str(e))
+            log.error("{}", e, node=node_id)
             raise e
 
     def delete_entry_request(self, node_id: int, entry_id):
@@ -228,19 +336,24 @@ class Server(Bottle):
 
             entry_value = request.forms.get('value')
 
-            with self.lock:
+            with self.node_locks[node_id]:
                 return self.nodes[node_id].delete_entry(entry_id)
 
         except Exception as e:
-            print("[ERROR] " + str(e))
+            log.error("{}", e, node=node_id)
             raise e
 
 
-# Sleep a bit to allow logging to be attached
-time.sleep(2)
+if __name__ == "__main__":
+    # Sleep a bit to allow logging to be attached
+    time.sleep(2)
 
-server = Server()
+    server = Server()
 
-NUM_THREADS = 2
-print("#### Starting labs server with {} nodes on port {}".format(NUM_NODES, SERVER_PORT))
-httpserver.serve(server, host='0.0.0.0', port=SERVER_PORT, threadpool_workers=NUM_THREADS,                  threadpool_options={"spawn_if_under": NUM_THREADS})
\ No newline at end of file
+    NUM_THREADS = 2
+    print("#### Starting labs server with {} nodes on port {}".format(NUM_NODES, SERVER_PORT))
+    if SERVER_CORE == 'asyncio':
+        async_server.serve(server, '0.0.0.0', SERVER_PORT, tasks=[server.simulate])
+    else:
+        server.start_update_thread()
+        httpserver.serve(server, host='0.0.0.0', port=SERVER_PORT, threadpool_workers=NUM_THREADS,                  threadpool_options={"spawn_if_under": NUM_THREADS})
\ No newline at end of file
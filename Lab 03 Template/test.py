@@ -6,6 +6,8 @@ Modify the parameters below to test different scenarios:
 - NUM_ENTRIES: Number of entries to create
 - NUM_SERVERS: Number of nodes
 - SCENARIO: 'easy' (no failures), 'medium' (delays), 'hard' (delays + packet loss)
+- VIRTUAL_TIME: jump from event to event instead of sleeping, stop as soon as all nodes converged
+- NUM_WORKERS: update nodes in parallel, the result is the same as with a single worker
 """
 
 import random
@@ -13,6 +15,7 @@ import time
 from messenger import Message, Messenger, Transport, UnreliableTransport
 from node import Node, Entry, TimeStamp
 from vector_clock import VectorClock
+from scheduler import EventSimulation, node_random
 
 # ============================================================
 # TEST CONFIGURATION
@@ -20,6 +23,8 @@ from vector_clock import VectorClock
 NUM_ENTRIES = 10
 NUM_SERVERS = 4
 SCENARIO = 'hard'  # Options: 'easy', 'medium', 'hard'
+VIRTUAL_TIME = True  # False: step every time_step and sleep like the server does
+NUM_WORKERS = 1  # >1: update the nodes which are due at the same time on a thread pool (virtual time and free-threaded Python only)
 
 # ============================================================
 
@@ -64,12 +69,24 @@ def create_transports(nodes, scenario, r):
     return transports
 
 
-def run_simulation(nodes, transports, duration_seconds=5.0, time_step=0.01):
+def run_simulation(nodes, transports, duration_seconds=5.0, time_step=0.01, start_time=0.0, virtual=VIRTUAL_TIME, stop_when=None):
     """
     Run the distributed system simulation for a specified duration.
     Delivers messages and updates nodes at each time step.
+
+    In virtual time the clock jumps straight to the next pending event (message arrival or retransmission)
+    without sleeping, and the run ends early once stop_when(simulation) returns True.
+    Returns the simulated time that was reached, pass it as start_time to continue the simulation.
     """
-    t = 0.0
+    if virtual:
+        simulation = EventSimulation(nodes, transports, resolution=time_step, start_time=start_time, workers=NUM_WORKERS)
+        simulation.wake_all()  # pick up messages queued before the simulation started
+        try:
+            return simulation.run(start_time + duration_seconds, stop_when)
+        finally:
+            simulation.close()
+
+    t = start_time
     iterations = int(duration_seconds / time_step)
 
     for _ in range(iterations):
@@ -88,6 +105,72 @@ def run_simulation(nodes, transports, duration_seconds=5.0, time_step=0.01):
     return t
 
 
+def converged(nodes, num_entries):
+    """
+    Stop condition for the virtual-time mode:
+    no messages in flight and all running nodes have the same num_entries entries.
+    """
+    def check(simulation):
+        if simulation.in_flight():
+            return False
+        # compare the cached board digests instead of serializing all entries of every node
+        boards = [node.board for node in nodes if not node.is_crashed()]
+        return len(boards[0]) == num_entries and all(board.get_digest() == boards[0].get_digest() for board in boards[1:])
+    return check
+
+
+def test_crash_recovery():
+    """
+    A node crashes and misses the entries created meanwhile, including the messages sent to it (its links are down).
+    After the recovery the digest exchange has to stream exactly the missed entries, not the whole board.
+    """
+    print("=" * 60)
+    print(f"Crash + recovery with digest exchange - Scenario: {SCENARIO}")
+    print("=" * 60)
+
+    r = random.Random(42)
+    nodes = [Node(Messenger(i, NUM_SERVERS), i, NUM_SERVERS, node_random(42, i)) for i in range(NUM_SERVERS)]
+    transports = create_transports(nodes, SCENARIO, r)
+
+    for i in range(NUM_ENTRIES):
+        for node in nodes:
+            node.create_entry(f"Server{node.own_id}_Entry{i}")
+    before = NUM_ENTRIES * NUM_SERVERS
+    t = run_simulation(nodes, transports, duration_seconds=20.0, stop_when=converged(nodes, before))
+
+    crashed = nodes[0]
+    crashed.status["crashed"] = True
+    print(f"Node {crashed.own_id} crashed with {len(crashed.board)} entries")
+    alive_links = {link: transport for link, transport in transports.items() if crashed.own_id not in link}
+
+    for i in range(NUM_ENTRIES):
+        for node in nodes[1:]:
+            node.create_entry(f"Alive_E{i}")
+    total = before + NUM_ENTRIES * (NUM_SERVERS - 1)
+    t = run_simulation(nodes, alive_links, duration_seconds=20.0, start_time=t, stop_when=converged(nodes, total))
+    for link, transport in transports.items():
+        if crashed.own_id in link:
+            lost = transport.in_queue.drain()  # the messages to and from the crashed node are lost
+            transport.in_queue.release(sum(msg.count for msg in lost))
+
+    print(f"Node {crashed.own_id} recovers!")
+    crashed.status["crashed"] = False
+    crashed.recover()
+    sent = sum(node.sync_sent for node in nodes)
+    recovered_at = t
+    t = run_simulation(nodes, transports, duration_seconds=20.0, start_time=t, stop_when=converged(nodes, total))
+
+    expected = nodes[1].get_entries()
+    assert len(expected) == total
+    for node in nodes:
+        assert node.get_entries() == expected
+    streamed = sum(node.sync_sent for node in nodes) - sent
+    missed = total - before
+    print(f"Caught up after {t - recovered_at:.2f}s, {streamed} entries streamed for {missed} missed ones (board: {total})")
+    assert streamed < total  # only (about) the missed entries, not the whole board
+    print("SUCCESS: Crashed node caught up!")
+
+
 if __name__ == "__main__":
     print("=" * 60)
     print(f"Lab 3 Test - Scenario: {SCENARIO}")
@@ -98,7 +181,7 @@ if __name__ == "__main__":
     nodes = []
     for i in range(NUM_SERVERS):
         m = Messenger(i, NUM_SERVERS)
-        n = Node(m, i, NUM_SERVERS, r)
+        n = Node(m, i, NUM_SERVERS, node_random(42, i))
         nodes.append(n)
 
     # Setup transports based on scenario
@@ -116,9 +199,10 @@ if __name__ == "__main__":
     duration = 10.0
 
     print(f"Running simulation for {duration}s...")
-    run_simulation(nodes, transports, duration_seconds=duration)
+    t = run_simulation(nodes, transports, duration_seconds=duration, stop_when=converged(nodes, NUM_ENTRIES * NUM_SERVERS))
 
     elapsed = time.time() - start_time
+    print(f"Simulated time: {t:.2f}s")
     print(f"Time taken: {elapsed:.2f}s")
 
     # Check consistency
@@ -149,6 +233,8 @@ if __name__ == "__main__":
         print("TEST FAILED - Inconsistency detected!")
         print("=" * 60)
 
+    test_crash_recovery()
+
 
 
 """